@@ -7,60 +7,130 @@ With Duplicate Detection, Secure Key Storage, and All Features
 import os
 import sys
 import time
+IMPORT_STARTED = time.perf_counter()
 import json
 import random
+import math
 import ctypes
-import winreg
-import requests
+import importlib.util
+import weakref
 import threading
+import queue
 import sqlite3
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-from datetime import datetime, timedelta
-from PIL import Image, ImageTk, ImageDraw, ImageFile
+from datetime import datetime, timedelta, timezone
+from collections import deque
+from PIL import Image, ImageFile
 import io
-import pystray
 import subprocess
 import tempfile
 import shutil
 import hashlib
-import numpy as np
+from stat import S_ISREG
+from abc import ABC, abstractmethod
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from typing import List, Tuple
 
 # Increase PIL image size limit for large wallpapers
 Image.MAX_IMAGE_PIXELS = None  # Disable decompression bomb check
 ImageFile.LOAD_TRUNCATED_IMAGES = True  # Handle truncated images
 
-# Try to import imagehash, install if not present
-try:
-    import imagehash
-except ImportError:
-    print("Installing imagehash module...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "imagehash"])
-    import imagehash
+class LazyModule:
+    """Stand-in that imports the real module on first attribute access.
+
+    The import runs under a lock with a normal import_module, so threads
+    that race on first use all wait for a fully initialised module.
+    """
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+    
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+def lazy_import(name):
+    """Module that is loaded on first attribute access; None if it is not installed"""
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None:
+        return None
+    return LazyModule(name)
+
+# Heavy or UI-only dependencies load when first used, not at start-up
+requests = lazy_import("requests")
+asyncio = lazy_import("asyncio")
+
+# Hashing needs imagehash (and numpy through it); both load with the first hash
+imagehash = lazy_import("imagehash")
+if imagehash is None:
+    raise ImportError("imagehash is required - install it with: pip install -r requirements.txt")
+
+# tkinter is only needed by the window; headless commands run without Tk installed
+tk = LazyModule("tkinter")
+ttk = LazyModule("tkinter.ttk")
+messagebox = LazyModule("tkinter.messagebox")
+filedialog = LazyModule("tkinter.filedialog")
+
+# Global shortcuts need keyboard
+keyboard = lazy_import("keyboard")
 
-# Try to import keyboard, install if not present
+# Windows-only modules; the core also runs headless on Linux without them
 try:
-    import keyboard
+    import winreg
 except ImportError:
-    print("Installing keyboard module...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "keyboard"])
-    import keyboard
+    winreg = None
 
-# Try to import keyring for secure API key storage
+# The tray icon needs a desktop session; without one the app runs without it
+pystray = lazy_import("pystray")
+HAS_TRAY = pystray is not None
+
+# Keyring for secure API key storage; imported and configured by load_keyring()
+keyring = None
+HAS_KEYRING = importlib.util.find_spec("keyring") is not None
+if not HAS_KEYRING:
+    print("ℹ️ Keyring not installed - API keys will be stored in config file")
+
+def load_keyring():
+    """Import keyring on first use; returns the module, or None if it is unavailable"""
+    global keyring, HAS_KEYRING
+    if keyring is not None or not HAS_KEYRING:
+        return keyring
+    try:
+        import keyring as module
+        if sys.platform == 'win32':
+            from keyring.backends import Windows
+            # Set the Windows backend explicitly
+            module.set_keyring(Windows.WinVaultKeyring())
+            print("✅ Keyring loaded with Windows Credential Manager")
+        keyring = module
+    except Exception as e:
+        HAS_KEYRING = False
+        print(f"ℹ️ Keyring error: {e} - using config file instead")
+    return keyring
+
+# Optional asyncio download engine; HTTP/2 additionally needs the h2 package
+httpx = lazy_import("httpx")
+HAS_HTTPX = httpx is not None
+HAS_HTTP2 = HAS_HTTPX and importlib.util.find_spec("h2") is not None
+
+# Optional inotify backend for the library index (Linux only)
 try:
-    import keyring
-    from keyring.backends import Windows
-    # Set the Windows backend explicitly
-    keyring.set_keyring(Windows.WinVaultKeyring())
-    HAS_KEYRING = True
-    print("✅ Keyring loaded with Windows Credential Manager")
+    from inotify_simple import INotify, flags as inotify_flags
+    HAS_INOTIFY = sys.platform.startswith('linux')
 except ImportError:
-    HAS_KEYRING = False
-    print("ℹ️ Keyring not installed - API keys will be stored in config file")
-except Exception as e:
-    HAS_KEYRING = False
-    print(f"ℹ️ Keyring error: {e} - using config file instead")
+    HAS_INOTIFY = False
 
 # ============================================================================
 # CONFIGURATION
@@ -75,13 +145,24 @@ else:
     APP_DATA = os.path.dirname(os.path.abspath(__file__))
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-os.makedirs(APP_DATA, exist_ok=True)
+def set_app_data(folder):
+    """Point every data file at folder; benchmarks use this to run on throwaway data"""
+    global APP_DATA, CONFIG_FILE, DATABASE_FILE, DUPLICATE_DB_FILE, LAST_WALLPAPER_FILE, KEYWORDS_FILE
+    global LIBRARY_DB_FILE, THUMBNAIL_CACHE_FOLDER, RENDER_CACHE_FOLDER, SEARCH_CACHE_FILE, DOWNLOAD_JOBS_FILE
+    os.makedirs(folder, exist_ok=True)
+    APP_DATA = folder
+    CONFIG_FILE = os.path.join(APP_DATA, "wallpaper_changer_config.json")
+    DATABASE_FILE = os.path.join(APP_DATA, "wallhaven_favorites.db")
+    DUPLICATE_DB_FILE = os.path.join(APP_DATA, "duplicate_hashes.db")
+    LAST_WALLPAPER_FILE = os.path.join(APP_DATA, "last_wallpaper.dat")
+    KEYWORDS_FILE = os.path.join(APP_DATA, "keywords.json")
+    LIBRARY_DB_FILE = os.path.join(APP_DATA, "library_index.db")
+    THUMBNAIL_CACHE_FOLDER = os.path.join(APP_DATA, "thumbnails")
+    RENDER_CACHE_FOLDER = os.path.join(APP_DATA, "rendered")
+    SEARCH_CACHE_FILE = os.path.join(APP_DATA, "search_cache.db")
+    DOWNLOAD_JOBS_FILE = os.path.join(APP_DATA, "download_jobs.db")
 
-CONFIG_FILE = os.path.join(APP_DATA, "wallpaper_changer_config.json")
-DATABASE_FILE = os.path.join(APP_DATA, "wallhaven_favorites.db")
-DUPLICATE_DB_FILE = os.path.join(APP_DATA, "duplicate_hashes.db")
-LAST_WALLPAPER_FILE = os.path.join(APP_DATA, "last_wallpaper.dat")
-KEYWORDS_FILE = os.path.join(APP_DATA, "keywords.json")
+set_app_data(APP_DATA)
 
 PICTURES_FOLDER = os.path.join(os.path.expanduser("~"), "Pictures")
 WALLHAVEN_FOLDER = os.path.join(PICTURES_FOLDER, "Wallhaven")
@@ -129,6 +210,7 @@ DEFAULT_CONFIG = {
     "min_resolution": "1920x1080",
     "aspect_ratios": [],
     "wallpaper_style": "fill",
+    "wallpaper_setter": "auto",
     "notifications": True,
     "theme": "light",
     "accent_color": "#3b82f6",
@@ -136,9 +218,31 @@ DEFAULT_CONFIG = {
     "random_order": True,
     "keywords": [],
     "downloads_per_keyword": 10,
+    "download_workers": 4,
+    "download_rate_limit": 2.0,  # images per second across all workers, 0 = unlimited
+    "download_backend": "threads",  # "threads" or "async" (needs httpx)
+    "async_concurrency": 50,
+    "thumbnail_cache_mb": 50,
+    "fast_start": True,
+    "render_enabled": False,
+    "render_target": "auto",
+    "render_cache_mb": 200,
+    "render_quality": 90,
+    "prefilter_enabled": True,  # skip known/oversized/off-filter search results before downloading
+    "prefetch_enabled": True,
+    "prefetch_depth": 3,
+    "prefetch_staging_mb": 100,
+    "search_cache_ttl": 3600,  # seconds a search page is reused, 0 = no cache
+    "search_cache_entries": 200,
+    "http_pool_size": 10,
+    "http_timeout": 30,
+    "http_max_retries": 4,
+    "api_rate_limit": 45,  # Wallhaven API calls per minute, shared by every caller
     "last_keyword_download": {},
     "quota_enabled": True,
     "quota_size": 1000,
+    "quota_auto_evict": False,
+    "quota_eviction_policy": "lru",
     "shortcuts": {
         "next": "ctrl+alt+right",
         "previous": "ctrl+alt+left",
@@ -154,7 +258,10 @@ DEFAULT_CONFIG = {
     "duplicate_hash_size": 8,
     "duplicate_auto_cleanup": False,
     "duplicate_keep_newest": True,
-    "duplicate_similarity_threshold": 0.9
+    "duplicate_similarity_threshold": 0.9,
+    "duplicate_scan_workers": 0,  # 0 = one hashing process per CPU core
+    "duplicate_fast_hash": True,
+    "duplicate_thumbnail_check": True  # compare thumbs.small before fetching the full image
 }
 
 # ============================================================================
@@ -216,8 +323,8 @@ class SecureConfig:
     @staticmethod
     def get_api_key(config):
         """Get API key from secure storage if available"""
-        # First check if we have a key in keyring
-        if HAS_KEYRING:
+        # First check if we have a key in keyring; skip loading it for keys kept in the config
+        if (config.get("api_key_use_keyring") or not config.get("api_key")) and load_keyring():
             try:
                 # Try to get from Windows Credential Manager
                 api_key = keyring.get_password(SecureConfig.SERVICE_NAME, "wallhaven_api_key")
@@ -234,7 +341,7 @@ class SecureConfig:
         """Set API key in secure storage if requested"""
         success = False
         
-        if HAS_KEYRING and use_keyring:
+        if use_keyring and load_keyring():
             try:
                 # Store in Windows Credential Manager
                 keyring.set_password(SecureConfig.SERVICE_NAME, "wallhaven_api_key", api_key)
@@ -262,7 +369,7 @@ class SecureConfig:
     @staticmethod
     def delete_api_key(config):
         """Remove API key from secure storage"""
-        if HAS_KEYRING:
+        if load_keyring():
             try:
                 # Delete from Windows Credential Manager
                 keyring.delete_password(SecureConfig.SERVICE_NAME, "wallhaven_api_key")
@@ -278,7 +385,7 @@ class SecureConfig:
     @staticmethod
     def verify_keyring():
         """Verify keyring is working and show where keys are stored"""
-        if not HAS_KEYRING:
+        if not load_keyring():
             return False, "Keyring not installed"
         
         try:
@@ -305,12 +412,40 @@ class SecureConfig:
 # ============================================================================
 
 class WallpaperValidator:
-    """Validate image files before setting as wallpaper"""
+    """Validate image files before setting as wallpaper.
+
+    Validation is tiered: a magic-byte check rejects non-images without
+    decoding, a full verify() runs only for files the library index has not
+    seen at their current size and mtime, and its result is remembered there,
+    so validating a known file is one stat and one indexed lookup.
+    """
+    
+    MAGIC = (
+        (0, b'\xff\xd8\xff'),           # JPEG
+        (0, b'\x89PNG\r\n\x1a\n'),      # PNG
+        (0, b'GIF87a'),
+        (0, b'GIF89a'),
+        (8, b'WEBP'),                   # RIFF....WEBP
+        (0, b'BM'),                     # BMP
+    )
+    
+    def __init__(self, library=None):
+        self.library = library
+    
+    @classmethod
+    def has_image_header(cls, file_path: str) -> bool:
+        """Cheap check that the file starts with a known image signature"""
+        try:
+            with open(file_path, 'rb') as f:
+                head = f.read(16)
+        except OSError:
+            return False
+        return any(head[offset:offset + len(magic)] == magic for offset, magic in cls.MAGIC)
     
-    @staticmethod
-    def is_valid_image(file_path: str) -> bool:
-        """Check if file exists and is a valid image"""
-        if not os.path.exists(file_path):
+    @classmethod
+    def is_valid_image(cls, file_path: str) -> bool:
+        """Check if file exists and is a valid image (full verify)"""
+        if not cls.has_image_header(file_path):
             return False
         
         try:
@@ -320,6 +455,24 @@ class WallpaperValidator:
         except Exception:
             return False
     
+    def validate(self, file_path: str) -> bool:
+        """is_valid_image, memoized on (path, size, mtime) in the library index"""
+        if self.library is None:
+            return self.is_valid_image(file_path)
+        
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        
+        known = self.library.cached_validity(file_path, st.st_size, st.st_mtime)
+        if known is not None:
+            return known
+        
+        valid = self.is_valid_image(file_path)
+        self.library.remember(file_path, st.st_size, st.st_mtime, valid)
+        return valid
+    
     @staticmethod
     def get_image_info(file_path: str) -> dict:
         """Get image dimensions and format"""
@@ -335,221 +488,1165 @@ class WallpaperValidator:
         except Exception:
             return None
 
+# ============================================================================
+# SQLITE STORAGE
+# ============================================================================
+
+class _WriteOp:
+    __slots__ = ("sql", "params", "many", "done", "error", "rowcount")
+    
+    def __init__(self, sql, params, many, wait):
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.done = threading.Event() if wait else None
+        self.error = None
+        self.rowcount = 0
+
+class _ReaderHandle:
+    """Thread-local owner of a reader connection; the connection closes when the thread's locals go away"""
+    __slots__ = ("conn", "__weakref__")
+    
+    def __init__(self, conn):
+        self.conn = conn
+
+def _close_reader(conn, readers, lock):
+    with lock:
+        readers.discard(conn)
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+class SQLiteStore:
+    """WAL-mode SQLite database with a single writer thread and per-thread readers.
+
+    Writes are queued to the writer, which drains whatever is waiting and
+    commits it as one transaction (group commit). With synchronous=NORMAL in
+    WAL mode a commit does not fsync, so bulk indexing no longer syncs once
+    per row. Reads use a connection owned by the calling thread and are never
+    blocked by the writer. A reader is closed when its thread exits, so
+    short-lived worker threads do not leak connections.
+    """
+    
+    def __init__(self, db_path: str, batch_size: int = 1000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._readers = set()
+        self._readers_lock = threading.RLock()
+        self._queue = queue.Queue()
+        self._closed = False
+        
+        # Created here so journal_mode=WAL is in place before any reader connects
+        self._writer_conn = self._connect(check_same_thread=False)
+        self._writer_conn.isolation_level = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+    
+    def _connect(self, check_same_thread=True):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=check_same_thread)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-16000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def _reader(self):
+        handle = getattr(self._local, "handle", None)
+        if handle is None:
+            # The finalizer may run on another thread, so the connection must allow that
+            conn = self._connect(check_same_thread=False)
+            handle = _ReaderHandle(conn)
+            self._local.handle = handle
+            with self._readers_lock:
+                self._readers.add(conn)
+            weakref.finalize(handle, _close_reader, conn, self._readers, self._readers_lock)
+        return handle.conn
+    
+    def query(self, sql: str, params=()) -> list:
+        """Run a read-only statement on this thread's connection"""
+        return self._reader().execute(sql, params).fetchall()
+    
+    def query_one(self, sql: str, params=()):
+        return self._reader().execute(sql, params).fetchone()
+    
+    def write(self, sql: str, params=(), many: bool = False, wait: bool = False) -> int:
+        """Queue a write; with wait=True block until committed and return the rowcount"""
+        op = _WriteOp(sql, params, many, wait)
+        self._queue.put(op)
+        if not wait:
+            return 0
+        op.done.wait()
+        if op.error:
+            raise op.error
+        return op.rowcount
+    
+    def flush(self):
+        """Wait until every write queued so far has been committed"""
+        self.write("SELECT 1", wait=True)
+    
+    def _write_loop(self):
+        conn = self._writer_conn
+        while True:
+            op = self._queue.get()
+            if op is None:
+                break
+            
+            batch = [op]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    op = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if op is None:
+                    stop = True
+                    break
+                batch.append(op)
+            
+            try:
+                conn.execute("BEGIN")
+                for op in batch:
+                    try:
+                        if op.many:
+                            cursor = conn.executemany(op.sql, op.params)
+                        else:
+                            cursor = conn.execute(op.sql, op.params)
+                        op.rowcount = cursor.rowcount
+                    except Exception as e:
+                        op.error = e
+                conn.execute("COMMIT")
+            except Exception as e:
+                for op in batch:
+                    op.error = op.error or e
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+            
+            for op in batch:
+                if op.done:
+                    op.done.set()
+                elif op.error:
+                    print(f"Database write error: {op.error}")
+            
+            if stop:
+                break
+        conn.close()
+    
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+        with self._readers_lock:
+            for conn in list(self._readers):
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._readers.clear()
+
+# ============================================================================
+# LIBRARY INDEX
+# ============================================================================
+
+class LibraryIndex:
+    """Persistent path -> (size, mtime, valid) index of the wallpaper folders.
+
+    refresh() diffs a folder against the stored rows using os.scandir stat data
+    and only validates new or changed files. The scandir pass itself is skipped
+    while the folder's own mtime is unchanged, or, with the inotify backend,
+    replaced by a stat of just the names reported by the kernel.
+    """
+    
+    IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+    # Coarsest directory mtime resolution to expect (FAT uses 2 s steps)
+    MTIME_GRANULARITY = 2.0
+    
+    def __init__(self, db_path: str, validator=None, use_inotify: bool = True, rescan_interval: int = 600):
+        self.db_path = db_path
+        self.validator = validator
+        self.rescan_interval = rescan_interval
+        self.store = SQLiteStore(self.db_path)
+        # Guards the list cache and inotify bookkeeping; the store handles its own locking
+        self.lock = threading.RLock()
+        self._cache = {}
+        self._create_tables()
+        
+        # inotify state: folder -> set of changed names, or None for "rescan everything"
+        self._inotify = None
+        self._watches = {}
+        self._dirty = {}
+        if use_inotify and HAS_INOTIFY:
+            try:
+                self._inotify = INotify()
+                threading.Thread(target=self._watch_loop, daemon=True).start()
+            except Exception as e:
+                print(f"inotify unavailable, falling back to polling: {e}")
+                self._inotify = None
+    
+    def _create_tables(self):
+        self.store.write("""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            folder TEXT,
+            name TEXT,
+            size INTEGER,
+            mtime REAL,
+            valid INTEGER
+        )
+        """)
+        self.store.write("""
+        CREATE TABLE IF NOT EXISTS folders (
+            folder TEXT PRIMARY KEY,
+            mtime REAL,
+            scanned_at REAL
+        )
+        """)
+        self.store.write("CREATE INDEX IF NOT EXISTS idx_files_folder ON files(folder)", wait=True)
+    
+    def _watch(self, folder: str):
+        with self.lock:
+            if self._inotify is None or self._is_watched(folder):
+                return
+            self._add_watch(folder)
+    
+    def _add_watch(self, folder: str):
+        try:
+            mask = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.CLOSE_WRITE |
+                    inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO | inotify_flags.ATTRIB |
+                    inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF)
+            wd = self._inotify.add_watch(folder, mask)
+            self._watches[wd] = folder
+            self._dirty[folder] = None
+        except OSError as e:
+            print(f"Cannot watch {folder}: {e}")
+    
+    def _watch_loop(self):
+        while True:
+            try:
+                events = self._inotify.read()
+            except Exception:
+                return
+            with self.lock:
+                for event in events:
+                    if event.mask & inotify_flags.Q_OVERFLOW:
+                        for folder in self._watches.values():
+                            self._dirty[folder] = None
+                        continue
+                    folder = self._watches.get(event.wd)
+                    if folder is None:
+                        continue
+                    if event.mask & (inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF | inotify_flags.IGNORED):
+                        self._watches.pop(event.wd, None)
+                        self._dirty[folder] = None
+                    elif self._dirty.get(folder, set()) is not None:
+                        self._dirty.setdefault(folder, set()).add(event.name)
+    
+    def _is_watched(self, folder: str) -> bool:
+        return folder in self._watches.values()
+    
+    def _stat_entry(self, path: str):
+        """Return (size, mtime) for a regular file, or None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not S_ISREG(st.st_mode):
+            return None
+        return st.st_size, st.st_mtime
+    
+    def _is_valid(self, path: str) -> int:
+        if not path.lower().endswith(self.IMAGE_EXTENSIONS):
+            return 0
+        if self.validator is None:
+            return 1
+        return 1 if self.validator(path) else 0
+    
+    def _apply(self, folder: str, current: dict, known: dict, full: bool):
+        """Write the difference between current and known {path: (size, mtime)}"""
+        changed = [(path, stat) for path, stat in current.items() if known.get(path) != stat]
+        if full:
+            removed = [path for path in known if path not in current]
+        else:
+            removed = [path for path in known if path not in current or current[path] is None]
+            changed = [(path, stat) for path, stat in changed if stat is not None]
+        
+        if not changed and not removed:
+            return False
+        
+        rows = [(path, folder, os.path.basename(path), stat[0], stat[1], self._is_valid(path))
+                for path, stat in changed]
+        self.store.write("DELETE FROM files WHERE path = ?", [(p,) for p in removed], many=True)
+        self.store.write(
+            "INSERT OR REPLACE INTO files (path, folder, name, size, mtime, valid) VALUES (?, ?, ?, ?, ?, ?)",
+            rows, many=True, wait=True
+        )
+        with self.lock:
+            self._cache.pop(folder, None)
+        return True
+    
+    def refresh(self, folder: str, force: bool = False) -> bool:
+        """Bring the index for one folder up to date; returns True if anything changed"""
+        folder = os.path.abspath(folder)
+        
+        try:
+            folder_mtime = os.stat(folder).st_mtime
+        except OSError:
+            self.store.write("DELETE FROM files WHERE folder = ?", (folder,))
+            self.store.write("DELETE FROM folders WHERE folder = ?", (folder,), wait=True)
+            with self.lock:
+                self._cache.pop(folder, None)
+            return False
+        
+        self._watch(folder)
+        now = time.time()
+        
+        with self.lock:
+            row = self.store.query_one("SELECT mtime, scanned_at FROM folders WHERE folder = ?", (folder,))
+            full_scan = row is None or force or now - (row[1] or 0) > self.rescan_interval
+            
+            if self._is_watched(folder):
+                # None means the watcher lost track and a full scan is needed
+                dirty = self._dirty.pop(folder, set())
+                full_scan = full_scan or dirty is None
+            else:
+                dirty = None
+                # An mtime within one tick of the last scan may hide a change made
+                # just after that scan in the same tick, so only trust older ones
+                settled = (row[1] or 0) - row[0] > self.MTIME_GRANULARITY if row else False
+                if not full_scan and row[0] == folder_mtime and settled:
+                    return False
+                full_scan = True
+            
+            if full_scan:
+                known = {r[0]: (r[1], r[2]) for r in
+                         self.store.query("SELECT path, size, mtime FROM files WHERE folder = ?", (folder,))}
+            else:
+                if not dirty:
+                    return False
+                # The kernel told us exactly which names changed
+                known = {}
+                for name in dirty:
+                    path = os.path.join(folder, name)
+                    r = self.store.query_one("SELECT size, mtime FROM files WHERE path = ?", (path,))
+                    if r:
+                        known[path] = (r[0], r[1])
+        
+        if not full_scan:
+            current = {os.path.join(folder, name): self._stat_entry(os.path.join(folder, name)) for name in dirty}
+            return self._apply(folder, current, known, full=False)
+        
+        current = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        current[entry.path] = (st.st_size, st.st_mtime)
+                except OSError:
+                    continue
+        
+        changed = self._apply(folder, current, known, full=True)
+        self.store.write(
+            "INSERT OR REPLACE INTO folders (folder, mtime, scanned_at) VALUES (?, ?, ?)",
+            (folder, folder_mtime, now), wait=True
+        )
+        return changed
+    
+    def _entries(self, folder: str) -> list:
+        """Cached [(name, path, size, mtime, valid)] for a folder, sorted by name"""
+        folder = os.path.abspath(folder)
+        with self.lock:
+            cache = self._cache.setdefault(folder, {})
+            if 'entries' not in cache:
+                cache['entries'] = self.store.query(
+                    "SELECT name, path, size, mtime, valid FROM files WHERE folder = ? ORDER BY name", (folder,)
+                )
+            return cache['entries']
+    
+    def list_files(self, folder: str, extensions=None, valid_only: bool = True) -> List[str]:
+        """Image paths in a folder, sorted by file name.
+
+        The list is cached until the folder changes; callers must not mutate it.
+        """
+        extensions = tuple(extensions or self.IMAGE_EXTENSIONS)
+        key = (extensions, valid_only)
+        with self.lock:
+            entries = self._entries(folder)
+            cache = self._cache[os.path.abspath(folder)]
+            if key not in cache:
+                cache[key] = [path for name, path, size, mtime, valid in entries
+                              if name.lower().endswith(extensions) and (valid or not valid_only)]
+            return cache[key]
+    
+    def list_entries(self, folder: str, extensions=None) -> List[dict]:
+        """Image file details (path, name, size, modified) for a folder"""
+        extensions = extensions or self.IMAGE_EXTENSIONS
+        return [{'path': path, 'name': name, 'size': size, 'modified': mtime}
+                for name, path, size, mtime, valid in self._entries(folder)
+                if name.lower().endswith(extensions)]
+    
+    def total_size(self, folder: str, skip_suffixes=()) -> int:
+        """Bytes used by every indexed file in a folder, except names ending in skip_suffixes"""
+        skip_suffixes = tuple(skip_suffixes)
+        return sum(entry[2] for entry in self._entries(folder)
+                   if not (skip_suffixes and entry[0].endswith(skip_suffixes)))
+    
+    def cached_validity(self, path: str, size: int, mtime: float):
+        """Stored validation result for path at this size and mtime, or None if unknown"""
+        row = self.store.query_one("SELECT size, mtime, valid FROM files WHERE path = ?", (os.path.abspath(path),))
+        if row is None or row[0] != size or row[1] != mtime:
+            return None
+        return bool(row[2])
+    
+    def remember(self, path: str, size: int, mtime: float, valid: bool):
+        """Record a validation result made outside refresh()"""
+        path = os.path.abspath(path)
+        folder = os.path.dirname(path)
+        self.store.write(
+            "INSERT OR REPLACE INTO files (path, folder, name, size, mtime, valid) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, folder, os.path.basename(path), size, mtime, 1 if valid else 0), wait=True
+        )
+        with self.lock:
+            self._cache.pop(folder, None)
+    
+    def close(self):
+        if self._inotify is not None:
+            try:
+                self._inotify.close()
+            except Exception:
+                pass
+        self.store.close()
+
+# ============================================================================
+# BK-TREE (Hamming distance index)
+# ============================================================================
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two integer hashes"""
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """Burkhard-Keller tree for sublinear "all hashes within distance k" queries"""
+
+    def __init__(self):
+        # Each node is [hash, paths, {distance: child_node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, path: str):
+        if self.root is None:
+            self.root = [value, [path], {}]
+            self.size += 1
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                if path not in node[1]:
+                    node[1].append(path)
+                    self.size += 1
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [path], {}]
+                self.size += 1
+                return
+            node = child
+
+    def remove(self, value: int, path: str) -> bool:
+        """Drop a path; emptied nodes stay in place as routing nodes"""
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                if path in node[1]:
+                    node[1].remove(path)
+                    self.size -= 1
+                    return True
+                return False
+            node = node[2].get(distance)
+        return False
+
+    def query(self, value: int, max_distance: int) -> List[Tuple[int, str]]:
+        """Return (distance, path) for every entry within max_distance of value"""
+        results = []
+        if self.root is None:
+            return results
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, path) for path in node[1])
+            # Triangle inequality: only children in [d - k, d + k] can match
+            low, high = distance - max_distance, distance + max_distance
+            for child_distance, child in node[2].items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+
+        results.sort()
+        return results
+
 # ============================================================================
 # DUPLICATE DETECTOR
 # ============================================================================
 
+def _load_hash_image(img, hash_size: int, fast: bool):
+    """Prepare an opened image for imagehash.phash.
+
+    The fast path asks the decoder for a reduced grayscale image (JPEG scales
+    by 1/2..1/8 in the DCT domain) and box-reduces other formats before any
+    colour conversion, instead of decoding an 8K wallpaper at full size.
+    """
+    if not fast:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        # Resize very large images before hashing for performance
+        if img.width > 2000 or img.height > 2000:
+            img.thumbnail((2000, 2000))
+        return img
+
+    # phash resamples to (hash_size * 4) squared; keep ~8x that for a clean downscale
+    target = hash_size * 32
+    img.draft('L', (target, target))
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert('RGB')
+    factor = min(img.width, img.height) // target
+    if factor > 1:
+        img = img.reduce(factor)
+    return img.convert('L')
+
+PARTIAL_HASH_BYTES = 64 * 1024
+
+def file_digest(path: str, limit: int = None) -> str:
+    """SHA-256 hex digest of a file, or of only its first limit bytes"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            if limit:
+                digest.update(f.read(limit))
+            else:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+    except OSError as e:
+        print(f"Error reading {path}: {e}")
+        return None
+    return digest.hexdigest()
+
+# Wallhaven's thumbs.small is a 300x200 centre crop of the original
+THUMBNAIL_RATIO = 3 / 2
+
+def _crop_to_ratio(img, ratio: float):
+    """Centre-crop an image to the given width/height ratio"""
+    width, height = img.size
+    if width / height > ratio:
+        new_width = max(1, int(round(height * ratio)))
+        left = (width - new_width) // 2
+        return img.crop((left, 0, left + new_width, height))
+    new_height = max(1, int(round(width / ratio)))
+    top = (height - new_height) // 2
+    return img.crop((0, top, width, top + new_height))
+
+def thumbnail_phash(img, hash_size: int = 8) -> str:
+    """phash of the 3:2 centre crop, comparable between a full image and its Wallhaven thumbnail"""
+    return str(imagehash.phash(_crop_to_ratio(img, THUMBNAIL_RATIO), hash_size=hash_size))
+
+def compute_image_record(image_path: str, hash_size: int = 8, fast: bool = True) -> tuple:
+    """Return (path, phash, file_size, width, height, thumb_phash) from a single decode.
+
+    Module level so it can run inside a ProcessPoolExecutor worker.
+    phash is None when the image cannot be read.
+    """
+    try:
+        Image.MAX_IMAGE_PIXELS = None
+        file_size = os.path.getsize(image_path)
+
+        with Image.open(image_path) as img:
+            # Record the real size before draft() shrinks the decode
+            width, height = img.width, img.height
+            hash_img = _load_hash_image(img, hash_size, fast)
+            phash = str(imagehash.phash(hash_img, hash_size=hash_size))
+            thumb_phash = thumbnail_phash(hash_img, hash_size)
+
+        return image_path, phash, file_size, width, height, thumb_phash
+    except Exception as e:
+        print(f"Error generating hash for {image_path}: {e}")
+        return image_path, None, 0, 0, 0, None
+
 class DuplicateDetector:
-    """Detect duplicate images using perceptual hashing"""
-    
-    def __init__(self, db_path: str, enabled: bool = True, hash_size: int = 8):
+    """Detect duplicate and near-duplicate images using perceptual hashing"""
+
+    def __init__(self, db_path: str, enabled: bool = True, hash_size: int = 8,
+                 similarity_threshold: float = 0.9, fast_hash: bool = True):
         self.db_path = db_path
         self.enabled = enabled
         self.hash_size = hash_size
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.similarity_threshold = similarity_threshold
+        self.fast_hash = fast_hash
+        self.store = SQLiteStore(self.db_path)
+        # Guards the in-memory BK-trees; database access goes through the store
         self.lock = threading.Lock()
+        # One BK-tree per hash bit length, so changing hash_size never mixes widths
+        self.trees = {}
+        self.path_hashes = {}
+        # Same layout for the thumbnail-normalized hashes
+        self.thumb_trees = {}
+        self.path_thumb_hashes = {}
         self._create_tables()
+        self._load_index()
     
     def _create_tables(self):
+        self.store.write("""
+        CREATE TABLE IF NOT EXISTS image_hashes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT UNIQUE,
+            phash TEXT,
+            file_size INTEGER,
+            width INTEGER,
+            height INTEGER,
+            created_at TEXT
+        )
+        """, wait=True)
+        # Exact-content tier, filled lazily (fdupes style: size, then partial, then full hash)
+        columns = [row[1] for row in self.store.query("PRAGMA table_info(image_hashes)")]
+        if 'content_hash' not in columns:
+            self.store.write("ALTER TABLE image_hashes ADD COLUMN content_hash TEXT")
+        if 'partial_hash' not in columns:
+            self.store.write("ALTER TABLE image_hashes ADD COLUMN partial_hash TEXT")
+        # Hash of the 3:2 centre crop, matched against Wallhaven thumbnails before downloading
+        if 'thumb_phash' not in columns:
+            self.store.write("ALTER TABLE image_hashes ADD COLUMN thumb_phash TEXT")
+        self.store.write("CREATE INDEX IF NOT EXISTS idx_phash ON image_hashes(phash)")
+        self.store.write("CREATE INDEX IF NOT EXISTS idx_content_hash ON image_hashes(content_hash)")
+        self.store.write("CREATE INDEX IF NOT EXISTS idx_file_size ON image_hashes(file_size)", wait=True)
+
+    def _load_index(self):
+        """Build the in-memory BK-trees from the stored hashes"""
+        rows = self.store.query("SELECT path, phash, thumb_phash FROM image_hashes WHERE phash != ''")
         with self.lock:
-            self.conn.execute("""
-            CREATE TABLE IF NOT EXISTS image_hashes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                path TEXT UNIQUE,
-                phash TEXT,
-                file_size INTEGER,
-                width INTEGER,
-                height INTEGER,
-                created_at TEXT
-            )
-            """)
-            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_phash ON image_hashes(phash)")
-            self.conn.commit()
+            for path, phash, thumb_phash in rows:
+                self._add_to_index(path, phash, thumb_phash)
+
+    @staticmethod
+    def _hash_to_int(phash: str) -> Tuple[int, int]:
+        """Convert a hex hash to (bit_length, integer value)"""
+        return len(phash) * 4, int(phash, 16)
+
+    def max_distance(self, bits: int) -> int:
+        """Largest Hamming distance still counted as a duplicate for this hash width"""
+        return int(round((1.0 - self.similarity_threshold) * bits))
+
+    def _add_to_index(self, path: str, phash: str, thumb_phash: str = None):
+        if not phash:
+            return
+        bits, value = self._hash_to_int(phash)
+        self.trees.setdefault(bits, BKTree()).add(value, path)
+        self.path_hashes[path] = phash
+        if thumb_phash:
+            self._add_thumbnail_to_index(path, thumb_phash)
+    
+    def _add_thumbnail_to_index(self, path: str, thumb_phash: str):
+        bits, value = self._hash_to_int(thumb_phash)
+        self.thumb_trees.setdefault(bits, BKTree()).add(value, path)
+        self.path_thumb_hashes[path] = thumb_phash
+
+    def _remove_from_index(self, path: str):
+        for trees, hashes in ((self.trees, self.path_hashes), (self.thumb_trees, self.path_thumb_hashes)):
+            phash = hashes.pop(path, None)
+            if phash:
+                bits, value = self._hash_to_int(phash)
+                if bits in trees:
+                    trees[bits].remove(value, path)
+
+    def find_similar(self, phash: str, max_distance: int = None) -> List[Tuple[int, str]]:
+        """Return (distance, path) for indexed images within max_distance of phash"""
+        if not phash:
+            return []
+
+        bits, value = self._hash_to_int(phash)
+        if max_distance is None:
+            max_distance = self.max_distance(bits)
+
+        with self.lock:
+            tree = self.trees.get(bits)
+            if tree is None:
+                return []
+            return tree.query(value, max_distance)
+    
+    def find_similar_thumbnail(self, thumb_phash: str, max_distance: int = None) -> List[Tuple[int, str]]:
+        """Like find_similar, against the thumbnail-normalized hashes"""
+        if not thumb_phash:
+            return []
+    
+        bits, value = self._hash_to_int(thumb_phash)
+        if max_distance is None:
+            max_distance = self.max_distance(bits)
+    
+        with self.lock:
+            tree = self.thumb_trees.get(bits)
+            if tree is None:
+                return []
+            return tree.query(value, max_distance)
+    
+    def check_thumbnail(self, data: bytes) -> Tuple[bool, str]:
+        """Check downloaded thumbnail bytes against the index; returns (is_duplicate, existing_path)"""
+        if not self.enabled:
+            return False, ""
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                thumb_phash = thumbnail_phash(img.convert('L'), self.hash_size)
+        except Exception as e:
+            print(f"Error hashing thumbnail: {e}")
+            return False, ""
     
+        matches = self.find_similar_thumbnail(thumb_phash)
+        if matches:
+            return True, matches[0][1]
+        return False, ""
+
+    def remove_image(self, image_path: str):
+        """Forget an image that was deleted from disk"""
+        with self.lock:
+            self._remove_from_index(image_path)
+        self.store.write("DELETE FROM image_hashes WHERE path = ?", (image_path,))
+
     def get_image_hash(self, image_path: str) -> str:
         """Generate perceptual hash for an image"""
         if not self.enabled:
             return None
         
-        try:
-            # Temporarily increase the limit for this operation
-            original_limit = Image.MAX_IMAGE_PIXELS
-            Image.MAX_IMAGE_PIXELS = None
-            
-            with Image.open(image_path) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                # Resize very large images before hashing for performance
-                if img.width > 2000 or img.height > 2000:
-                    img.thumbnail((2000, 2000))
-                result = str(imagehash.phash(img, hash_size=self.hash_size))
-            
-            # Restore original limit
-            Image.MAX_IMAGE_PIXELS = original_limit
-            return result
-        except Exception as e:
-            print(f"Error generating hash: {e}")
+        return compute_image_record(image_path, self.hash_size, self.fast_hash)[1]
+    
+    def _store_records(self, records: list, wait: bool = False):
+        """Insert (path, phash, file_size, width, height, thumb_phash[, content_hash]) rows in one transaction"""
+        now = datetime.now().isoformat()
+        rows = [(r[0], r[1], r[2], r[3], r[4], r[5], r[6] if len(r) > 6 else None, now) for r in records]
+        with self.lock:
+            for row in rows:
+                self._add_to_index(row[0], row[1], row[5])
+        self.store.write(
+            "INSERT OR IGNORE INTO image_hashes (path, phash, file_size, width, height, thumb_phash, content_hash, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows, many=True, wait=wait
+        )
+    
+    def _stored_digest(self, path: str, column: str) -> str:
+        """Return a row's partial_hash/content_hash, computing and saving it on first use"""
+        row = self.store.query_one(f"SELECT {column} FROM image_hashes WHERE path = ?", (path,))
+        if row and row[0]:
+            return row[0]
+        
+        limit = PARTIAL_HASH_BYTES if column == "partial_hash" else None
+        digest = file_digest(path, limit)
+        if digest:
+            # Wait so a following read of this row (e.g. _copy_record) sees the digest
+            self.store.write(f"UPDATE image_hashes SET {column} = ? WHERE path = ?", (digest, path), wait=True)
+        return digest
+    
+    def find_exact(self, image_path: str, file_size: int = None, content_hash: str = None) -> str:
+        """Return an indexed file byte-identical to image_path, or None.
+
+        Never decodes: candidates are narrowed by size, then by a hash of the
+        first 64 KiB, and only then compared by full SHA-256. Pass content_hash
+        when it is already known (e.g. computed while downloading).
+        """
+        if file_size is None:
+            file_size = os.path.getsize(image_path)
+        
+        candidates = [row[0] for row in self.store.query(
+            "SELECT path FROM image_hashes WHERE file_size = ? AND path != ?", (file_size, image_path)
+        )]
+        if not candidates:
+            return None
+        
+        if content_hash is None:
+            partial = file_digest(image_path, PARTIAL_HASH_BYTES)
+            candidates = [c for c in candidates if self._stored_digest(c, "partial_hash") == partial]
+            if not candidates:
+                return None
+            content_hash = file_digest(image_path)
+        
+        for candidate in candidates:
+            if self._stored_digest(candidate, "content_hash") == content_hash:
+                return candidate
+        return None
+    
+    def _copy_record(self, image_path: str, source_path: str, content_hash: str = None) -> tuple:
+        """Build a record for a byte-identical copy from the already indexed source"""
+        row = self.store.query_one(
+            "SELECT phash, file_size, width, height, thumb_phash, content_hash FROM image_hashes WHERE path = ?",
+            (source_path,)
+        )
+        if not row:
             return None
+        return (image_path, row[0], row[1], row[2], row[3], row[4], content_hash or row[5])
+    
+    def analyze(self, image_path: str) -> tuple:
+        """Decode an image once and return its (path, phash, file_size, width, height, thumb_phash) record.
+
+        A record with phash None means the image could not be decoded, which
+        doubles as validation for freshly downloaded files.
+        """
+        return compute_image_record(image_path, self.hash_size, self.fast_hash)
     
-    def index_image(self, image_path: str) -> bool:
-        """Index an image by storing its hash"""
+    def index_image(self, image_path: str, record: tuple = None, content_hash: str = None) -> bool:
+        """Index an image by storing its hash.
+
+        Pass the record from analyze() (possibly taken from a temp file before
+        it was renamed) to skip decoding the image again, and content_hash
+        when the SHA-256 is already known.
+        """
         if not self.enabled or not os.path.exists(image_path):
             return False
         
-        cursor = self.conn.execute("SELECT path FROM image_hashes WHERE path = ?", (image_path,))
-        if cursor.fetchone():
+        if self.store.query_one("SELECT path FROM image_hashes WHERE path = ?", (image_path,)):
             return True
         
         try:
-            phash = self.get_image_hash(image_path)
-            if not phash:
+            if record is None:
+                record = self.analyze(image_path)
+            record = (image_path,) + tuple(record[1:6]) + (content_hash,)
+            if not record[1]:
                 return False
             
-            with Image.open(image_path) as img:
-                width, height = img.width, img.height
-            
-            file_size = os.path.getsize(image_path)
-            
-            with self.lock:
-                self.conn.execute(
-                    "INSERT INTO image_hashes (path, phash, file_size, width, height, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                    (image_path, phash, file_size, width, height, datetime.now().isoformat())
-                )
-                self.conn.commit()
+            self._store_records([record], wait=True)
             return True
         except Exception as e:
             print(f"Error indexing {image_path}: {e}")
             return False
-    
+
     def find_duplicates(self) -> List[Tuple[str, str]]:
-        """Find duplicate images using database grouping (optimized for large collections)"""
+        """Find near-duplicate pairs with one BK-tree query per indexed image"""
         if not self.enabled:
             return []
-        
+
         duplicates = []
-        
-        # Use database grouping to find duplicates - much more efficient for large collections
-        cursor = self.conn.execute("""
-            SELECT phash, GROUP_CONCAT(path) as paths 
-            FROM image_hashes 
-            WHERE phash != '' 
-            GROUP BY phash 
-            HAVING COUNT(*) > 1
-        """)
-        
-        for row in cursor.fetchall():
-            paths = row[1].split(',')
-            for i in range(len(paths)):
-                for j in range(i+1, len(paths)):
-                    duplicates.append((paths[i], paths[j]))
-        
+
+        with self.lock:
+            indexed = list(self.path_hashes.items())
+
+        for path, phash in indexed:
+            for distance, other in self.find_similar(phash):
+                # Each pair is reported once, from its lexicographically smaller side
+                if other > path:
+                    duplicates.append((path, other))
+
         return duplicates
-    
+
     def cleanup_duplicates(self, keep_newest: bool = True) -> int:
-        """Remove duplicate images"""
+        """Remove near-duplicate images, keeping one file per cluster"""
         if not self.enabled:
             return 0
-        
+
         deleted = 0
-        
-        # Use database grouping for efficiency
-        cursor = self.conn.execute("""
-            SELECT phash, GROUP_CONCAT(path || '|' || COALESCE(created_at, '')) as paths 
-            FROM image_hashes 
-            WHERE phash != '' 
-            GROUP BY phash 
-            HAVING COUNT(*) > 1
-        """)
-        
-        for row in cursor.fetchall():
-            # Parse paths with creation times
-            items = []
-            for item in row[1].split(','):
-                if '|' in item:
-                    path, created = item.split('|', 1)
-                    items.append((path, created))
-                else:
-                    items.append((item, ''))
-            
-            if keep_newest:
-                items.sort(key=lambda x: x[1] if x[1] else '', reverse=True)
-            else:
-                items.sort(key=lambda x: x[1] if x[1] else '')
-            
-            kept = items[0][0]
-            for path, _ in items[1:]:
-                if os.path.exists(path):
-                    try:
-                        os.remove(path)
-                        deleted += 1
-                        self.conn.execute("DELETE FROM image_hashes WHERE path = ?", (path,))
-                    except:
-                        pass
-        
-        self.conn.commit()
+
+        items = self.store.query("SELECT path, phash, COALESCE(created_at, '') FROM image_hashes WHERE phash != ''")
+
+        # Visit images in keep-preference order; each kept image claims its neighbours
+        items.sort(key=lambda x: x[2], reverse=keep_newest)
+        kept = set()
+        doomed = set()
+
+        for path, phash, _ in items:
+            if path in doomed:
+                continue
+            kept.add(path)
+            for distance, other in self.find_similar(phash):
+                if other not in kept:
+                    doomed.add(other)
+
+        for path in doomed:
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                    deleted += 1
+                except:
+                    continue
+            self.remove_image(path)
+
         return deleted
     
-    def scan_folder(self, folder_path: str, progress_callback=None, stop_event=None) -> Tuple[int, int]:
-        """Scan a folder and index all images with ability to stop"""
+    def scan_folder(self, folder_path: str, progress_callback=None, stop_event=None,
+                    workers: int = None, batch_size: int = 200) -> Tuple[int, int]:
+        """Scan a folder and index all images with ability to stop.
+
+        New files are hashed on a process pool (workers=None uses every core,
+        workers=1 hashes in this thread) and written back in batches.
+        """
         if not self.enabled:
             return 0, 0
         
         supported = (".jpg", ".jpeg", ".png", ".gif", ".webp")
         indexed = 0
-        existing = 0
         
-        for file in os.listdir(folder_path):
-            # Check if we should stop
-            if stop_event and stop_event.is_set():
-                break
+        self.backfill_thumbnail_hashes(stop_event, workers)
+        known = {row[0] for row in self.store.query("SELECT path FROM image_hashes")}
+        
+        candidates = [os.path.join(folder_path, f) for f in os.listdir(folder_path)
+                      if f.lower().endswith(supported)]
+        pending = [p for p in candidates if p not in known]
+        existing = len(candidates) - len(pending)
+        
+        if not pending:
+            return 0, existing
+        
+        # Exact-copy tier: byte-identical files reuse a record instead of being decoded
+        copies_of_indexed, copies_of_pending, pending = self._split_exact_copies(pending)
+        copy_records = [self._copy_record(path, source) for path, source in copies_of_indexed.items()]
+        copy_records = [r for r in copy_records if r and r[1]]
+        self._store_records(copy_records)
+        indexed = len(copy_records)
+        
+        workers = workers or os.cpu_count() or 1
+        batch = []
+        leader_records = {}
+        
+        def flush():
+            nonlocal indexed
+            if batch:
+                for record in batch:
+                    leader_records[record[0]] = record
+                self._store_records(batch)
+                indexed += len(batch)
+                batch.clear()
+                if progress_callback:
+                    # Call in main thread if needed
+                    if threading.current_thread() is threading.main_thread():
+                        progress_callback(f"Indexed: {indexed}", indexed)
+        
+        if workers <= 1 or len(pending) == 1:
+            for path in pending:
+                if stop_event and stop_event.is_set():
+                    break
+                record = compute_image_record(path, self.hash_size, self.fast_hash)
+                if record[1]:
+                    batch.append(record)
+                if len(batch) >= batch_size:
+                    flush()
+            flush()
+            self._store_pending_copies(copies_of_pending, leader_records)
+            indexed += sum(1 for leader in copies_of_pending.values() if leader in leader_records)
+            return indexed, existing
+        
+        # Keep a bounded window of work in flight so a stop request takes effect quickly
+        window = workers * 4
+        paths = iter(pending)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            in_flight = set()
+            while True:
+                while len(in_flight) < window and not (stop_event and stop_event.is_set()):
+                    path = next(paths, None)
+                    if path is None:
+                        break
+                    in_flight.add(pool.submit(compute_image_record, path, self.hash_size, self.fast_hash))
                 
-            if file.lower().endswith(supported):
-                full_path = os.path.join(folder_path, file)
-                cursor = self.conn.execute("SELECT path FROM image_hashes WHERE path = ?", (full_path,))
-                if cursor.fetchone():
-                    existing += 1
-                else:
-                    if self.index_image(full_path):
-                        indexed += 1
-                        if progress_callback:
-                            # Call in main thread if needed
-                            if threading.current_thread() is threading.main_thread():
-                                progress_callback(f"Indexed: {file}", indexed)
-                            else:
-                                # For thread safety, we'll let the caller handle UI updates
-                                pass
-        
+                if not in_flight:
+                    break
+                
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record = future.result()
+                    if record[1]:
+                        batch.append(record)
+                if len(batch) >= batch_size:
+                    flush()
+            flush()
+        
+        self._store_pending_copies(copies_of_pending, leader_records)
+        indexed += sum(1 for leader in copies_of_pending.values() if leader in leader_records)
         return indexed, existing
     
-    def check_before_download(self, temp_path: str) -> Tuple[bool, str]:
-        """Check if image is duplicate before downloading"""
-        if not self.enabled:
-            return False, ""
-        
-        phash = self.get_image_hash(temp_path)
-        if not phash:
-            return False, ""
+    def backfill_thumbnail_hashes(self, stop_event=None, workers: int = None, batch_size: int = 200) -> int:
+        """Compute thumb_phash for images indexed before thumbnail hashes existed"""
+        paths = [row[0] for row in self.store.query(
+            "SELECT path FROM image_hashes WHERE thumb_phash IS NULL AND phash != ''"
+        ) if os.path.exists(row[0])]
+        if not paths:
+            return 0
         
-        cursor = self.conn.execute("SELECT path FROM image_hashes WHERE phash = ?", (phash,))
-        result = cursor.fetchone()
-        if result:
-            return True, result[0]
-        return False, ""
-    
-    def get_stats(self) -> dict:
-        """Get statistics using efficient database queries"""
-        cursor = self.conn.execute("SELECT COUNT(*) FROM image_hashes")
-        total = cursor.fetchone()[0]
+        workers = workers or os.cpu_count() or 1
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(paths) > 1 else None
+        updated = 0
+        try:
+            for start in range(0, len(paths), batch_size):
+                if stop_event and stop_event.is_set():
+                    break
+                chunk = paths[start:start + batch_size]
+                if pool:
+                    records = pool.map(compute_image_record, chunk, [self.hash_size] * len(chunk),
+                                       [self.fast_hash] * len(chunk))
+                else:
+                    records = (compute_image_record(path, self.hash_size, self.fast_hash) for path in chunk)
+                rows = [(record[5], record[0]) for record in records if record[5]]
+                with self.lock:
+                    for thumb_phash, path in rows:
+                        self._add_thumbnail_to_index(path, thumb_phash)
+                self.store.write("UPDATE image_hashes SET thumb_phash = ? WHERE path = ?", rows, many=True)
+                updated += len(rows)
+        finally:
+            if pool:
+                pool.shutdown()
+        return updated
+    
+    def _split_exact_copies(self, paths: List[str]):
+        """Partition new files into copies of indexed files, copies of each other, and the rest.
+
+        Returns ({copy: indexed_source}, {copy: pending_leader}, paths_to_decode).
+        """
+        sizes = {}
+        for path in paths:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                continue
+        
+        known_sizes = {row[0] for row in self.store.query("SELECT DISTINCT file_size FROM image_hashes")}
+        
+        copies_of_indexed = {}
+        for path, size in sizes.items():
+            if size in known_sizes:
+                source = self.find_exact(path, size)
+                if source:
+                    copies_of_indexed[path] = source
+        
+        # Among the remaining new files: same size -> same first 64 KiB -> same SHA-256
+        by_size = {}
+        for path, size in sizes.items():
+            if path not in copies_of_indexed:
+                by_size.setdefault(size, []).append(path)
+        
+        copies_of_pending = {}
+        for group in by_size.values():
+            if len(group) < 2:
+                continue
+            by_partial = {}
+            for path in group:
+                by_partial.setdefault(file_digest(path, PARTIAL_HASH_BYTES), []).append(path)
+            for partial_group in by_partial.values():
+                if len(partial_group) < 2:
+                    continue
+                leaders = {}
+                for path in partial_group:
+                    digest = file_digest(path)
+                    if digest in leaders:
+                        copies_of_pending[path] = leaders[digest]
+                    else:
+                        leaders[digest] = path
+        
+        to_decode = [p for p in sizes if p not in copies_of_indexed and p not in copies_of_pending]
+        return copies_of_indexed, copies_of_pending, to_decode
+    
+    def _store_pending_copies(self, copies: dict, leader_records: dict):
+        records = []
+        for path, leader in copies.items():
+            record = leader_records.get(leader)
+            if record:
+                records.append((path,) + tuple(record[1:6]))
+        if records:
+            self._store_records(records)
+    
+    def compare_hash_modes(self, paths: List[str] = None, sample: int = 100) -> dict:
+        """Hash a sample with both the fast and full-decode paths and report divergence"""
+        if paths is None:
+            paths = [row[0] for row in self.store.query("SELECT path FROM image_hashes")]
+        paths = [p for p in paths if os.path.exists(p)]
+        if len(paths) > sample:
+            paths = random.sample(paths, sample)
+
+        distances = []
+        fast_time = full_time = 0.0
+        for path in paths:
+            start = time.perf_counter()
+            full = compute_image_record(path, self.hash_size, fast=False)[1]
+            full_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            fast = compute_image_record(path, self.hash_size, fast=True)[1]
+            fast_time += time.perf_counter() - start
+
+            if full and fast:
+                distances.append(hamming_distance(int(full, 16), int(fast, 16)))
+
+        bits = self.hash_size * self.hash_size
+        count = len(distances)
+        return {
+            "images": count,
+            "mean_distance": sum(distances) / count if count else 0.0,
+            "max_distance": max(distances) if count else 0,
+            "within_threshold": sum(1 for d in distances if d <= self.max_distance(bits)),
+            "full_ms_per_image": 1000 * full_time / max(len(paths), 1),
+            "fast_ms_per_image": 1000 * fast_time / max(len(paths), 1)
+        }
+    
+    def check_before_download(self, temp_path: str, record: tuple = None, content_hash: str = None,
+                              exact_checked: bool = False) -> Tuple[bool, str]:
+        """Check if image is duplicate before downloading.
+
+        Byte-identical files are caught by find_exact() without decoding;
+        only files that survive it are perceptually hashed. Pass
+        exact_checked=True when the caller already ran find_exact().
+        """
+        if not self.enabled:
+            return False, ""
         
-        cursor = self.conn.execute("SELECT COUNT(DISTINCT phash) FROM image_hashes")
-        unique = cursor.fetchone()[0]
+        if not exact_checked:
+            existing = self.find_exact(temp_path, content_hash=content_hash)
+            if existing:
+                return True, existing
         
-        cursor = self.conn.execute("""
+        phash = record[1] if record else self.get_image_hash(temp_path)
+        if not phash:
+            return False, ""
+        
+        matches = self.find_similar(phash)
+        if matches:
+            return True, matches[0][1]
+        return False, ""
+    
+    @staticmethod
+    def group_duplicates(pairs: List[Tuple[str, str]]) -> List[List[str]]:
+        """Merge find_duplicates() pairs into groups of mutually near-duplicate paths"""
+        parent = {}
+        
+        def root(path):
+            parent.setdefault(path, path)
+            while parent[path] != path:
+                parent[path] = parent[parent[path]]
+                path = parent[path]
+            return path
+        
+        for path, other in pairs:
+            parent[root(path)] = root(other)
+        
+        groups = {}
+        for path in parent:
+            groups.setdefault(root(path), []).append(path)
+        return list(groups.values())
+    
+    def get_stats(self) -> dict:
+        """Get statistics using efficient database queries.
+
+        Groups here are exact hash matches; near-duplicate groups need the
+        all-pairs search, so callers compute them on demand with
+        find_duplicates() and group_duplicates() off the UI thread.
+        """
+        total = self.store.query_one("SELECT COUNT(*) FROM image_hashes")[0]
+        
+        unique = self.store.query_one("SELECT COUNT(DISTINCT phash) FROM image_hashes")[0]
+        
+        duplicate_groups = self.store.query_one("""
             SELECT COUNT(*) FROM (
                 SELECT phash FROM image_hashes GROUP BY phash HAVING COUNT(*) > 1
             )
-        """)
-        duplicate_groups = cursor.fetchone()[0]
+        """)[0]
         
         return {
             "enabled": self.enabled,
@@ -560,7 +1657,740 @@ class DuplicateDetector:
         }
     
     def close(self):
-        self.conn.close()
+        self.store.close()
+
+# ============================================================================
+# HTTP TRANSPORT
+# ============================================================================
+
+class SlidingWindowLimiter:
+    """Allow at most max_requests in any window-second span, across all threads.
+
+    pause() blocks every caller until a deadline, which is how a server's
+    Retry-After is applied to requests that have not been sent yet.
+    """
+    
+    def __init__(self, max_requests=45, window=60.0):
+        self.max_requests = max_requests
+        self.window = window
+        self.sent = deque()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+    
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+    
+    def acquire(self, stop_event=None):
+        """Block until a request may be sent; returns False if stop_event was set"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.sent and now - self.sent[0] >= self.window:
+                    self.sent.popleft()
+                if now >= self.blocked_until and len(self.sent) < self.max_requests:
+                    self.sent.append(now)
+                    return True
+                delay = max(self.blocked_until - now,
+                            self.sent[0] + self.window - now if len(self.sent) >= self.max_requests else 0)
+            if stop_event is not None:
+                if stop_event.wait(delay):
+                    return False
+            else:
+                time.sleep(delay)
+
+class HttpTransport:
+    """requests.Session wrapper with pool sizing, default timeouts and retries.
+
+    Connection errors, 429 and 5xx responses are retried with exponential
+    backoff and full jitter. A Retry-After header takes precedence over the
+    computed delay and, when a limiter is passed, pauses everyone sharing it.
+    get() has the same shape as Session.get, so a transport can be handed to
+    download_to_temp in place of a session.
+    """
+    
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    
+    def __init__(self, pool_size=10, timeout=30, max_retries=4, backoff=1.0, max_backoff=60.0, headers=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.headers = {"User-Agent": "Wallhaven-Changer/1.0", **(headers or {})}
+        self._session = None
+        self._session_lock = threading.Lock()
+    
+    @property
+    def session(self):
+        """The pooled requests.Session, created (and requests imported) on first use"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                            pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    session.headers.update(self.headers)
+                    self._session = session
+        return self._session
+    
+    @staticmethod
+    def retry_after(response):
+        """Seconds requested by a Retry-After header, or None"""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        from email.utils import parsedate_to_datetime
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+    
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+    
+    def get(self, url, limiter=None, stop_event=None, **kwargs):
+        """GET with retries; returns the last response, or raises the last connection error"""
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if limiter is not None and not limiter.acquire(stop_event):
+                raise requests.ConnectionError("Request cancelled")
+            
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._delay(attempt)
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                wait_for = self.retry_after(response)
+                delay = min(self.max_backoff, wait_for) if wait_for is not None else self._delay(attempt)
+                if response.status_code == 429 and limiter is not None:
+                    limiter.pause(delay)
+                response.close()
+            
+            attempt += 1
+            if stop_event is not None:
+                if stop_event.wait(delay):
+                    raise requests.ConnectionError("Request cancelled")
+            else:
+                time.sleep(delay)
+
+# ============================================================================
+# STREAMING DOWNLOADS
+# ============================================================================
+
+# Small reads keep an interruption from losing much; writes are still buffered
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# The part file is flushed and its journal updated every this many bytes
+JOURNAL_INTERVAL = 1024 * 1024
+# A stream that breaks mid-transfer is continued with a Range request this many times
+STREAM_RETRIES = 3
+
+class QuotaExceededError(Exception):
+    """A download was refused because it would not fit in the disk quota"""
+
+class DownloadInterrupted(Exception):
+    """A transfer was stopped on request; its .part file is kept for resuming"""
+
+class PartialDownload:
+    """A resumable .part file in the destination folder plus a JSON journal.
+
+    The part file name is derived from the URL, so a later attempt at the
+    same URL finds it. The journal records the URL, the validator (strong
+    ETag or Last-Modified) used for If-Range, the expected total length and
+    the last offset written. If another transfer of the same URL is already
+    running, this one gets a private non-resumable temp file instead.
+    """
+    
+    JOURNAL_SUFFIX = ".json"
+    # Part files, journals and journals being rewritten
+    FILE_SUFFIXES = (".part", ".part.json", ".part.json.tmp")
+    _active = set()
+    _active_lock = threading.Lock()
+    
+    def __init__(self, folder, url):
+        self.url = url
+        self.validator = None
+        self.length = 0
+        self.offset = 0
+        path = os.path.join(folder, f".{hashlib.sha1(url.encode()).hexdigest()[:20]}.part")
+        with self._active_lock:
+            self.resumable = path not in self._active
+            if self.resumable:
+                self._active.add(path)
+        if self.resumable:
+            self.path = path
+        else:
+            fd, self.path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.part')
+            os.close(fd)
+            with self._active_lock:
+                self._active.add(self.path)
+        self.journal_path = self.path + self.JOURNAL_SUFFIX
+    
+    def resume_headers(self):
+        """Range/If-Range headers for continuing an earlier attempt, or {}"""
+        if not self.resumable:
+            return {}
+        try:
+            with open(self.journal_path, 'r') as f:
+                journal = json.load(f)
+            self.offset = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            journal = None
+        
+        if not journal or journal.get('url') != self.url or not journal.get('validator') or not self.offset:
+            self.offset = 0
+            return {}
+        self.validator = journal['validator']
+        self.length = journal.get('length', 0)
+        return {"Range": f"bytes={self.offset}-", "If-Range": self.validator}
+    
+    def start(self, status, headers):
+        """Adopt a response; returns True if it continues the existing part file"""
+        content_range = headers.get('Content-Range', '')
+        resumed = (status == 206 and self.offset > 0
+                   and content_range.startswith(f"bytes {self.offset}-"))
+        if resumed:
+            total = content_range.rsplit('/', 1)[-1]
+            self.length = int(total) if total.isdigit() else self.length
+        else:
+            self.offset = 0
+            self.length = int(headers.get('Content-Length') or 0)
+        
+        etag = headers.get('ETag')
+        self.validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+        self.save()
+        return resumed
+    
+    def retry_headers(self, offset):
+        """Range/If-Range headers to continue this transfer from offset, or {} to start over"""
+        self.offset = offset if self.validator else 0
+        if not self.offset:
+            return {}
+        return {"Range": f"bytes={self.offset}-", "If-Range": self.validator}
+    
+    def written(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+    
+    def prefix_digest(self):
+        """SHA-256 state over the bytes already on disk"""
+        digest = hashlib.sha256()
+        if self.offset:
+            with open(self.path, 'rb') as f:
+                remaining = self.offset
+                while remaining:
+                    chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+        return digest
+    
+    def save(self, offset=None):
+        if not self.resumable or not self.validator:
+            return
+        if offset is not None:
+            self.offset = offset
+        temp = self.journal_path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'url': self.url, 'validator': self.validator, 'length': self.length,
+                       'offset': self.offset}, f)
+        os.replace(temp, self.journal_path)
+    
+    def finish(self, size):
+        """Validate the completed file, drop the journal and move it to a private name.
+
+        The rename keeps a later transfer of the same URL from reopening the
+        file before the caller has committed it.
+        """
+        if self.length and size != self.length:
+            self.discard()
+            raise IOError(f"Incomplete download: {size} of {self.length} bytes")
+        self._remove(self.journal_path)
+        if self.resumable:
+            fd, done_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.', suffix='.part')
+            os.close(fd)
+            os.replace(self.path, done_path)
+            self.release()
+            self.path = done_path
+        else:
+            self.release()
+    
+    def release(self):
+        with self._active_lock:
+            self._active.discard(self.path)
+    
+    def discard(self):
+        self._remove(self.path)
+        self._remove(self.journal_path)
+        self.release()
+    
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def clean_partial_downloads(folder, max_age_days=7, grace_seconds=3600):
+    """Remove .part files that cannot be resumed, and resumable ones older than max_age_days.
+
+    Files an active transfer in this process owns are never touched, and
+    unresumable ones are only removed once untouched for grace_seconds, since
+    a finished transfer's file waits under a private .part name until its
+    caller commits it. Safe to run while downloads are in progress.
+
+    Returns the number of files removed.
+    """
+    if not os.path.isdir(folder):
+        return 0
+    now = time.time()
+    cutoff = now - max_age_days * 86400
+    names = set(os.listdir(folder))
+    with PartialDownload._active_lock:
+        active = {os.path.abspath(p) for p in PartialDownload._active}
+    removed = 0
+    for name in names:
+        path = os.path.join(folder, name)
+        if name.endswith('.part'):
+            if os.path.abspath(path) in active:
+                continue
+            has_journal = name + PartialDownload.JOURNAL_SUFFIX in names
+            try:
+                mtime = os.path.getmtime(path)
+                if mtime >= (cutoff if has_journal else now - grace_seconds):
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        elif name.endswith('.part' + PartialDownload.JOURNAL_SUFFIX) and name[:-len(PartialDownload.JOURNAL_SUFFIX)] not in names:
+            PartialDownload._remove(path)
+    if removed:
+        print(f"Removed {removed} stale partial downloads from {folder}")
+    return removed
+
+def download_to_temp(session, url, folder, quota=None, timeout=30, chunk_size=DOWNLOAD_CHUNK_SIZE, stop_event=None):
+    """Stream url into a hidden .part file inside folder; returns (part_path, size, sha256_hex).
+
+    session is a requests.Session or an HttpTransport.
+
+    The part file lives next to its final destination so committing it is an
+    atomic os.replace. If an earlier attempt at the same URL was cut short,
+    the transfer resumes with a Range request guarded by If-Range, and falls
+    back to a full download when the server's copy changed. When a quota is
+    given, the remaining length is checked before the first byte is written.
+    The SHA-256 digest is computed while streaming (plus one read of any
+    resumed prefix). A stream that breaks mid-transfer is continued from the
+    bytes on disk up to STREAM_RETRIES times; the journal is updated every
+    JOURNAL_INTERVAL bytes so a crash loses little. Setting stop_event raises
+    DownloadInterrupted and keeps the part file.
+    """
+    os.makedirs(folder, exist_ok=True)
+    partial = PartialDownload(folder, url)
+    reserved_path = partial.path
+    
+    try:
+        headers = partial.resume_headers()
+        attempt = 0
+        while True:
+            try:
+                size, digest = _stream_part(session, url, partial, headers, quota, reserved_path,
+                                            timeout, chunk_size, stop_event)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                attempt += 1
+                if attempt > STREAM_RETRIES:
+                    raise
+                if quota is not None:
+                    quota.release(reserved_path)
+                headers = partial.retry_headers(partial.written())
+                if stop_event is not None and stop_event.wait(attempt):
+                    raise DownloadInterrupted(url)
+                if stop_event is None:
+                    time.sleep(attempt)
+        
+        partial.finish(size)
+        if quota is not None:
+            # The caller commits or releases the reservation under the file's new name
+            quota.move_reservation(reserved_path, partial.path)
+    except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, DownloadInterrupted):
+        # Keep what arrived so the next attempt can resume it
+        if quota is not None:
+            quota.release(reserved_path)
+        if partial.resumable and os.path.exists(partial.path):
+            partial.save(os.path.getsize(partial.path))
+            partial.release()
+        else:
+            partial.discard()
+        raise
+    except BaseException:
+        if quota is not None:
+            quota.release(reserved_path)
+        partial.discard()
+        raise
+    
+    return partial.path, size, digest.hexdigest()
+
+def fetch_thumbnail(session, url, timeout=10):
+    """Fetch a small preview image into memory; returns its bytes or None"""
+    if not url:
+        return None
+    try:
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+    except Exception as e:
+        print(f"Error fetching thumbnail {url}: {e}")
+        return None
+
+def _stream_part(session, url, partial, headers, quota, reserved_path, timeout, chunk_size, stop_event):
+    """One request of download_to_temp(); appends to the part file and returns (size, digest)"""
+    response = session.get(url, stream=True, timeout=timeout, headers=headers)
+    if response.status_code == 416:
+        # The saved prefix does not fit the server's copy any more
+        response.close()
+        partial.offset = 0
+        response = session.get(url, stream=True, timeout=timeout)
+    
+    with response:
+        response.raise_for_status()
+        resumed = partial.start(response.status_code, response.headers)
+        
+        remaining = int(response.headers.get('Content-Length') or 0)
+        if quota is not None and not quota.make_room(remaining / (1024 * 1024), reserve_for=reserved_path):
+            raise QuotaExceededError(f"{remaining} bytes would exceed the quota")
+        
+        digest = partial.prefix_digest() if resumed else hashlib.sha256()
+        size = saved = partial.offset
+        with open(partial.path, 'ab' if resumed else 'wb', buffering=JOURNAL_INTERVAL) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if stop_event is not None and stop_event.is_set():
+                    raise DownloadInterrupted(url)
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                if size - saved >= JOURNAL_INTERVAL:
+                    f.flush()
+                    partial.save(size)
+                    saved = size
+    return size, digest
+
+def stream_download(session, url, save_path, quota=None, timeout=30, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Download url to save_path without buffering it in memory; returns (size, sha256_hex)"""
+    previous_size = os.path.getsize(save_path) if os.path.exists(save_path) else 0
+    temp_path, size, digest = download_to_temp(session, url, os.path.dirname(save_path) or '.', quota, timeout, chunk_size)
+    try:
+        os.replace(temp_path, save_path)
+    except OSError:
+        if quota is not None:
+            quota.release(temp_path)
+        raise
+    if quota is not None:
+        quota.commit(temp_path, size - previous_size)
+    return size, digest
+
+# ============================================================================
+# ASYNC DOWNLOAD ENGINE
+# ============================================================================
+
+class AsyncDownloadEngine:
+    """httpx transfers multiplexed on a private asyncio event-loop thread.
+
+    Every transfer shares one AsyncClient connection pool (HTTP/2 when h2 is
+    installed), so dozens of downloads can be in flight without a thread
+    each. Coroutines are submitted from any thread with submit(), which
+    returns a concurrent.futures.Future; deliver() hands a finished future
+    back to Tk through root.after.
+    """
+    
+    def __init__(self, concurrency=50, timeout=30, max_retries=4, http2=True):
+        if not HAS_HTTPX:
+            raise RuntimeError("httpx is not installed")
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.http2 = http2 and HAS_HTTP2
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.submit(self._start()).result()
+    
+    async def _start(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.client = httpx.AsyncClient(
+            http2=self.http2,
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            headers={"User-Agent": "Wallhaven-Changer/1.0"}
+        )
+    
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def deliver(self, future, root, callback):
+        """Call callback(future) on the Tk thread once future is done"""
+        future.add_done_callback(lambda f: root.after(0, callback, f))
+    
+    async def _open(self, url, headers=None):
+        """Start a streamed GET, retrying like HttpTransport does"""
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.send(self.client.build_request("GET", url, headers=headers), stream=True)
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(60.0, 2 ** attempt))
+            else:
+                if response.status_code not in HttpTransport.RETRY_STATUSES or attempt >= self.max_retries:
+                    return response
+                wait_for = HttpTransport.retry_after(response)
+                delay = min(60.0, wait_for) if wait_for is not None else random.uniform(0, min(60.0, 2 ** attempt))
+                await response.aclose()
+            attempt += 1
+            await asyncio.sleep(delay)
+    
+    async def download_to_temp(self, url, folder, quota=None, rate_limiter=None, cancelled=None,
+                               chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Async counterpart of download_to_temp(), resumable the same way.
+
+        Returns None if cancelled() became true before the transfer started;
+        if it becomes true mid-transfer, DownloadInterrupted is raised and
+        the part file is kept. Broken streams are continued with a Range
+        request up to STREAM_RETRIES times.
+        """
+        os.makedirs(folder, exist_ok=True)
+        
+        async with self.semaphore:
+            if rate_limiter is not None:
+                await asyncio.sleep(rate_limiter.reserve())
+            if cancelled and cancelled():
+                return None
+            
+            partial = PartialDownload(folder, url)
+            reserved_path = partial.path
+            try:
+                headers = partial.resume_headers()
+                attempt = 0
+                while True:
+                    try:
+                        size, digest = await self._stream_part(url, partial, headers, quota, reserved_path,
+                                                               cancelled, chunk_size)
+                        break
+                    except (httpx.TransportError, httpx.StreamError):
+                        attempt += 1
+                        if attempt > STREAM_RETRIES:
+                            raise
+                        if quota is not None:
+                            quota.release(reserved_path)
+                        headers = partial.retry_headers(partial.written())
+                        await asyncio.sleep(attempt)
+                        if cancelled and cancelled():
+                            raise DownloadInterrupted(url)
+                
+                partial.finish(size)
+                if quota is not None:
+                    quota.move_reservation(reserved_path, partial.path)
+            except (httpx.TransportError, httpx.StreamError, DownloadInterrupted, asyncio.CancelledError):
+                if quota is not None:
+                    quota.release(reserved_path)
+                if partial.resumable and os.path.exists(partial.path):
+                    partial.save(os.path.getsize(partial.path))
+                    partial.release()
+                else:
+                    partial.discard()
+                raise
+            except BaseException:
+                if quota is not None:
+                    quota.release(reserved_path)
+                partial.discard()
+                raise
+        
+        return partial.path, size, digest.hexdigest()
+    
+    async def _stream_part(self, url, partial, headers, quota, reserved_path, cancelled, chunk_size):
+        """One request of download_to_temp(); appends to the part file and returns (size, digest)"""
+        response = await self._open(url, headers)
+        if response.status_code == 416:
+            await response.aclose()
+            partial.offset = 0
+            response = await self._open(url)
+        
+        try:
+            response.raise_for_status()
+            resumed = partial.start(response.status_code, response.headers)
+            
+            remaining = int(response.headers.get('Content-Length') or 0)
+            if quota is not None and not await asyncio.to_thread(quota.make_room, remaining / (1024 * 1024),
+                                                                 reserved_path):
+                raise QuotaExceededError(f"{remaining} bytes would exceed the quota")
+            
+            digest = partial.prefix_digest() if resumed else hashlib.sha256()
+            size = saved = partial.offset
+            with open(partial.path, 'ab' if resumed else 'wb', buffering=JOURNAL_INTERVAL) as f:
+                async for chunk in response.aiter_bytes(chunk_size):
+                    if cancelled and cancelled():
+                        raise DownloadInterrupted(url)
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    if size - saved >= JOURNAL_INTERVAL:
+                        f.flush()
+                        partial.save(size)
+                        saved = size
+        finally:
+            await response.aclose()
+        return size, digest
+    
+    async def download_file(self, url, save_path, quota=None):
+        """Async counterpart of stream_download(); returns (size, sha256_hex)"""
+        previous_size = os.path.getsize(save_path) if os.path.exists(save_path) else 0
+        temp_path, size, digest = await self.download_to_temp(url, os.path.dirname(save_path) or '.', quota)
+        try:
+            os.replace(temp_path, save_path)
+        except OSError:
+            if quota is not None:
+                quota.release(temp_path)
+            raise
+        if quota is not None:
+            quota.commit(temp_path, size - previous_size)
+        return size, digest
+    
+    async def _close(self):
+        await self.client.aclose()
+    
+    def close(self):
+        if not self.loop.is_running():
+            return
+        try:
+            self.submit(self._close()).result(timeout=5)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+def benchmark_download_backends(urls, folder, workers=4, concurrency=50):
+    """Download urls with the threaded transport and with the async engine.
+
+    Returns {backend: {files, bytes, seconds, mb_per_second}}. The
+    downloaded temp files are removed afterwards.
+    """
+    results = {}
+    
+    def summarize(name, fetched, elapsed):
+        total = 0
+        for temp_path, size, digest in fetched:
+            total += size
+            os.remove(temp_path)
+        results[name] = {
+            "files": len(fetched),
+            "bytes": total,
+            "seconds": elapsed,
+            "mb_per_second": total / (1024 * 1024) / elapsed if elapsed else 0.0
+        }
+    
+    transport = HttpTransport(pool_size=workers)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fetched = list(pool.map(lambda url: download_to_temp(transport, url, folder), urls))
+    summarize("threads", fetched, time.monotonic() - started)
+    
+    if HAS_HTTPX:
+        engine = AsyncDownloadEngine(concurrency)
+        try:
+            started = time.monotonic()
+            futures = [engine.submit(engine.download_to_temp(url, folder)) for url in urls]
+            fetched = [future.result() for future in futures]
+            summarize("async", fetched, time.monotonic() - started)
+        finally:
+            engine.close()
+    
+    return results
+
+# ============================================================================
+# SEARCH CACHE
+# ============================================================================
+
+class SearchCache:
+    """Persistent cache of API search responses keyed by normalized query parameters.
+
+    Entries younger than ttl are served without a request. Older entries are
+    revalidated with If-None-Match / If-Modified-Since, and served as-is if
+    the API is unreachable. The least recently used entries are dropped
+    once there are more than max_entries.
+    """
+    
+    def __init__(self, db_path, ttl=3600, max_entries=200):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.store = SQLiteStore(db_path)
+        self.store.write('''
+            CREATE TABLE IF NOT EXISTS search_cache (
+                key TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL,
+                accessed_at REAL
+            )
+        ''')
+        self.store.write('CREATE INDEX IF NOT EXISTS idx_search_accessed ON search_cache(accessed_at)', wait=True)
+    
+    @staticmethod
+    def make_key(url, params, scope=""):
+        """Order-independent key; scope separates e.g. different API keys"""
+        normalized = sorted((str(k), str(v)) for k, v in params.items() if v is not None)
+        return json.dumps([url, scope, normalized])
+    
+    def get(self, key):
+        """Return (body, etag, last_modified, is_fresh) or None"""
+        row = self.store.query_one(
+            "SELECT body, etag, last_modified, fetched_at FROM search_cache WHERE key = ?", (key,)
+        )
+        if not row:
+            return None
+        self.store.write("UPDATE search_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0]), row[1], row[2], time.time() - row[3] < self.ttl
+    
+    def put(self, key, body, etag=None, last_modified=None):
+        now = time.time()
+        self.store.write('''
+            INSERT OR REPLACE INTO search_cache (key, body, etag, last_modified, fetched_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (key, json.dumps(body), etag, last_modified, now, now))
+        self.store.write('''
+            DELETE FROM search_cache WHERE key NOT IN (
+                SELECT key FROM search_cache ORDER BY accessed_at DESC LIMIT ?
+            )
+        ''', (self.max_entries,))
+    
+    def touch(self, key):
+        """Mark an entry fresh again after a 304 Not Modified"""
+        now = time.time()
+        self.store.write("UPDATE search_cache SET fetched_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+    
+    def clear(self):
+        self.store.write("DELETE FROM search_cache", wait=True)
+    
+    def close(self):
+        self.store.close()
 
 # ============================================================================
 # WALLHAVEN API
@@ -569,12 +2399,14 @@ class DuplicateDetector:
 class WallhavenAPI:
     BASE_URL = "https://wallhaven.cc/api/v1"
     
-    def __init__(self, api_key=None):
+    # Wallhaven allows 45 API calls per minute per client, whichever instance makes them
+    limiter = SlidingWindowLimiter(45, 60.0)
+    
+    def __init__(self, api_key=None, cache=None, transport=None):
         self.api_key = api_key
-        self.session = requests.Session()
-        if api_key:
-            self.session.headers.update({"X-API-Key": api_key})
-        self.session.headers.update({"User-Agent": "Wallhaven-Changer/1.0"})
+        self.cache = cache
+        self.transport = transport or HttpTransport()
+        self.headers = {"X-API-Key": api_key} if api_key else {}
     
     def search(self, **params):
         url = f"{self.BASE_URL}/search"
@@ -591,33 +2423,62 @@ class WallhavenAPI:
                 pur_str = f"{pur.get('sfw', 1)}{pur.get('sketchy', 0)}{pur.get('nsfw', 0)}"
                 params["purity"] = pur_str
         
-        response = self.session.get(url, params=params)
-        response.raise_for_status()
-        return response.json()
-    
-    def download_image(self, url, save_path):
-        response = self.session.get(url, stream=True)
-        response.raise_for_status()
+        if not self.cache:
+            response = self.transport.get(url, limiter=self.limiter, params=params, headers=self.headers)
+            response.raise_for_status()
+            return response.json()
+        
+        scope = hashlib.sha256(self.api_key.encode()).hexdigest()[:16] if self.api_key else ""
+        key = SearchCache.make_key(url, params, scope)
+        cached = self.cache.get(key)
+        if cached and cached[3]:
+            self.cache.hits += 1
+            return cached[0]
+        
+        headers = dict(self.headers)
+        if cached:
+            if cached[1]:
+                headers["If-None-Match"] = cached[1]
+            if cached[2]:
+                headers["If-Modified-Since"] = cached[2]
         
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        return save_path
+        try:
+            response = self.transport.get(url, limiter=self.limiter, params=params, headers=headers)
+            if response.status_code == 304 and cached:
+                self.cache.touch(key)
+                self.cache.revalidated += 1
+                return cached[0]
+            response.raise_for_status()
+        except requests.RequestException:
+            # A stale page is better than no page while the API is unreachable
+            if cached:
+                return cached[0]
+            raise
+        
+        body = response.json()
+        self.cache.misses += 1
+        self.cache.put(key, body, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return body
+    
+    def download_image(self, url, save_path, quota=None):
+        """Stream an image to save_path; returns its SHA-256 hex digest"""
+        size, digest = stream_download(self.transport, url, save_path, quota)
+        return digest
 
 # ============================================================================
 # WALLHAVEN SOURCE
 # ============================================================================
 
 class WallhavenSource:
-    def __init__(self, api_key=None, filters=None, enabled=True):
+    def __init__(self, api_key=None, filters=None, enabled=True, search_cache=None, transport=None):
         self.name = "Wallhaven"
         self.enabled = enabled
         self.api_key = api_key
         self.filters = filters or {}
-        self.api = WallhavenAPI(api_key)
+        self.api = WallhavenAPI(api_key, search_cache, transport)
     
     def get_images(self, count=10, tags=None):
+        """Up to count results, [] when nothing matches, or None if the search failed"""
         try:
             params = {
                 "page": random.randint(1, 5),
@@ -638,13 +2499,18 @@ class WallhavenSource:
                     'download_url': item['path'],
                     'source': 'wallhaven',
                     'resolution': item.get('resolution', ''),
+                    'ratio': item.get('ratio', ''),
+                    'file_size': item.get('file_size', 0),
+                    'file_type': item.get('file_type', ''),
+                    'colors': item.get('colors', []),
+                    'thumb_url': item.get('thumbs', {}).get('small', ''),
                     'tags': [tag['name'] for tag in item.get('tags', [])]
                 })
             
             return images[:count]
         except Exception as e:
             print(f"Wallhaven error: {e}")
-            return []
+            return None
     
     def search(self, query, count=10):
         return self.get_images(count, query)
@@ -654,10 +2520,10 @@ class WallhavenSource:
 # ============================================================================
 
 class SourceManager:
-    def __init__(self, api_key=None, filters=None):
+    def __init__(self, api_key=None, filters=None, search_cache=None, transport=None):
         self.api_key = api_key
         self.filters = filters or {}
-        self.source = WallhavenSource(api_key, filters)
+        self.source = WallhavenSource(api_key, filters, search_cache=search_cache, transport=transport)
     
     def update_filters(self, filters):
         self.filters = filters
@@ -673,96 +2539,243 @@ class SourceManager:
             return []
         return self.source.search(query, count)
 
+# ============================================================================
+# SEARCH PREFILTER
+# ============================================================================
+
+def parse_dimensions(value):
+    """'1920x1080' or '16:9' -> (1920, 1080); None if it does not parse"""
+    for sep in ('x', ':'):
+        if sep in str(value):
+            try:
+                w, h = (int(part) for part in str(value).split(sep, 1))
+                return (w, h) if w > 0 and h > 0 else None
+            except ValueError:
+                return None
+    return None
+
+class MetadataPrefilter:
+    """Rejects search results using only their metadata, before anything is fetched.
+
+    Results are skipped when their Wallhaven id is already on disk (or was
+    already skipped as a duplicate by a batch run), when their file_size
+    cannot fit in the quota, or when their resolution or aspect ratio does
+    not match the configured filters. Results without metadata pass.
+    """
+    
+    def __init__(self, library, download_folder, quota_manager=None, config=None, job_queue=None,
+                 ratio_tolerance=0.05):
+        self.library = library
+        self.download_folder = download_folder
+        self.quota_manager = quota_manager
+        self.config = config if config is not None else {}
+        self.job_queue = job_queue
+        self.ratio_tolerance = ratio_tolerance
+        self.last_rejected = {}
+    
+    @staticmethod
+    def image_key(img):
+        """The bare Wallhaven id; local ids are prefixed, e.g. wallhaven_abc123 or nature_wallhaven_abc123"""
+        return str(img.get('id', '')).rsplit('_', 1)[-1]
+    
+    def known_ids(self):
+        # Downloaded files are named <...>_<id>.<ext>
+        names = (os.path.splitext(entry['name'])[0] for entry in self.library.list_entries(self.download_folder))
+        known = {name.rsplit('_', 1)[-1] for name in names}
+        if self.job_queue:
+            known |= {image_id.rsplit('_', 1)[-1] for image_id in self.job_queue.known_image_ids()}
+        return known
+    
+    def _quota_budget(self):
+        """Bytes that may still be added, or None for unlimited"""
+        quota = self.quota_manager
+        if not quota or not quota.enabled:
+            return None
+        if quota.eviction_policy:
+            # Eviction can free everything except what is protected; only oversized files are hopeless
+            return quota.max_size_bytes
+        return max(0, quota.max_size_bytes - quota.get_used_bytes() - quota.reserved_bytes)
+    
+    def _resolution_ok(self, img):
+        dims = parse_dimensions(img.get('resolution', ''))
+        if not dims:
+            return True
+        minimum = parse_dimensions(self.config.get("min_resolution", ""))
+        if minimum and (dims[0] < minimum[0] or dims[1] < minimum[1]):
+            return False
+        
+        ratios = [parse_dimensions(r) for r in self.config.get("aspect_ratios") or []]
+        ratios = [w / h for w, h in ratios if w and h]
+        if ratios:
+            actual = dims[0] / dims[1]
+            return any(abs(actual - ratio) <= ratio * self.ratio_tolerance for ratio in ratios)
+        return True
+    
+    def filter(self, images):
+        """Return the images worth downloading; counts of skipped ones go to last_rejected"""
+        rejected = {}
+        if not self.config.get("prefilter_enabled", True):
+            self.last_rejected = rejected
+            return list(images)
+        
+        known = self.known_ids()
+        budget = self._quota_budget()
+        kept = []
+        for img in images:
+            key = self.image_key(img)
+            size = img.get('file_size') or 0
+            if key in known:
+                reason = "known"
+            elif budget is not None and size > budget:
+                reason = "quota"
+            elif not self._resolution_ok(img):
+                reason = "resolution"
+            else:
+                reason = None
+            
+            if reason:
+                rejected[reason] = rejected.get(reason, 0) + 1
+                continue
+            known.add(key)
+            if budget is not None and not self.quota_manager.eviction_policy:
+                budget -= size
+            kept.append(img)
+        
+        self.last_rejected = rejected
+        return kept
+
 # ============================================================================
 # FAVORITES DATABASE
 # ============================================================================
 
 class FavoritesDatabase:
+    # Rows of the history log that are kept; view_stats holds the per-path totals
+    HISTORY_LIMIT = 1000
+    
     def __init__(self):
         db_dir = os.path.dirname(DATABASE_FILE)
         os.makedirs(db_dir, exist_ok=True)
         
-        self.conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
-        self.lock = threading.Lock()
+        self.store = SQLiteStore(DATABASE_FILE)
+        self.views_logged = 0
         self.create_tables()
     
     def create_tables(self):
-        with self.lock:
-            self.conn.execute('''
-                CREATE TABLE IF NOT EXISTS favorites (
-                    id TEXT PRIMARY KEY,
-                    path TEXT NOT NULL,
-                    resolution TEXT,
-                    file_type TEXT DEFAULT 'static',
-                    download_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    last_used DATETIME,
-                    use_count INTEGER DEFAULT 0,
-                    source TEXT DEFAULT 'wallhaven'
-                )
-            ''')
-            self.conn.execute('''
-                CREATE TABLE IF NOT EXISTS history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    wallpaper_id TEXT,
-                    set_time DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            self.conn.commit()
+        self.store.write('''
+            CREATE TABLE IF NOT EXISTS favorites (
+                id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                resolution TEXT,
+                file_type TEXT DEFAULT 'static',
+                download_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_used DATETIME,
+                use_count INTEGER DEFAULT 0,
+                source TEXT DEFAULT 'wallhaven'
+            )
+        ''')
+        self.store.write('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                wallpaper_id TEXT,
+                set_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                path TEXT
+            )
+        ''', wait=True)
+        # Databases created before history tracked paths
+        columns = [row[1] for row in self.store.query('PRAGMA table_info(history)')]
+        if 'path' not in columns:
+            self.store.write('ALTER TABLE history ADD COLUMN path TEXT')
+        self.store.write('CREATE INDEX IF NOT EXISTS idx_history_path ON history(path)', wait=True)
+        self.store.write('''
+            CREATE TABLE IF NOT EXISTS view_stats (
+                path TEXT PRIMARY KEY,
+                view_count INTEGER DEFAULT 0,
+                last_viewed REAL
+            )
+        ''', wait=True)
+        if self.store.query_one('SELECT COUNT(*) FROM view_stats')[0] == 0:
+            # Databases created before view_stats: fold the history log into it once
+            self.store.write('''
+                INSERT OR IGNORE INTO view_stats (path, view_count, last_viewed)
+                SELECT path, COUNT(*), CAST(strftime('%s', MAX(set_time)) AS REAL)
+                FROM history WHERE path IS NOT NULL GROUP BY path
+            ''', wait=True)
+        self.prune_history()
     
     def add_favorite(self, wallpaper_data):
-        with self.lock:
-            try:
-                self.conn.execute('''
-                    INSERT OR REPLACE INTO favorites 
-                    (id, path, resolution, file_type, source, download_date)
-                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                ''', (
-                    wallpaper_data['id'],
-                    wallpaper_data['path'],
-                    wallpaper_data.get('resolution', ''),
-                    wallpaper_data.get('file_type', 'static'),
-                    wallpaper_data.get('source', 'wallhaven')
-                ))
-                self.conn.commit()
-                return True
-            except:
-                return False
+        try:
+            self.store.write('''
+                INSERT OR REPLACE INTO favorites 
+                (id, path, resolution, file_type, source, download_date)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (
+                wallpaper_data['id'],
+                wallpaper_data['path'],
+                wallpaper_data.get('resolution', ''),
+                wallpaper_data.get('file_type', 'static'),
+                wallpaper_data.get('source', 'wallhaven')
+            ), wait=True)
+            return True
+        except:
+            return False
     
     def remove_favorite(self, wallpaper_id):
-        with self.lock:
-            self.conn.execute('DELETE FROM favorites WHERE id = ?', (wallpaper_id,))
-            self.conn.commit()
+        self.store.write('DELETE FROM favorites WHERE id = ?', (wallpaper_id,), wait=True)
     
     def get_favorites(self, limit=50):
-        with self.lock:
-            cursor = self.conn.execute('''
-                SELECT * FROM favorites ORDER BY download_date DESC LIMIT ?
-            ''', (limit,))
-            return cursor.fetchall()
+        return self.store.query('''
+            SELECT * FROM favorites ORDER BY download_date DESC LIMIT ?
+        ''', (limit,))
     
     def is_favorite(self, wallpaper_id):
-        with self.lock:
-            cursor = self.conn.execute('SELECT 1 FROM favorites WHERE id = ?', (wallpaper_id,))
-            return cursor.fetchone() is not None
-    
-    def record_use(self, wallpaper_id):
-        with self.lock:
-            self.conn.execute('''
-                UPDATE favorites SET last_used = CURRENT_TIMESTAMP, use_count = use_count + 1 WHERE id = ?
-            ''', (wallpaper_id,))
-            self.conn.execute('INSERT INTO history (wallpaper_id) VALUES (?)', (wallpaper_id,))
-            self.conn.commit()
+        return self.store.query_one('SELECT 1 FROM favorites WHERE id = ?', (wallpaper_id,)) is not None
+    
+    def record_use(self, wallpaper_id, path=None):
+        # History writes are fire-and-forget; the writer thread group-commits them
+        self.store.write('''
+            UPDATE favorites SET last_used = CURRENT_TIMESTAMP, use_count = use_count + 1 WHERE id = ?
+        ''', (wallpaper_id,))
+        self.record_view(wallpaper_id, path)
+    
+    def record_view(self, wallpaper_id, path):
+        """Log a wallpaper being shown and bump its per-path view totals"""
+        self.store.write('INSERT INTO history (wallpaper_id, path) VALUES (?, ?)', (wallpaper_id, path))
+        if path:
+            self.store.write('''
+                INSERT INTO view_stats (path, view_count, last_viewed) VALUES (?, 1, ?)
+                ON CONFLICT(path) DO UPDATE SET view_count = view_count + 1, last_viewed = excluded.last_viewed
+            ''', (path, time.time()))
+        self.views_logged += 1
+        if self.views_logged % self.HISTORY_LIMIT == 0:
+            self.prune_history()
+    
+    def prune_history(self):
+        """Keep only the newest HISTORY_LIMIT rows of the history log"""
+        self.store.write('DELETE FROM history WHERE id <= (SELECT MAX(id) FROM history) - ?', (self.HISTORY_LIMIT,))
+    
+    def forget_views(self, paths):
+        """Drop view totals for files that no longer exist"""
+        self.store.write('DELETE FROM view_stats WHERE path = ?', [(path,) for path in paths], many=True)
+    
+    def get_favorite_paths(self):
+        return {row[0] for row in self.store.query('SELECT path FROM favorites')}
+    
+    def get_view_stats(self):
+        """Return {path: (last_shown_epoch, times_shown)} from the per-path totals"""
+        rows = self.store.query('SELECT path, last_viewed, view_count FROM view_stats')
+        return {row[0]: (row[1] or 0, row[2]) for row in rows}
     
     def close(self):
-        self.conn.close()
+        self.store.close()
 
 # ============================================================================
 # FAVORITES FOLDER MANAGER
 # ============================================================================
 
 class FavoritesFolderManager:
-    def __init__(self, config):
+    def __init__(self, config, library):
         self.config = config
+        self.library = library
         self.favorites_folder = config.get("favorites_folder", FAVORITES_FOLDER)
         self.copy_enabled = config.get("copy_to_favorites", True)
         os.makedirs(self.favorites_folder, exist_ok=True)
@@ -788,17 +2801,8 @@ class FavoritesFolderManager:
             return None
     
     def get_all_favorites(self):
-        files = []
-        if os.path.exists(self.favorites_folder):
-            for f in os.listdir(self.favorites_folder):
-                if f.endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                    file_path = os.path.join(self.favorites_folder, f)
-                    files.append({
-                        'path': file_path,
-                        'name': f,
-                        'size': os.path.getsize(file_path),
-                        'modified': os.path.getmtime(file_path)
-                    })
+        self.library.refresh(self.favorites_folder)
+        files = self.library.list_entries(self.favorites_folder, ('.jpg', '.jpeg', '.png', '.gif'))
         return sorted(files, key=lambda x: x['modified'], reverse=True)
 
 # ============================================================================
@@ -806,25 +2810,211 @@ class FavoritesFolderManager:
 # ============================================================================
 
 class QuotaManager:
-    def __init__(self, download_folder, enabled=True, max_size_mb=1000):
+    """Disk quota backed by a running byte counter.
+
+    The counter is seeded from the library index once, adjusted by the app's
+    own writes and deletes, and reconciled against the index in the background
+    so external changes are picked up eventually.
+    """
+    
+    EVICTION_POLICIES = {
+        "lru": "Least recently shown",
+        "lfu": "Least frequently shown",
+        "oldest": "Oldest downloaded",
+        "largest": "Largest first"
+    }
+    
+    def __init__(self, download_folder, library, enabled=True, max_size_mb=1000, reconcile_interval=300,
+                 eviction_policy=None, favorites_db=None, eviction_headroom=0.05):
         self.download_folder = download_folder
+        self.library = library
         self.enabled = enabled
         self.max_size_mb = max_size_mb
-        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.reconcile_interval = reconcile_interval
+        # Eviction is off while eviction_policy is None
+        self.eviction_policy = eviction_policy
+        self.favorites_db = favorites_db
+        self.duplicate_detector = None
+        self.eviction_headroom = eviction_headroom
+        self.protected_paths = set()
+        # Files of a batch that is still running; never evicted until released
+        self.held_paths = set()
+        self.used_bytes = None
+        self.lock = threading.Lock()
+        # Serialises room checks and eviction so concurrent downloads cannot overshoot together
+        self.room_lock = threading.RLock()
+        # In-flight transfers: path -> (bytes, reserved_at)
+        self.reservations = {}
+        self.reserved_bytes = 0
+        self.stop_event = threading.Event()
+        threading.Thread(target=self._reconcile_loop, daemon=True).start()
+    
+    @property
+    def max_size_bytes(self):
+        # Derived so a limit changed in the Quota tab applies everywhere at once
+        return self.max_size_mb * 1024 * 1024
+    
+    def _reconcile_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"Quota reconcile error: {e}")
+            self.stop_event.wait(self.reconcile_interval)
+    
+    def reconcile(self):
+        """Recount usage from the library index.
+
+        Part files are left out: in-flight ones are covered by their
+        reservation, and a resumed one is charged in full by commit().
+        """
+        self.library.refresh(self.download_folder)
+        total = self.library.total_size(self.download_folder, PartialDownload.FILE_SUFFIXES)
+        with self.lock:
+            self.used_bytes = total
+            # Drop reservations whose transfer vanished without committing or releasing
+            now = time.time()
+            for path, (nbytes, reserved_at) in list(self.reservations.items()):
+                if now - reserved_at > 60 and not os.path.exists(path):
+                    del self.reservations[path]
+                    self.reserved_bytes -= nbytes
+        return total
+    
+    def record_delete(self, nbytes):
+        """Account for a file the app removed from the download folder"""
+        with self.lock:
+            if self.used_bytes is not None:
+                self.used_bytes = max(0, self.used_bytes - nbytes)
+    
+    def get_used_bytes(self):
+        with self.lock:
+            used = self.used_bytes
+        if used is None:
+            used = self.reconcile()
+        return used
     
     def get_folder_size_mb(self):
-        total_size = 0
-        if os.path.exists(self.download_folder):
-            for f in os.listdir(self.download_folder):
-                fp = os.path.join(self.download_folder, f)
-                if os.path.isfile(fp):
-                    total_size += os.path.getsize(fp)
-        return total_size / (1024 * 1024)
+        return self.get_used_bytes() / (1024 * 1024)
+    
+    def hold(self, path):
+        """Keep path out of eviction until unhold()"""
+        with self.lock:
+            self.held_paths.add(os.path.abspath(path))
+    
+    def unhold(self, paths):
+        with self.lock:
+            self.held_paths.difference_update(os.path.abspath(path) for path in paths)
+    
+    def release(self, path):
+        """Give back the space reserved for a transfer that failed or was dropped"""
+        with self.lock:
+            nbytes, _ = self.reservations.pop(path, (0, 0))
+            self.reserved_bytes -= nbytes
+    
+    def move_reservation(self, old_path, new_path):
+        with self.lock:
+            if old_path in self.reservations:
+                self.reservations[new_path] = self.reservations.pop(old_path)
+    
+    def commit(self, path, nbytes):
+        """Turn a transfer's reservation into nbytes of recorded usage"""
+        with self.lock:
+            reserved, _ = self.reservations.pop(path, (0, 0))
+            self.reserved_bytes -= reserved
+            if self.used_bytes is not None:
+                self.used_bytes += nbytes
     
     def can_download(self, file_size_mb):
         if not self.enabled:
             return True
-        return (self.get_folder_size_mb() + file_size_mb) <= self.max_size_mb
+        used = self.get_used_bytes() + self.reserved_bytes
+        return used + file_size_mb * 1024 * 1024 <= self.max_size_bytes
+    
+    def _eviction_order(self, entries, policy):
+        """Sort candidate entries so the first one is evicted first"""
+        views = self.favorites_db.get_view_stats() if self.favorites_db else {}
+        
+        def last_touched(entry):
+            # A freshly downloaded wallpaper counts as touched at download time
+            return max(views.get(entry['path'], (0, 0))[0], entry['modified'])
+        
+        if policy == "lfu":
+            key = lambda e: (views.get(e['path'], (0, 0))[1], last_touched(e))
+        elif policy == "oldest":
+            key = lambda e: e['modified']
+        elif policy == "largest":
+            key = lambda e: -e['size']
+        else:
+            key = last_touched
+        return sorted(entries, key=key)
+    
+    def evict(self, bytes_to_free, policy=None):
+        """Delete non-favorite wallpapers until bytes_to_free is released.
+
+        Returns the list of deleted paths.
+        """
+        with self.room_lock:
+            return self._evict(bytes_to_free, policy or self.eviction_policy or "lru")
+    
+    def _evict(self, bytes_to_free, policy):
+        self.library.refresh(self.download_folder)
+        
+        protected = {os.path.abspath(p) for p in self.protected_paths if p}
+        with self.lock:
+            protected |= self.held_paths
+        if self.favorites_db:
+            protected |= {os.path.abspath(p) for p in self.favorites_db.get_favorite_paths() if p}
+        
+        candidates = [e for e in self.library.list_entries(self.download_folder)
+                      if os.path.abspath(e['path']) not in protected]
+        
+        freed = 0
+        deleted = []
+        for entry in self._eviction_order(candidates, policy):
+            if freed >= bytes_to_free:
+                break
+            try:
+                os.remove(entry['path'])
+            except OSError as e:
+                print(f"Could not evict {entry['path']}: {e}")
+                continue
+            freed += entry['size']
+            deleted.append(entry['path'])
+            self.record_delete(entry['size'])
+            if self.duplicate_detector:
+                self.duplicate_detector.remove_image(entry['path'])
+        
+        if deleted:
+            if self.favorites_db:
+                self.favorites_db.forget_views(deleted)
+            print(f"Quota eviction ({policy}): removed {len(deleted)} files, {freed / (1024 * 1024):.1f} MB")
+        return deleted
+    
+    def make_room(self, file_size_mb, reserve_for=None):
+        """Like can_download, but evicts old wallpapers first when a policy is set.
+
+        With reserve_for (the transfer's temp path) the space is also reserved
+        until commit() or release(), so parallel downloads cannot all claim it.
+        """
+        with self.room_lock:
+            fits = self.can_download(file_size_mb)
+            if not fits and self.eviction_policy:
+                max_bytes = self.max_size_bytes
+                needed = self.get_used_bytes() + self.reserved_bytes + file_size_mb * 1024 * 1024 - max_bytes
+                # Free a little extra so the next downloads do not evict one file at a time
+                self.evict(needed + max_bytes * self.eviction_headroom)
+                fits = self.can_download(file_size_mb)
+            
+            if fits and reserve_for and self.enabled:
+                nbytes = int(file_size_mb * 1024 * 1024)
+                with self.lock:
+                    previous, _ = self.reservations.get(reserve_for, (0, 0))
+                    self.reservations[reserve_for] = (nbytes, time.time())
+                    self.reserved_bytes += nbytes - previous
+            return fits
+    
+    def close(self):
+        self.stop_event.set()
 
 # ============================================================================
 # KEYWORD MANAGER
@@ -888,134 +3078,1213 @@ class KeywordManager:
         self.last_download[keyword] = datetime.now().isoformat()
         self.save_keywords()
 
+# ============================================================================
+# RATE LIMITER
+# ============================================================================
+
+class TokenBucket:
+    """Thread-safe token bucket shared by all download workers"""
+    
+    def __init__(self, rate: float, capacity: float = None):
+        # rate is tokens per second; 0 or less disables limiting
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, tokens: float = 1, stop_event=None) -> bool:
+        """Block until tokens are available; False if stop_event fired first"""
+        if self.rate <= 0:
+            return True
+        
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait_time = (tokens - self.tokens) / self.rate
+            
+            if stop_event:
+                if stop_event.wait(wait_time):
+                    return False
+            else:
+                time.sleep(wait_time)
+    
+    def reserve(self, tokens: float = 1) -> float:
+        """Take tokens now, going into debt if needed; returns seconds to wait before using them"""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+# ============================================================================
+# DOWNLOAD JOB QUEUE
+# ============================================================================
+
+class DownloadJobQueue:
+    """Durable keyword batch runs: one row per image to download, with state and retries.
+
+    A run lists its keywords; once a keyword has been searched its results
+    become jobs. Jobs move queued -> in-flight -> done / skipped-duplicate /
+    failed. Failures are re-queued until max_attempts is reached. Jobs left
+    in-flight by a crash go back to queued on startup, so an interrupted run
+    resumes where it stopped.
+    """
+    
+    QUEUED = "queued"
+    IN_FLIGHT = "in-flight"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped-duplicate"
+    
+    def __init__(self, db_path, max_attempts=3):
+        self.max_attempts = max_attempts
+        self.store = SQLiteStore(db_path)
+        self.store.write('''
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                per_keyword INTEGER,
+                status TEXT DEFAULT 'active',
+                created_at REAL
+            )
+        ''')
+        self.store.write('''
+            CREATE TABLE IF NOT EXISTS run_keywords (
+                run_id INTEGER,
+                keyword TEXT,
+                priority INTEGER DEFAULT 0,
+                searched INTEGER DEFAULT 0,
+                search_attempts INTEGER DEFAULT 0,
+                PRIMARY KEY (run_id, keyword)
+            )
+        ''')
+        self.store.write('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER,
+                keyword TEXT,
+                image_id TEXT,
+                data TEXT,
+                priority INTEGER DEFAULT 0,
+                state TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                path TEXT,
+                updated_at REAL,
+                UNIQUE (run_id, image_id)
+            )
+        ''')
+        self.store.write('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(run_id, state, priority)')
+        # Anything in flight when the app last exited never finished
+        self.store.write("UPDATE jobs SET state = ? WHERE state = ?", (self.QUEUED, self.IN_FLIGHT), wait=True)
+    
+    def start_run(self, keywords, per_keyword, priorities=None):
+        """Create a run for keywords; priorities maps keyword -> int (higher first).
+
+        Earlier unfinished runs are kept; unfinished_run() returns the newest.
+        """
+        priorities = priorities or {}
+        self.store.write("INSERT INTO runs (per_keyword, status, created_at) VALUES (?, 'active', ?)",
+                         (per_keyword, time.time()), wait=True)
+        run_id = self.store.query_one("SELECT MAX(id) FROM runs")[0]
+        self.store.write("INSERT OR IGNORE INTO run_keywords (run_id, keyword, priority) VALUES (?, ?, ?)",
+                         [(run_id, keyword, priorities.get(keyword, 0)) for keyword in keywords], many=True, wait=True)
+        return run_id
+    
+    def unfinished_run(self, include_stopped=True):
+        """(run_id, per_keyword) of the latest run that still has work, or None"""
+        statuses = ('active', 'stopped') if include_stopped else ('active',)
+        row = self.store.query_one(
+            f"SELECT id, per_keyword FROM runs WHERE status IN ({','.join('?' * len(statuses))}) "
+            "ORDER BY id DESC LIMIT 1", statuses
+        )
+        return tuple(row) if row else None
+    
+    def set_run_status(self, run_id, status):
+        self.store.write("UPDATE runs SET status = ? WHERE id = ?", (status, run_id), wait=True)
+    
+    def pending_keywords(self, run_id):
+        """Keywords of a run whose search has not succeeded yet and may be retried"""
+        return [row[0] for row in self.store.query(
+            "SELECT keyword FROM run_keywords WHERE run_id = ? AND searched = 0 AND search_attempts < ? "
+            "ORDER BY priority DESC, rowid",
+            (run_id, self.max_attempts)
+        )]
+    
+    def add_keywords(self, run_id, keywords):
+        """Append keywords to an existing run; they are searched when it next resumes"""
+        self.store.write("INSERT OR IGNORE INTO run_keywords (run_id, keyword) VALUES (?, ?)",
+                         [(run_id, keyword) for keyword in keywords], many=True, wait=True)
+    
+    def search_failed(self, run_id, keyword):
+        self.store.write("UPDATE run_keywords SET search_attempts = search_attempts + 1 WHERE run_id = ? AND keyword = ?",
+                         (run_id, keyword), wait=True)
+    
+    def run_keywords(self, run_id):
+        return [row[0] for row in self.store.query(
+            "SELECT keyword FROM run_keywords WHERE run_id = ? ORDER BY priority DESC, rowid", (run_id,)
+        )]
+    
+    def add_jobs(self, run_id, keyword, images):
+        """Queue a keyword's search results and mark the keyword searched"""
+        priority = self.store.query_one(
+            "SELECT priority FROM run_keywords WHERE run_id = ? AND keyword = ?", (run_id, keyword)
+        )
+        priority = priority[0] if priority else 0
+        now = time.time()
+        self.store.write('''
+            INSERT OR IGNORE INTO jobs (run_id, keyword, image_id, data, priority, state, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(run_id, keyword, img['id'], json.dumps(img), priority, self.QUEUED, now) for img in images], many=True)
+        self.store.write("UPDATE run_keywords SET searched = 1 WHERE run_id = ? AND keyword = ?",
+                         (run_id, keyword), wait=True)
+    
+    def claim(self, run_id, limit):
+        """Move up to limit queued jobs to in-flight; returns [(job_id, keyword, image)]"""
+        # finish() does not wait for its writes; make re-queued jobs visible to this read
+        self.store.flush()
+        rows = self.store.query('''
+            SELECT id, keyword, data FROM jobs WHERE run_id = ? AND state = ?
+            ORDER BY priority DESC, id LIMIT ?
+        ''', (run_id, self.QUEUED, limit))
+        if rows:
+            self.store.write("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?",
+                             [(self.IN_FLIGHT, time.time(), row[0]) for row in rows], many=True, wait=True)
+        return [(row[0], row[1], json.loads(row[2])) for row in rows]
+    
+    def finish(self, job_id, status, path=None, error=None):
+        """Record a BatchDownloader status (ok/duplicate/error/quota/stopped) for a job"""
+        now = time.time()
+        if status == "ok":
+            self.store.write("UPDATE jobs SET state = ?, path = ?, updated_at = ? WHERE id = ?",
+                             (self.DONE, path, now, job_id))
+        elif status == "duplicate":
+            self.store.write("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (self.SKIPPED, now, job_id))
+        elif status == "error":
+            # Re-queue until the attempts run out
+            self.store.write('''
+                UPDATE jobs SET attempts = attempts + 1, error = ?, updated_at = ?,
+                    state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END
+                WHERE id = ?
+            ''', (error, now, self.max_attempts, self.FAILED, self.QUEUED, job_id))
+        else:
+            # Stopped or out of quota: not the job's fault, try again next time
+            self.store.write("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (self.QUEUED, now, job_id))
+    
+    def known_image_ids(self):
+        """Image ids that any run downloaded or found to be a duplicate"""
+        return {row[0] for row in self.store.query(
+            "SELECT DISTINCT image_id FROM jobs WHERE state IN (?, ?)", (self.DONE, self.SKIPPED)
+        )}
+    
+    def keyword_states(self, run_id):
+        """{keyword: {state: count}} for a run"""
+        states = {}
+        for keyword, state, count in self.store.query(
+            "SELECT keyword, state, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY keyword, state", (run_id,)
+        ):
+            states.setdefault(keyword, {})[state] = count
+        return states
+    
+    def completed_keywords(self, run_id):
+        """Keywords that were searched and have every job done or skipped as a duplicate"""
+        return [row[0] for row in self.store.query('''
+            SELECT keyword FROM run_keywords k WHERE run_id = ? AND searched = 1 AND NOT EXISTS (
+                SELECT 1 FROM jobs j WHERE j.run_id = k.run_id AND j.keyword = k.keyword
+                AND j.state NOT IN (?, ?)
+            )
+        ''', (run_id, self.DONE, self.SKIPPED))]
+    
+    def prune(self, keep_days=30):
+        """Forget finished runs older than keep_days"""
+        cutoff = time.time() - keep_days * 86400
+        old = "SELECT id FROM runs WHERE status NOT IN ('active', 'stopped') AND created_at < ?"
+        self.store.write(f"DELETE FROM jobs WHERE run_id IN ({old})", (cutoff,))
+        self.store.write(f"DELETE FROM run_keywords WHERE run_id IN ({old})", (cutoff,))
+        self.store.write("DELETE FROM runs WHERE status NOT IN ('active', 'stopped') AND created_at < ?", (cutoff,))
+    
+    def close(self):
+        self.store.close()
+
 # ============================================================================
 # BATCH DOWNLOADER
 # ============================================================================
 
-class BatchDownloader:
-    def __init__(self, source_manager, download_folder, quota_manager=None, duplicate_detector=None):
-        self.source_manager = source_manager
-        self.download_folder = download_folder
-        self.quota_manager = quota_manager
-        self.duplicate_detector = duplicate_detector
-        self.is_downloading = False
-        self.progress_callback = None
-        self.complete_callback = None
-        self.stop_event = threading.Event()
+class BatchDownloader:
+    def __init__(self, source_manager, download_folder, quota_manager=None, duplicate_detector=None,
+                 workers=4, rate_limit=2.0, engine=None, job_queue=None, prefilter=None, thumbnail_check=False,
+                 thumbnail_cache=None):
+        self.source_manager = source_manager
+        self.download_folder = download_folder
+        self.quota_manager = quota_manager
+        self.duplicate_detector = duplicate_detector
+        self.workers = max(1, workers)
+        self.rate_limiter = TokenBucket(rate_limit)
+        self.transport = HttpTransport(pool_size=self.workers)
+        # Optional AsyncDownloadEngine; transfers then run on its event loop instead of the pool
+        self.engine = engine
+        # Optional DownloadJobQueue; download_all then persists and resumes its work
+        self.job_queue = job_queue
+        self.completed_keywords = []
+        # Files saved by the running batch, held back from quota eviction until it ends
+        self.held_paths = []
+        self.prefilter = prefilter
+        # Fetch thumbs.small first and skip the full image if its thumbnail is already known
+        self.thumbnail_check = thumbnail_check
+        self.thumbnail_cache = thumbnail_cache
+        self.is_downloading = False
+        self.progress_callback = None
+        self.complete_callback = None
+        self.stop_event = threading.Event()
+        self.quota_full = threading.Event()
+        # Duplicate check, move and index must be atomic across workers
+        self.index_lock = threading.Lock()
+        self.last_run_stats = {}
+    
+    def _download_image(self, keyword, img, fetched=None):
+        """Download one search result; returns (status, path) with status ok/duplicate/quota/stopped/error.
+
+        With the async engine the transfer has already happened and fetched
+        is its finished future; only dedup, move and indexing run here.
+        """
+        if fetched is None:
+            if self.stop_event.is_set():
+                return "stopped", None
+            if self.quota_full.is_set():
+                return "quota", None
+        
+        temp_path = None
+        try:
+            file_ext = os.path.splitext(img['download_url'])[1] or '.jpg'
+            if fetched is not None:
+                result = fetched.result()
+                if result is None:
+                    return ("quota" if self.quota_full.is_set() else "stopped"), None
+                temp_path, size, digest = result
+            else:
+                if not self.rate_limiter.acquire(stop_event=self.stop_event):
+                    return "stopped", None
+                
+                # Stream into a temp file in the download folder; quota is checked against Content-Length
+                temp_path, size, digest = download_to_temp(self.transport, img['download_url'], self.download_folder,
+                                                           self.quota_manager, stop_event=self.stop_event)
+            
+            # Byte-identical re-downloads are rejected on the streamed digest, without decoding
+            if self.duplicate_detector and self.duplicate_detector.enabled:
+                with self.index_lock:
+                    existing = self.duplicate_detector.find_exact(temp_path, size, digest)
+                if existing:
+                    os.remove(temp_path)
+                    if self.progress_callback:
+                        self.progress_callback(f"Skipped duplicate: {img['id']}")
+                    return "duplicate", None
+            
+            # One decode yields validation, dimensions and phash for both dedup and indexing
+            record = None
+            if self.duplicate_detector:
+                record = self.duplicate_detector.analyze(temp_path)
+                if not record[1]:
+                    os.remove(temp_path)
+                    return "error", None
+            
+            with self.index_lock:
+                # Check for duplicates
+                if self.duplicate_detector and self.duplicate_detector.enabled:
+                    # find_exact already ran above; identical bytes racing in meanwhile share a phash
+                    is_dup, existing = self.duplicate_detector.check_before_download(temp_path, record, digest,
+                                                                                     exact_checked=True)
+                    if is_dup:
+                        os.unlink(temp_path)
+                        if self.progress_callback:
+                            self.progress_callback(f"Skipped duplicate: {img['id']}")
+                        return "duplicate", None
+                
+                # Save final file
+                filename = f"{keyword}_{img['source']}_{img['id']}{file_ext}"
+                save_path = os.path.join(self.download_folder, filename)
+                if self.quota_manager:
+                    # Concurrent transfers may evict; not files from this batch
+                    self.quota_manager.hold(save_path)
+                    self.held_paths.append(save_path)
+                os.replace(temp_path, save_path)
+                if self.quota_manager:
+                    self.quota_manager.commit(temp_path, size)
+                
+                # Index in duplicate detector
+                if self.duplicate_detector and self.duplicate_detector.enabled:
+                    self.duplicate_detector.index_image(save_path, record, digest)
+            
+            if self.thumbnail_cache:
+                self.thumbnail_cache.request(save_path)
+            return "ok", save_path
+        except QuotaExceededError:
+            self.quota_full.set()
+            return "quota", None
+        except DownloadInterrupted:
+            return "stopped", None
+        except Exception as e:
+            print(f"Error downloading: {e}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return "error", None
+        finally:
+            # No-op after a commit; frees the space of a rejected or failed file
+            if temp_path and self.quota_manager:
+                self.quota_manager.release(temp_path)
+    
+    def _search(self, keyword, count):
+        """Search results for a keyword, or None if the search failed"""
+        try:
+            images = self.source_manager.search(keyword, count * 2)
+        except Exception as e:
+            print(f"Error downloading keyword {keyword}: {e}")
+            return None
+        if images is None:
+            return None
+        
+        # Drop known, oversized and off-filter results before fetching anything
+        if self.prefilter:
+            total = len(images)
+            images = self.prefilter.filter(images)
+            if total > len(images) and self.progress_callback:
+                reasons = ", ".join(f"{n} {reason}" for reason, n in self.prefilter.last_rejected.items())
+                self.progress_callback(f"'{keyword}': skipped {total - len(images)} before download ({reasons})")
+        return images[:count]
+    
+    def _check_thumbnails(self, jobs):
+        """Split jobs into (novel, thumbnail_duplicates) by hashing each result's small thumbnail"""
+        detector = self.duplicate_detector
+        
+        def is_duplicate(job):
+            if self.stop_event.is_set():
+                return False
+            thumbnail = fetch_thumbnail(self.transport, job[2].get('thumb_url'))
+            return bool(thumbnail) and detector.check_thumbnail(thumbnail)[0]
+        
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            flags = list(pool.map(is_duplicate, jobs))
+        novel = [job for job, duplicate in zip(jobs, flags) if not duplicate]
+        duplicates = [job for job, duplicate in zip(jobs, flags) if duplicate]
+        return novel, duplicates
+    
+    def _run(self, jobs):
+        """Download (job_id, keyword, image) jobs on the worker pool.
+
+        job_id is None unless the jobs came from the job queue, which is then
+        told how each one ended. Returns ({keyword: [paths]},
+        {keyword: skipped_duplicates}, {keyword: unfinished}).
+        """
+        results = {}
+        skipped = {}
+        unfinished = {}
+        
+        if self.thumbnail_check and self.duplicate_detector and self.duplicate_detector.enabled:
+            jobs, duplicates = self._check_thumbnails(jobs)
+            for job_id, keyword, img in duplicates:
+                if job_id is not None and self.job_queue:
+                    self.job_queue.finish(job_id, "duplicate")
+                skipped[keyword] = skipped.get(keyword, 0) + 1
+                if self.progress_callback:
+                    self.progress_callback(f"Skipped duplicate (thumbnail): {img['id']}")
+        
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            if self.engine:
+                # All transfers are in flight at once on the engine; the pool only post-processes
+                cancelled = lambda: self.stop_event.is_set() or self.quota_full.is_set()
+                fetches = {
+                    self.engine.submit(self.engine.download_to_temp(
+                        img['download_url'], self.download_folder, self.quota_manager, self.rate_limiter, cancelled
+                    )): (job_id, keyword, img)
+                    for job_id, keyword, img in jobs
+                }
+                futures = {}
+                for fetch in as_completed(fetches):
+                    job_id, keyword, img = fetches[fetch]
+                    futures[pool.submit(self._download_image, keyword, img, fetch)] = (job_id, keyword)
+            else:
+                futures = {pool.submit(self._download_image, keyword, img): (job_id, keyword)
+                           for job_id, keyword, img in jobs}
+            for future in as_completed(futures):
+                job_id, keyword = futures[future]
+                status, path = future.result()
+                if job_id is not None and self.job_queue:
+                    self.job_queue.finish(job_id, status, path)
+                if status == "ok":
+                    results.setdefault(keyword, []).append(path)
+                    if self.progress_callback:
+                        self.progress_callback(f"Downloaded {os.path.basename(path)}")
+                elif status == "duplicate":
+                    skipped[keyword] = skipped.get(keyword, 0) + 1
+                else:
+                    unfinished[keyword] = unfinished.get(keyword, 0) + 1
+        
+        return results, skipped, unfinished
+    
+    def _record_stats(self, results, started):
+        elapsed = time.monotonic() - started
+        paths = [path for keyword_paths in results.values() for path in keyword_paths]
+        downloaded_bytes = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+        self.last_run_stats = {
+            "images": len(paths),
+            "bytes": downloaded_bytes,
+            "seconds": elapsed,
+            "images_per_second": len(paths) / elapsed if elapsed else 0.0,
+            "mb_per_second": downloaded_bytes / (1024 * 1024) / elapsed if elapsed else 0.0
+        }
+    
+    def _search_all(self, keywords, per_keyword):
+        """Search every keyword in parallel; returns [(keyword, images or None)]"""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(lambda kw: (kw, self._search(kw, per_keyword)), keywords))
+    
+    def _release_held(self):
+        if self.quota_manager and self.held_paths:
+            self.quota_manager.unhold(self.held_paths)
+        self.held_paths = []
+    
+    def download_keyword(self, keyword, count=10):
+        self.quota_full.clear()
+        started = time.monotonic()
+        try:
+            results, skipped, unfinished = self._run([(None, keyword, img) for img in self._search(keyword, count) or []])
+        finally:
+            self._release_held()
+        self._record_stats(results, started)
+        return results.get(keyword, []), skipped.get(keyword, 0)
+    
+    def _download_queued(self, keywords, per_keyword):
+        """Finish an interrupted batch, then run the requested one; returns (keywords, results, skipped)"""
+        job_queue = self.job_queue
+        results = {}
+        skipped = {}
+        self.completed_keywords = []
+        run_keywords = []
+        
+        unfinished = job_queue.unfinished_run()
+        if unfinished:
+            run_id, run_per_keyword = unfinished
+            run_keywords = job_queue.run_keywords(run_id)
+            if self.progress_callback:
+                self.progress_callback(f"Resuming interrupted batch of {len(run_keywords)} keywords...")
+            already_completed = set(job_queue.completed_keywords(run_id))
+            status = self._drive_run(run_id, run_per_keyword, results, skipped)
+            # Keywords finished by an earlier attempt were reported then
+            self.completed_keywords.extend(kw for kw in job_queue.completed_keywords(run_id)
+                                           if kw not in already_completed)
+            
+            keywords = [kw for kw in keywords if kw not in run_keywords]
+            if keywords and status == 'stopped':
+                # Stopped or out of quota: keep the request so it runs when this batch resumes
+                job_queue.add_keywords(run_id, keywords)
+                return run_keywords, results, skipped
+        
+        if keywords:
+            run_id = job_queue.start_run(keywords, per_keyword)
+            self._drive_run(run_id, per_keyword, results, skipped)
+            self.completed_keywords.extend(job_queue.completed_keywords(run_id))
+        return run_keywords + keywords, results, skipped
+    
+    def _drive_run(self, run_id, per_keyword, results, skipped):
+        """Search a run's pending keywords and download its queued jobs; returns the run's new status"""
+        job_queue = self.job_queue
+        job_queue.set_run_status(run_id, 'active')
+        
+        pending = job_queue.pending_keywords(run_id)
+        if pending:
+            if self.progress_callback:
+                self.progress_callback(f"Searching {len(pending)} keywords...")
+            for keyword, images in self._search_all(pending, per_keyword):
+                if images is not None:
+                    job_queue.add_jobs(run_id, keyword, images)
+                else:
+                    job_queue.search_failed(run_id, keyword)
+        
+        claim_size = max(self.workers, self.engine.concurrency if self.engine else 0) * 4
+        while not self.stop_event.is_set() and not self.quota_full.is_set():
+            jobs = job_queue.claim(run_id, claim_size)
+            if not jobs:
+                break
+            batch_results, batch_skipped, _ = self._run(jobs)
+            for keyword, paths in batch_results.items():
+                results.setdefault(keyword, []).extend(paths)
+            for keyword, count in batch_skipped.items():
+                skipped[keyword] = skipped.get(keyword, 0) + count
+        
+        if self.stop_event.is_set() or self.quota_full.is_set():
+            status = 'stopped'
+        elif job_queue.pending_keywords(run_id):
+            # A search failed; keep the run active so the next start retries it
+            status = 'active'
+        else:
+            status = 'complete'
+        job_queue.set_run_status(run_id, status)
+        return status
+    
+    def download_all(self, keywords, per_keyword=10):
+        if not keywords and not (self.job_queue and self.job_queue.unfinished_run()):
+            if self.progress_callback:
+                self.progress_callback("No keywords to download")
+            return {}
+        
+        self.is_downloading = True
+        self.stop_event.clear()
+        self.quota_full.clear()
+        self.completed_keywords = []
+        started = time.monotonic()
+        
+        try:
+            if self.job_queue:
+                keywords, results, skipped = self._download_queued(keywords, per_keyword)
+            else:
+                if self.progress_callback:
+                    self.progress_callback(f"Searching {len(keywords)} keywords...")
+                
+                # Search every keyword up front, then download across keywords in parallel
+                jobs = []
+                searched = set()
+                for keyword, images in self._search_all(keywords, per_keyword):
+                    if images is not None:
+                        searched.add(keyword)
+                        jobs.extend((None, keyword, img) for img in images)
+                
+                results, skipped, unfinished = self._run(jobs)
+                self.completed_keywords = [kw for kw in keywords if kw in searched and not unfinished.get(kw)]
+        finally:
+            self._release_held()
+        
+        self._record_stats(results, started)
+        all_results = {keyword: results.get(keyword, []) for keyword in keywords}
+        total_skipped = sum(skipped.values())
+        
+        if self.progress_callback:
+            for keyword in keywords:
+                self.progress_callback(f"Downloaded {len(all_results[keyword])} for '{keyword}' (skipped {skipped.get(keyword, 0)})")
+        
+        self.is_downloading = False
+        
+        if self.complete_callback:
+            self.complete_callback(all_results, total_skipped)
+        
+        return all_results
+    
+    def stop_download(self):
+        self.stop_event.set()
+        self.is_downloading = False
+
+# ============================================================================
+# PREFETCHER
+# ============================================================================
+
+class Prefetcher:
+    """Keeps the next few remote wallpapers downloaded, validated and hashed.
+
+    Files are staged in a hidden folder inside the download folder, so they
+    stay out of the library and the quota until pop() hands one out, and
+    promoting one is a same-volume rename. A background thread refills the
+    ready queue whenever an item is taken.
+    """
+    
+    STAGING_DIR = ".prefetch"
+    
+    def __init__(self, search, download_folder, quota_manager=None, depth=3, max_staging_mb=100,
+                 retry_interval=60):
+        self.search = search  # callable returning a list of Wallhaven search results
+        self.staging_folder = os.path.join(download_folder, self.STAGING_DIR)
+        self.quota_manager = quota_manager
+        self.duplicate_detector = None
+        self.prefilter = None
+        self.thumbnail_check = False
+        self.depth = max(1, depth)
+        self.max_staging_bytes = max_staging_mb * 1024 * 1024
+        self.retry_interval = retry_interval
+        self.transport = HttpTransport(pool_size=2)
+        self.ready = []
+        self.candidates = []
+        self.staged_ids = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self._clear_staging()
+        self.thread = threading.Thread(target=self._refill_loop, daemon=True)
+        self.thread.start()
+    
+    def _clear_staging(self):
+        """Drop files staged by a previous run; their records were not kept.
+
+        Interrupted transfers are left for download_to_temp to resume.
+        """
+        with self.lock:
+            self.ready = []
+            self.staged_ids = set()
+        if not os.path.isdir(self.staging_folder):
+            return
+        clean_partial_downloads(self.staging_folder)
+        for entry in os.scandir(self.staging_folder):
+            if '.part' in entry.name:
+                continue
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    
+    def staged_bytes(self):
+        with self.lock:
+            return sum(item['size'] for item in self.ready)
+    
+    def _next_candidate(self):
+        if not self.candidates:
+            self.candidates = list(self.search() or [])
+            if self.prefilter:
+                self.candidates = self.prefilter.filter(self.candidates)
+            random.shuffle(self.candidates)
+        while self.candidates:
+            candidate = self.candidates.pop()
+            with self.lock:
+                if candidate['id'] in self.staged_ids:
+                    continue
+            return candidate
+        return None
+    
+    def _refill_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                # Bounded so a run of duplicates cannot keep the thread searching
+                attempts = self.depth * 4
+                while (attempts and len(self.ready) < self.depth and self.staged_bytes() < self.max_staging_bytes
+                       and not self.stop_event.is_set()):
+                    attempts -= 1
+                    candidate = self._next_candidate()
+                    if candidate is None:
+                        break
+                    self._stage(candidate)
+            except Exception as e:
+                print(f"Prefetch error: {e}")
+            
+            # Sleep until something is taken, or retry a failed refill later
+            self.wake.wait(self.retry_interval if len(self.ready) < self.depth else None)
+            self.wake.clear()
+    
+    def _stage(self, candidate):
+        """Download, validate and hash one search result into the staging folder"""
+        detector = self.duplicate_detector
+        if self.thumbnail_check and detector and detector.enabled:
+            thumbnail = fetch_thumbnail(self.transport, candidate.get('thumbs', {}).get('small'))
+            if thumbnail and detector.check_thumbnail(thumbnail)[0]:
+                return False
+        
+        temp_path, size, digest = download_to_temp(self.transport, candidate['path'], self.staging_folder,
+                                                   stop_event=self.stop_event)
+        try:
+            if detector and detector.enabled and detector.find_exact(temp_path, size, digest):
+                os.remove(temp_path)
+                return False
+            
+            record = detector.analyze(temp_path) if detector else compute_image_record(temp_path)
+            if not record[1]:
+                os.remove(temp_path)
+                return False
+            
+            if detector and detector.enabled and detector.check_before_download(temp_path, record, digest,
+                                                                                exact_checked=True)[0]:
+                os.remove(temp_path)
+                return False
+            
+            file_ext = os.path.splitext(candidate['path'])[1] or '.jpg'
+            filename = f"wallhaven_{candidate['id']}{file_ext}"
+            staged_path = os.path.join(self.staging_folder, filename)
+            os.replace(temp_path, staged_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        
+        with self.lock:
+            self.ready.append({
+                'id': candidate['id'],
+                'path': staged_path,
+                'filename': filename,
+                'size': size,
+                'digest': digest,
+                'record': (staged_path,) + tuple(record[1:])
+            })
+            self.staged_ids.add(candidate['id'])
+        return True
+    
+    def pop(self):
+        """Take the next ready item (or None) and schedule a refill"""
+        with self.lock:
+            item = self.ready.pop(0) if self.ready else None
+            if item:
+                self.staged_ids.discard(item['id'])
+        self.wake.set()
+        if item and not os.path.exists(item['path']):
+            return None
+        return item
+    
+    def promote(self, item, download_folder):
+        """Move a popped item into the download folder; returns the final path or None"""
+        if self.quota_manager and not self.quota_manager.make_room(item['size'] / (1024 * 1024),
+                                                                    reserve_for=item['path']):
+            os.remove(item['path'])
+            return None
+        
+        save_path = os.path.join(download_folder, item['filename'])
+        previous_size = os.path.getsize(save_path) if os.path.exists(save_path) else 0
+        try:
+            os.replace(item['path'], save_path)
+        except OSError:
+            if self.quota_manager:
+                self.quota_manager.release(item['path'])
+            raise
+        if self.quota_manager:
+            self.quota_manager.commit(item['path'], item['size'] - previous_size)
+        return save_path
+    
+    def close(self):
+        self.stop_event.set()
+        self.wake.set()
+
+# ============================================================================
+# THUMBNAIL CACHE
+# ============================================================================
+
+class ThumbnailCache:
+    """Small JPEG previews on disk, keyed by source path, mtime and size.
+
+    A changed file gets a new key, so stale previews are never served; they
+    age out through eviction, which drops the least recently used files
+    once the folder grows past max_mb. Thumbnails are generated on a single
+    background thread so the UI never decodes a full-size wallpaper.
+    """
+    
+    def __init__(self, folder, size=(300, 200), max_mb=50, quality=85):
+        self.folder = folder
+        self.size = size
+        self.max_bytes = max_mb * 1024 * 1024
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(folder, exist_ok=True)
+        self.used_bytes = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+    
+    def _key_path(self, image_path):
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return None
+        key = f"{os.path.abspath(image_path)}|{st.st_mtime_ns}|{st.st_size}|{self.size[0]}x{self.size[1]}"
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + ".jpg")
+    
+    def get(self, image_path):
+        """Cached thumbnail path for image_path, or None if it has not been generated"""
+        cached = self._key_path(image_path)
+        if cached and os.path.exists(cached):
+            try:
+                os.utime(cached)  # mtime doubles as the LRU timestamp
+            except OSError:
+                pass
+            return cached
+        return None
+    
+    def _generate(self, image_path):
+        cached = self._key_path(image_path)
+        if not cached:
+            return None
+        if os.path.exists(cached):
+            return cached
+        
+        with Image.open(image_path) as img:
+            img.draft('RGB', self.size)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.thumbnail(self.size)
+            temp = cached + '.tmp'
+            img.save(temp, 'JPEG', quality=self.quality)
+        os.replace(temp, cached)
+        
+        with self.lock:
+            self.used_bytes += os.path.getsize(cached)
+            over = self.used_bytes > self.max_bytes
+        if over:
+            self._evict()
+        return cached
+    
+    def _run(self, image_path):
+        try:
+            return self._generate(image_path)
+        except Exception as e:
+            print(f"Thumbnail error for {image_path}: {e}")
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(image_path, None)
+    
+    def request(self, image_path):
+        """Generate a thumbnail in the background; returns a future resolving to its path or None"""
+        with self.lock:
+            future = self.pending.get(image_path)
+            if future is None:
+                future = self.executor.submit(self._run, image_path)
+                self.pending[image_path] = future
+        return future
+    
+    def _evict(self):
+        used = evict_lru_files(self.folder, self.max_bytes)
+        with self.lock:
+            self.used_bytes = used
+    
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def evict_lru_files(folder, max_bytes):
+    """Delete least recently used files (by mtime) down to 90% of max_bytes; returns bytes left"""
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    entries.sort()
+    
+    used = sum(size for _, size, _ in entries)
+    target = max_bytes * 0.9
+    for _, size, path in entries:
+        if used <= target:
+            break
+        try:
+            os.remove(path)
+            used -= size
+        except OSError:
+            pass
+    return used
+
+# ============================================================================
+# WALLPAPER RENDERER
+# ============================================================================
+
+def detect_screen_size(span=False):
+    """Primary monitor size, or the whole virtual desktop with span=True; None if unknown"""
+    if sys.platform != 'win32':
+        return None
+    try:
+        user32 = ctypes.windll.user32
+        user32.SetProcessDPIAware()
+        if span:
+            size = (user32.GetSystemMetrics(78), user32.GetSystemMetrics(79))  # SM_CX/CYVIRTUALSCREEN
+        else:
+            size = (user32.GetSystemMetrics(0), user32.GetSystemMetrics(1))
+        return size if size[0] > 0 and size[1] > 0 else None
+    except Exception:
+        return None
+
+class WallpaperRenderer:
+    """Pre-renders wallpapers to the exact target resolution as cached JPEGs.
+
+    The desktop then shows a screen-sized image as-is instead of decoding and
+    rescaling the original on every change. Renders are keyed by source path,
+    mtime, size, style and target, and the cache is bounded like
+    ThumbnailCache. Nothing here touches the OS, so target sizes can be
+    passed explicitly.
+    """
+    
+    STYLES = ("fill", "fit", "stretch", "center", "span")
+    
+    def __init__(self, folder, max_mb=200, quality=90, background=(0, 0, 0)):
+        self.folder = folder
+        self.max_bytes = max_mb * 1024 * 1024
+        self.quality = quality
+        self.background = background
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.used_bytes = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+    
+    def _key_path(self, image_path, style, target):
+        st = os.stat(image_path)
+        key = f"{os.path.abspath(image_path)}|{st.st_mtime_ns}|{st.st_size}|{style}|{target[0]}x{target[1]}"
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + ".jpg")
+    
+    def _scale(self, size, style, target):
+        """Scale factor from source to output, or None for a non-uniform stretch"""
+        sx, sy = target[0] / size[0], target[1] / size[1]
+        if style in ("fill", "span"):
+            return max(sx, sy)
+        if style == "fit":
+            return min(sx, sy)
+        if style == "center":
+            return 1.0
+        return None
+    
+    def _compose(self, img, style, target):
+        scale = self._scale(img.size, style, target)
+        
+        # Let the JPEG decoder downscale by a power of two while staying above the output size
+        if scale is None:
+            img.draft('RGB', target)
+        elif scale < 1:
+            img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        if scale is None:
+            return img.resize(target, Image.LANCZOS)
+        
+        scale = self._scale(img.size, style, target)  # draft may have changed the size
+        if scale != 1.0:
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+        
+        canvas = Image.new('RGB', target, self.background)
+        # Negative offsets crop the overflow evenly for fill, span and center
+        canvas.paste(img, ((target[0] - img.width) // 2, (target[1] - img.height) // 2))
+        return canvas
+    
+    def render(self, image_path, style, target):
+        """Path of image_path rendered for a target (width, height) screen, or None for unsupported styles"""
+        if style not in self.STYLES:
+            return None
+        
+        cached = self._key_path(image_path, style, target)
+        if os.path.exists(cached):
+            try:
+                os.utime(cached)
+            except OSError:
+                pass
+            return cached
+        
+        with Image.open(image_path) as img:
+            output = self._compose(img, style, target)
+        temp = cached + '.tmp'
+        output.save(temp, 'JPEG', quality=self.quality)
+        os.replace(temp, cached)
+        
+        with self.lock:
+            self.used_bytes += os.path.getsize(cached)
+            over = self.used_bytes > self.max_bytes
+        if over:
+            used = evict_lru_files(self.folder, self.max_bytes)
+            with self.lock:
+                self.used_bytes = used
+        return cached
+
+# ============================================================================
+# WALLPAPER SETTERS
+# ============================================================================
+
+class WallpaperSetter(ABC):
+    """Applies a wallpaper file and display style to the desktop.
+
+    set_wallpaper returns True if the desktop accepted the file.
+    """
+    
+    name = "base"
+    
+    def set_style(self, style):
+        pass
+    
+    @abstractmethod
+    def set_wallpaper(self, path) -> bool:
+        """Show path on the desktop; returns True on success"""
+
+class WindowsWallpaperSetter(WallpaperSetter):
+    """Registry style values plus SystemParametersInfoW(SPI_SETDESKWALLPAPER)"""
+    
+    name = "windows"
+    STYLE_VALUES = {
+        'fill': ('10', '0'), 'fit': ('6', '0'), 'stretch': ('2', '0'),
+        'tile': ('0', '1'), 'center': ('0', '0'), 'span': ('22', '0')
+    }
+    
+    def set_style(self, style):
+        try:
+            key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Control Panel\\Desktop", 0, winreg.KEY_SET_VALUE)
+            if style in self.STYLE_VALUES:
+                wallpaper_style, tile_wallpaper = self.STYLE_VALUES[style]
+                winreg.SetValueEx(key, "WallpaperStyle", 0, winreg.REG_SZ, wallpaper_style)
+                winreg.SetValueEx(key, "TileWallpaper", 0, winreg.REG_SZ, tile_wallpaper)
+            winreg.CloseKey(key)
+        except:
+            pass
+    
+    def set_wallpaper(self, path) -> bool:
+        # SPIF_UPDATEINIFILE | SPIF_SENDCHANGE
+        return bool(ctypes.windll.user32.SystemParametersInfoW(20, 0, path, 3))
+
+class GnomeWallpaperSetter(WallpaperSetter):
+    """GNOME and derivatives through gsettings"""
+    
+    name = "gnome"
+    SCHEMA = "org.gnome.desktop.background"
+    STYLE_VALUES = {
+        'fill': 'zoom', 'fit': 'scaled', 'stretch': 'stretched',
+        'tile': 'wallpaper', 'center': 'centered', 'span': 'spanned'
+    }
+    
+    def _gsettings(self, key, value) -> bool:
+        try:
+            subprocess.run(["gsettings", "set", self.SCHEMA, key, value],
+                           check=True, capture_output=True, timeout=10)
+            return True
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"gsettings {key} failed: {e}")
+            return False
+    
+    def set_style(self, style):
+        if style in self.STYLE_VALUES:
+            self._gsettings("picture-options", self.STYLE_VALUES[style])
+    
+    def set_wallpaper(self, path) -> bool:
+        # Percent-encodes spaces, '#' and non-ASCII names as GNOME expects
+        uri = Path(os.path.abspath(path)).as_uri()
+        ok = self._gsettings("picture-uri", uri)
+        # GNOME 42+ reads a separate key in dark mode; older versions reject it
+        self._gsettings("picture-uri-dark", uri)
+        return ok
+
+class FehWallpaperSetter(WallpaperSetter):
+    """Plain X11 window managers through feh"""
     
-    def download_keyword(self, keyword, count=10):
-        results = []
-        skipped = 0
-        
+    name = "feh"
+    STYLE_FLAGS = {
+        'fill': ['--bg-fill'], 'fit': ['--bg-max'], 'stretch': ['--bg-scale'],
+        'tile': ['--bg-tile'], 'center': ['--bg-center'], 'span': ['--no-xinerama', '--bg-fill']
+    }
+    
+    def __init__(self):
+        self.flags = self.STYLE_FLAGS['fill']
+    
+    def set_style(self, style):
+        self.flags = self.STYLE_FLAGS.get(style, self.flags)
+    
+    def set_wallpaper(self, path) -> bool:
         try:
-            images = self.source_manager.search(keyword, count * 2)
-            
-            for img in images[:count]:
-                if self.stop_event.is_set():
-                    break
-                
-                try:
-                    if self.quota_manager and not self.quota_manager.can_download(5):
-                        break
-                    
-                    # Download to temp file first
-                    response = requests.get(img['download_url'], timeout=30)
-                    file_ext = os.path.splitext(img['download_url'])[1] or '.jpg'
-                    
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-                        tmp_file.write(response.content)
-                        temp_path = tmp_file.name
-                    
-                    # Check for duplicates
-                    if self.duplicate_detector and self.duplicate_detector.enabled:
-                        is_dup, existing = self.duplicate_detector.check_before_download(temp_path)
-                        if is_dup:
-                            os.unlink(temp_path)
-                            skipped += 1
-                            if self.progress_callback:
-                                self.progress_callback(f"Skipped duplicate: {img['id']}")
-                            continue
-                    
-                    # Save final file
-                    filename = f"{keyword}_{img['source']}_{img['id']}{file_ext}"
-                    save_path = os.path.join(self.download_folder, filename)
-                    shutil.move(temp_path, save_path)
-                    
-                    # Index in duplicate detector
-                    if self.duplicate_detector and self.duplicate_detector.enabled:
-                        self.duplicate_detector.index_image(save_path)
-                    
-                    results.append(save_path)
-                    time.sleep(0.5)
-                    
-                except Exception as e:
-                    print(f"Error downloading: {e}")
-            
-        except Exception as e:
-            print(f"Error downloading keyword {keyword}: {e}")
-        
-        return results, skipped
+            subprocess.run(["feh", *self.flags, path], check=True, capture_output=True, timeout=10)
+            return True
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"feh failed: {e}")
+            return False
+
+class NullWallpaperSetter(WallpaperSetter):
+    """Changes nothing and records every call; for headless runs and benchmarks"""
     
-    def download_all(self, keywords, per_keyword=10):
-        if not keywords:
-            if self.progress_callback:
-                self.progress_callback("No keywords to download")
-            return {}
-        
-        self.is_downloading = True
-        self.stop_event.clear()
-        all_results = {}
-        total_skipped = 0
-        
-        for keyword in keywords:
-            if self.stop_event.is_set():
-                break
-            
-            if self.progress_callback:
-                self.progress_callback(f"Starting: {keyword}")
-            
-            results, skipped = self.download_keyword(keyword, per_keyword)
-            all_results[keyword] = results
-            total_skipped += skipped
-            
-            if self.progress_callback:
-                self.progress_callback(f"Downloaded {len(results)} for '{keyword}' (skipped {skipped})")
-        
-        self.is_downloading = False
-        
-        if self.complete_callback:
-            self.complete_callback(all_results, total_skipped)
-        
-        return all_results
+    name = "null"
     
-    def stop_download(self):
-        self.stop_event.set()
-        self.is_downloading = False
+    def __init__(self):
+        self.style = None
+        self.history = []
+    
+    def set_style(self, style):
+        self.style = style
+    
+    def set_wallpaper(self, path) -> bool:
+        self.history.append((path, self.style))
+        return True
+
+WALLPAPER_SETTERS = {
+    "windows": WindowsWallpaperSetter,
+    "gnome": GnomeWallpaperSetter,
+    "feh": FehWallpaperSetter,
+    "null": NullWallpaperSetter,
+}
+
+def create_wallpaper_setter(name="auto"):
+    """Setter by name; "auto" picks one for the current platform and desktop"""
+    if name in WALLPAPER_SETTERS:
+        return WALLPAPER_SETTERS[name]()
+    if sys.platform == 'win32':
+        return WindowsWallpaperSetter()
+    if shutil.which("gsettings") and os.environ.get("XDG_CURRENT_DESKTOP"):
+        return GnomeWallpaperSetter()
+    if shutil.which("feh") and os.environ.get("DISPLAY"):
+        return FehWallpaperSetter()
+    print("ℹ️ No desktop found to set wallpapers on - changes will only be recorded")
+    return NullWallpaperSetter()
 
 # ============================================================================
 # WALLPAPER CHANGER CORE
 # ============================================================================
 
 class WallpaperChanger:
-    def __init__(self, config=None, app=None):
+    def __init__(self, config=None, app=None, setter=None):
         self.app = app
         self.config = config or self.load_config()
         self.paused = False
+        self.setter = setter or create_wallpaper_setter(self.config.get("wallpaper_setter", "auto"))
         
         if not self.config.get("download_folder"):
             self.config["download_folder"] = WALLHAVEN_FOLDER
         
         # Get API key securely
         api_key = SecureConfig.get_api_key(self.config)
-        self.api = WallhavenAPI(api_key)
+        self.search_cache = None
+        if self.config.get("search_cache_ttl", 3600) > 0:
+            self.search_cache = SearchCache(
+                SEARCH_CACHE_FILE,
+                self.config.get("search_cache_ttl", 3600),
+                self.config.get("search_cache_entries", 200)
+            )
+        self.transport = HttpTransport(
+            pool_size=self.config.get("http_pool_size", 10),
+            timeout=self.config.get("http_timeout", 30),
+            max_retries=self.config.get("http_max_retries", 4)
+        )
+        WallhavenAPI.limiter.max_requests = self.config.get("api_rate_limit", 45)
+        self.api = WallhavenAPI(api_key, self.search_cache, self.transport)
+        self.download_engine = None
+        if self.config.get("download_backend", "threads") == "async":
+            if HAS_HTTPX:
+                self.download_engine = AsyncDownloadEngine(
+                    self.config.get("async_concurrency", 50),
+                    timeout=self.config.get("http_timeout", 30),
+                    max_retries=self.config.get("http_max_retries", 4)
+                )
+            else:
+                print("ℹ️ httpx not installed - using threaded downloads")
         self.db = FavoritesDatabase()
+        self.validator = WallpaperValidator()
+        self.library = LibraryIndex(LIBRARY_DB_FILE, self.validator.is_valid_image)
+        self.validator.library = self.library
         self.quota = QuotaManager(
             self.config["download_folder"],
+            self.library,
             self.config.get("quota_enabled", True),
-            self.config.get("quota_size", 1000)
+            self.config.get("quota_size", 1000),
+            eviction_policy=self.config.get("quota_eviction_policy") if self.config.get("quota_auto_evict", False) else None,
+            favorites_db=self.db
         )
-        self.favorites_folder_manager = FavoritesFolderManager(self.config)
-        self.validator = WallpaperValidator()
+        self.favorites_folder_manager = FavoritesFolderManager(self.config, self.library)
+        self.thumbnails = ThumbnailCache(THUMBNAIL_CACHE_FOLDER, max_mb=self.config.get("thumbnail_cache_mb", 50))
+        self.renderer = None
+        if self.config.get("render_enabled", False):
+            self.renderer = WallpaperRenderer(
+                RENDER_CACHE_FOLDER,
+                self.config.get("render_cache_mb", 200),
+                self.config.get("render_quality", 90)
+            )
+        self.prefilter = MetadataPrefilter(self.library, self.config["download_folder"], self.quota, self.config)
+        self.prefetcher = None
+        if self.config.get("prefetch_enabled", True):
+            self.prefetcher = Prefetcher(
+                self.search_random,
+                self.config["download_folder"],
+                self.quota,
+                self.config.get("prefetch_depth", 3),
+                self.config.get("prefetch_staging_mb", 100)
+            )
+            self.prefetcher.prefilter = self.prefilter
+            self.prefetcher.thumbnail_check = self.config.get("duplicate_thumbnail_check", True)
         self.running = False
         self.timer = None
         self.current_wallpaper = None
@@ -1026,14 +4295,30 @@ class WallpaperChanger:
         self.notification_callback = None
         self.duplicate_detector = None
         
-        os.makedirs(self.config["download_folder"], exist_ok=True)
+        self.library_ready = threading.Event()
         
-        if self.config.get("remember_last_wallpaper", True):
-            self.load_last_wallpaper()
+        os.makedirs(self.config["download_folder"], exist_ok=True)
         
+        if self.config.get("fast_start", True):
+            # Start from the index as last saved; the full refresh and cleanup run in the background
+            self.downloaded_wallpapers = list(self.library.list_files(self.config["download_folder"], ('.jpg', '.jpeg', '.png', '.gif')))
+            if self.config.get("remember_last_wallpaper", True):
+                self.load_last_wallpaper()
+            threading.Thread(target=self.load_library, daemon=True).start()
+        else:
+            if self.config.get("remember_last_wallpaper", True):
+                self.load_last_wallpaper()
+            self.load_library()
+    
+    def load_library(self):
+        clean_partial_downloads(self.config["download_folder"])
         self.scan_downloaded_wallpapers()
+        self.library_ready.set()
+        if self.app and getattr(self.app, 'root', None):
+            self.app.root.after(0, self.app.update_navigation_display)
     
-    def load_config(self):
+    @staticmethod
+    def load_config():
         if os.path.exists(CONFIG_FILE):
             try:
                 with open(CONFIG_FILE, 'r') as f:
@@ -1067,21 +4352,17 @@ class WallpaperChanger:
                 with open(LAST_WALLPAPER_FILE, 'r') as f:
                     data = json.load(f)
                     path = data.get('path', '')
-                    if os.path.exists(path) and self.validator.is_valid_image(path):
-                        self.set_wallpaper(path, data.get('id'), data.get('type', 'static'))
+                    if self.validator.validate(path):
+                        self.set_wallpaper(path, data.get('id'), data.get('type', 'static'), validated=True)
             except:
                 pass
     
     def scan_downloaded_wallpapers(self):
         folder = self.config["download_folder"]
-        self.downloaded_wallpapers = []
         
-        if os.path.exists(folder):
-            for file in sorted(os.listdir(folder)):
-                if file.endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                    full_path = os.path.join(folder, file)
-                    if self.validator.is_valid_image(full_path):
-                        self.downloaded_wallpapers.append(full_path)
+        # Only new or changed files are validated; the rest comes from the index
+        self.library.refresh(folder)
+        self.downloaded_wallpapers = list(self.library.list_files(folder, ('.jpg', '.jpeg', '.png', '.gif')))
         
         if self.current_wallpaper in self.downloaded_wallpapers:
             self.current_nav_index = self.downloaded_wallpapers.index(self.current_wallpaper)
@@ -1102,12 +4383,13 @@ class WallpaperChanger:
             # Remove from duplicate detector
             if self.duplicate_detector and self.duplicate_detector.enabled:
                 try:
-                    self.duplicate_detector.conn.execute("DELETE FROM image_hashes WHERE path = ?", (self.current_wallpaper,))
-                    self.duplicate_detector.conn.commit()
+                    self.duplicate_detector.remove_image(self.current_wallpaper)
                 except:
                     pass
             
+            file_size = os.path.getsize(self.current_wallpaper)
             os.remove(self.current_wallpaper)
+            self.quota.record_delete(file_size)
             
             if self.downloaded_wallpapers:
                 next_idx = min(self.current_nav_index, len(self.downloaded_wallpapers) - 1)
@@ -1136,28 +4418,26 @@ class WallpaperChanger:
             return False
         
         supported = (".jpg", ".jpeg", ".png", ".gif")
-        all_files = [f for f in os.listdir(folder) if f.lower().endswith(supported)]
+        self.library.refresh(folder)
+        all_files = self.library.list_files(folder, supported)
         
         if not all_files:
             return False
         
-        if avoid_current and self.current_wallpaper:
-            current_name = os.path.basename(self.current_wallpaper)
-            candidates = [f for f in all_files if f != current_name]
-            if not candidates:
-                candidates = all_files
-        else:
-            candidates = all_files
+        avoid = None
+        if avoid_current and self.current_wallpaper and len(all_files) > 1:
+            avoid = os.path.abspath(self.current_wallpaper)
         
         # Try up to 5 times to find a valid image
         for _ in range(5):
-            selected = random.choice(candidates)
-            full_path = os.path.join(folder, selected)
+            full_path = random.choice(all_files)
+            if full_path == avoid:
+                continue
             
-            if self.validator.is_valid_image(full_path):
-                file_type = "gif" if selected.lower().endswith('.gif') else "static"
+            if self.validator.validate(full_path):
+                file_type = "gif" if full_path.lower().endswith('.gif') else "static"
                 wallpaper_id = f"local_{int(time.time())}"
-                self.set_wallpaper(full_path, wallpaper_id, file_type)
+                self.set_wallpaper(full_path, wallpaper_id, file_type, validated=True)
                 return True
         
         return False
@@ -1167,9 +4447,9 @@ class WallpaperChanger:
             self.current_nav_index += 1
             path = self.downloaded_wallpapers[self.current_nav_index]
             
-            if self.validator.is_valid_image(path):
+            if self.validator.validate(path):
                 file_type = "gif" if path.lower().endswith('.gif') else "static"
-                self.set_wallpaper(path, f"local_{int(time.time())}", file_type)
+                self.set_wallpaper(path, f"local_{int(time.time())}", file_type, validated=True)
                 return True
         return False
     
@@ -1178,40 +4458,53 @@ class WallpaperChanger:
             self.current_nav_index -= 1
             path = self.downloaded_wallpapers[self.current_nav_index]
             
-            if self.validator.is_valid_image(path):
+            if self.validator.validate(path):
                 file_type = "gif" if path.lower().endswith('.gif') else "static"
-                self.set_wallpaper(path, f"local_{int(time.time())}", file_type)
+                self.set_wallpaper(path, f"local_{int(time.time())}", file_type, validated=True)
                 return True
         return False
     
     def set_wallpaper_style(self, style):
+        self.setter.set_style(style)
+    
+    def render_target(self, style):
+        target = self.config.get("render_target", "auto")
+        if target == "auto":
+            return detect_screen_size(span=(style == "span"))
+        return parse_dimensions(target)
+    
+    def render_for_screen(self, image_path, style, file_type="static"):
+        """Screen-sized rendered copy of image_path when rendering is on, else image_path"""
+        if not self.renderer or file_type == "gif":
+            return image_path
+        target = self.render_target(style)
+        if not target:
+            return image_path
         try:
-            key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Control Panel\\Desktop", 0, winreg.KEY_SET_VALUE)
-            style_values = {
-                'fill': ('10', '0'), 'fit': ('6', '0'), 'stretch': ('2', '0'),
-                'tile': ('0', '1'), 'center': ('0', '0'), 'span': ('22', '0')
-            }
-            if style in style_values:
-                wallpaper_style, tile_wallpaper = style_values[style]
-                winreg.SetValueEx(key, "WallpaperStyle", 0, winreg.REG_SZ, wallpaper_style)
-                winreg.SetValueEx(key, "TileWallpaper", 0, winreg.REG_SZ, tile_wallpaper)
-            winreg.CloseKey(key)
-        except:
-            pass
+            return self.renderer.render(image_path, style, target) or image_path
+        except Exception as e:
+            print(f"Render error for {image_path}: {e}")
+            return image_path
     
-    def set_wallpaper(self, image_path, wallpaper_id=None, file_type="static"):
-        # Validate image before setting
-        if not self.validator.is_valid_image(image_path):
+    def set_wallpaper(self, image_path, wallpaper_id=None, file_type="static", validated=False):
+        # Validate image before setting, unless the caller just decoded it
+        if not validated and not self.validator.validate(image_path):
             if self.app:
                 self.app.status_var.set("Invalid image file")
             return False
         
-        self.set_wallpaper_style(self.config.get("wallpaper_style", "fill"))
+        style = self.config.get("wallpaper_style", "fill")
+        self.set_wallpaper_style(style)
         
         image_path = os.path.abspath(image_path)
-        ctypes.windll.user32.SystemParametersInfoW(20, 0, image_path, 3)
+        shown_path = self.render_for_screen(image_path, style, file_type)
+        if not self.setter.set_wallpaper(shown_path):
+            if self.app:
+                self.app.status_var.set("Could not set wallpaper")
+            return False
         
         self.current_wallpaper = image_path
+        self.quota.protected_paths = {image_path}
         self.current_wallpaper_id = wallpaper_id
         self.current_wallpaper_type = file_type
         
@@ -1219,13 +4512,16 @@ class WallpaperChanger:
             self.current_nav_index = self.downloaded_wallpapers.index(image_path)
         
         if wallpaper_id and self.db.is_favorite(wallpaper_id):
-            self.db.record_use(wallpaper_id)
+            self.db.record_use(wallpaper_id, image_path)
+        else:
+            self.db.record_view(wallpaper_id, image_path)
         
-        try:
-            with open(LAST_WALLPAPER_FILE, 'w') as f:
-                json.dump({'path': image_path, 'id': wallpaper_id, 'type': file_type}, f)
-        except:
-            pass
+        if self.config.get("remember_last_wallpaper", True):
+            try:
+                with open(LAST_WALLPAPER_FILE, 'w') as f:
+                    json.dump({'path': image_path, 'id': wallpaper_id, 'type': file_type}, f)
+            except:
+                pass
         
         if self.config.get("notifications", True) and self.notification_callback:
             self.notification_callback("Wallpaper Changed", os.path.basename(image_path))
@@ -1237,6 +4533,8 @@ class WallpaperChanger:
             return
         self.running = True
         self.paused = False
+        if self.prefetcher:
+            self.prefetcher.start()
         self.auto_change_loop()
     
     def stop_auto_change(self):
@@ -1278,35 +4576,71 @@ class WallpaperChanger:
         self.timer.daemon = True
         self.timer.start()
     
+    def search_random(self):
+        images = self.api.search(page=random.randint(1, 5), sorting="random")
+        return images.get('data', []) if images else []
+    
     def change_wallpaper(self):
         try:
-            images = self.api.search(page=random.randint(1, 5), sorting="random")
-            if images and images.get('data'):
-                selected = random.choice(images['data'])
+            # Prefetched wallpapers are already downloaded, validated and hashed
+            if self.prefetcher:
+                item = self.prefetcher.pop()
+                if item and self.apply_prefetched(item):
+                    return True
+            
+            candidates = self.search_random()
+            if candidates:
+                selected = random.choice(candidates)
                 img_url = selected['path']
                 file_ext = os.path.splitext(img_url)[1] or '.jpg'
                 filename = f"wallhaven_{selected['id']}{file_ext}"
                 save_path = os.path.join(self.config["download_folder"], filename)
                 
-                self.api.download_image(img_url, save_path)
-                
-                # Validate downloaded image
-                if not self.validator.is_valid_image(save_path):
-                    os.remove(save_path)
-                    return False
-                
-                self.set_wallpaper(save_path, selected['id'], "static")
-                
-                # Index in duplicate detector
-                if self.duplicate_detector and self.duplicate_detector.enabled:
-                    self.duplicate_detector.index_image(save_path)
-                
-                return True
+                digest = self.api.download_image(img_url, save_path, self.quota)
+                return self.apply_downloaded(save_path, selected['id'], digest)
             return False
         except Exception as e:
             print(f"Error changing wallpaper: {e}")
             return False
     
+    def apply_prefetched(self, item):
+        """Set a wallpaper taken from the prefetch queue without touching the network or decoding"""
+        save_path = self.prefetcher.promote(item, self.config["download_folder"])
+        if not save_path:
+            return False
+        self.thumbnails.request(save_path)
+        
+        self.set_wallpaper(save_path, item['id'], "static", validated=True)
+        
+        if self.duplicate_detector and self.duplicate_detector.enabled:
+            self.duplicate_detector.index_image(save_path, (save_path,) + item['record'][1:], item['digest'])
+        return True
+    
+    def analyze_image(self, image_path):
+        """Single-decode (path, phash, file_size, width, height, thumb_phash) record for an image"""
+        if self.duplicate_detector:
+            return self.duplicate_detector.analyze(image_path)
+        return compute_image_record(image_path)
+    
+    def apply_downloaded(self, save_path, wallpaper_id, content_hash=None):
+        """Validate, set and index a freshly downloaded file with a single decode"""
+        record = self.analyze_image(save_path)
+        
+        # Validate downloaded image
+        if not record[1]:
+            self.quota.record_delete(os.path.getsize(save_path))
+            os.remove(save_path)
+            return False
+        
+        self.thumbnails.request(save_path)
+        self.set_wallpaper(save_path, wallpaper_id, "static", validated=True)
+        
+        # Index in duplicate detector
+        if self.duplicate_detector and self.duplicate_detector.enabled:
+            self.duplicate_detector.index_image(save_path, record, content_hash)
+        
+        return True
+    
     def toggle_favorite_current(self):
         if not self.current_wallpaper_id:
             return False, "No wallpaper"
@@ -1330,92 +4664,316 @@ class WallpaperChanger:
         current = self.current_nav_index + 1 if self.current_nav_index >= 0 else 0
         return current, total
 
+def benchmark_rotation(folder, changes=200, random_order=True):
+    """Rotate through a folder headlessly with the null setter.
+
+    Runs on a throwaway data folder, so the user's index, favorites and view
+    history are untouched. Returns {files, changes, scan_seconds, seconds,
+    changes_per_second, quota_mb}.
+    """
+    previous_app_data = APP_DATA
+    with tempfile.TemporaryDirectory() as app_data:
+        set_app_data(app_data)
+        try:
+            return _run_rotation(folder, changes, random_order)
+        finally:
+            set_app_data(previous_app_data)
+
+def _run_rotation(folder, changes, random_order):
+    config = DEFAULT_CONFIG.copy()
+    config.update({
+        "download_folder": folder,
+        "random_order": random_order,
+        "prefetch_enabled": False,
+        "notifications": False,
+        "remember_last_wallpaper": False,
+        "fast_start": False,
+    })
+    setter = NullWallpaperSetter()
+    started = time.monotonic()
+    changer = WallpaperChanger(config, setter=setter)
+    try:
+        scan_seconds = time.monotonic() - started
+        started = time.monotonic()
+        for _ in range(changes):
+            if not changer.next_wallpaper() and not random_order:
+                changer.current_nav_index = -1  # wrap around
+        elapsed = time.monotonic() - started
+        return {
+            "files": len(changer.downloaded_wallpapers),
+            "changes": len(setter.history),
+            "scan_seconds": scan_seconds,
+            "seconds": elapsed,
+            "changes_per_second": len(setter.history) / elapsed if elapsed else 0.0,
+            "quota_mb": changer.quota.get_folder_size_mb()
+        }
+    finally:
+        changer.thumbnails.close()
+        changer.quota.close()
+        if changer.search_cache:
+            changer.search_cache.close()
+        changer.db.close()
+        changer.library.close()
+
+def profile_imports(top=15):
+    """Run a fresh interpreter under -X importtime and return
+    (total_ms, [(module, cumulative_ms)]) for the slowest modules this one imports.
+
+    Modules that load lazily only show up once something uses them.
+    """
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=120
+    )
+    
+    # Children are printed before their parent, one indent level deeper
+    total = 0.0
+    pending = []
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            pending.append((name.strip(), int(cumulative) / 1000))
+        elif depth == 0:
+            if name.strip() == module:
+                total = int(cumulative) / 1000
+                imports = pending
+            pending = []
+    return total, sorted(imports, key=lambda item: -item[1])[:top]
+
+def benchmark_startup(top_imports=15):
+    """Time start-up the way the app does it: engine construction, the first
+    wallpaper change and the background library refresh.
+
+    Uses the app's real config and data with the null setter.
+    """
+    config = WallpaperChanger.load_config()
+    config.update({
+        "notifications": False,
+        "remember_last_wallpaper": False,
+        "prefetch_enabled": False,
+    })
+    results = {"import_seconds": IMPORT_SECONDS}
+    started = time.perf_counter()
+    engine = WallpaperEngine(config, setter=NullWallpaperSetter())
+    try:
+        changer = engine.changer
+        results["engine_seconds"] = time.perf_counter() - started
+        changer.next_wallpaper()
+        results["first_wallpaper_seconds"] = time.perf_counter() - started
+        changer.library_ready.wait(300)
+        results["library_ready_seconds"] = time.perf_counter() - started
+        results["wallpapers"] = len(changer.downloaded_wallpapers)
+    finally:
+        engine.close()
+    
+    if top_imports and not getattr(sys, 'frozen', False):
+        results["import_total_ms"], results["slowest_imports"] = profile_imports(top_imports)
+    return results
+
+# ============================================================================
+# ENGINE
+# ============================================================================
+
+class WallpaperEngine:
+    """Everything the app runs besides its UI: the changer and its scheduler,
+    the sources, the batch job queue and the duplicate detector.
+
+    The Tk app builds its windows on top of one of these; the command line
+    runs one on its own, without Tk, the tray icon or keyboard hooks.
+    """
+    
+    def __init__(self, config=None, app=None, setter=None):
+        self.changer = WallpaperChanger(config, app=app, setter=setter)
+        self.source_manager = SourceManager(
+            SecureConfig.get_api_key(self.changer.config),
+            self.changer.config,
+            self.changer.search_cache,
+            self.changer.transport
+        )
+        self.keyword_manager = KeywordManager()
+        self.job_queue = DownloadJobQueue(DOWNLOAD_JOBS_FILE)
+        self.job_queue.prune()
+        self.changer.prefilter.job_queue = self.job_queue
+        # One batch at a time; runs share the job queue
+        self.download_lock = threading.Lock()
+        self.duplicate_detector = DuplicateDetector(
+            DUPLICATE_DB_FILE,
+            self.changer.config.get("duplicate_detection_enabled", True),
+            self.changer.config.get("duplicate_hash_size", 8),
+            self.changer.config.get("duplicate_similarity_threshold", 0.9),
+            self.changer.config.get("duplicate_fast_hash", True)
+        )
+        
+        # Link to changer
+        self.changer.duplicate_detector = self.duplicate_detector
+        self.changer.quota.duplicate_detector = self.duplicate_detector
+        if self.changer.prefetcher:
+            self.changer.prefetcher.duplicate_detector = self.duplicate_detector
+    
+    def batch_downloader(self):
+        config = self.changer.config
+        return BatchDownloader(
+            self.source_manager,
+            config["download_folder"],
+            self.changer.quota,
+            self.duplicate_detector,
+            workers=config.get("download_workers", 4),
+            rate_limit=config.get("download_rate_limit", 2.0),
+            engine=self.changer.download_engine,
+            job_queue=self.job_queue,
+            prefilter=self.changer.prefilter,
+            thumbnail_check=config.get("duplicate_thumbnail_check", True),
+            thumbnail_cache=self.changer.thumbnails
+        )
+    
+    def download_keywords(self, keywords=None, per_keyword=None, progress_callback=None):
+        """Batch download, resuming an interrupted run first; returns the BatchDownloader used"""
+        downloader = self.batch_downloader()
+        downloader.progress_callback = progress_callback
+        with self.download_lock:
+            downloader.download_all(
+                keywords if keywords is not None else self.keyword_manager.keywords,
+                per_keyword or self.keyword_manager.downloads_per_keyword
+            )
+        # Only keywords whose every image finished count as downloaded
+        for kw in downloader.completed_keywords:
+            self.keyword_manager.record_download(kw)
+        self.changer.scan_downloaded_wallpapers()
+        return downloader
+    
+    def stats(self):
+        changer = self.changer
+        folder = changer.config["download_folder"]
+        run = self.job_queue.unfinished_run()
+        return {
+            "download_folder": folder,
+            "wallpapers": len(changer.downloaded_wallpapers),
+            "current_wallpaper": changer.current_wallpaper,
+            "quota_used_mb": round(changer.quota.get_folder_size_mb(), 1),
+            "quota_limit_mb": changer.quota.max_size_mb if changer.quota.enabled else None,
+            "favorites": changer.db.store.query_one("SELECT COUNT(*) FROM favorites")[0],
+            "keywords": len(self.keyword_manager.keywords),
+            "unfinished_batch": run[0] if run else None,
+            "duplicates": self.duplicate_detector.get_stats(),
+        }
+    
+    def close(self):
+        self.changer.stop_auto_change()
+        if self.changer.prefetcher:
+            self.changer.prefetcher.close()
+        self.changer.quota.close()
+        if self.changer.search_cache:
+            self.changer.search_cache.close()
+        if self.changer.download_engine:
+            self.changer.download_engine.close()
+        self.job_queue.close()
+        self.changer.thumbnails.close()
+        self.changer.db.close()
+        self.duplicate_detector.close()
+        # Last: the quota manager and prefetcher above still read the index while shutting down
+        self.changer.library.close()
+
 # ============================================================================
 # MODERN UI WIDGETS
 # ============================================================================
 
-class ModernCard(tk.Frame):
-    def __init__(self, parent, colors, **kwargs):
-        super().__init__(parent, bg=colors["card_bg"], **kwargs)
-        self.colors = colors
-        self.configure(relief='flat', bd=0)
-        self.inner = tk.Frame(self, bg=colors["card_bg"])
-        self.inner.pack(fill='both', expand=True, padx=12, pady=12)
+# The widget classes subclass tkinter ones, so they are only defined once
+# the window is built; headless commands never import tkinter.
+ModernCard = ModernButton = ModernToggle = None
 
-class ModernButton(tk.Button):
-    def __init__(self, parent, text="", command=None, variant="primary", **kwargs):
-        # Try to get colors from parent, fallback to light scheme
-        if hasattr(parent, 'colors'):
-            colors = parent.colors
-        else:
-            # Walk up the widget hierarchy to find colors
-            colors = COLOR_SCHEMES["light"]
+def load_ui_widgets():
+    """Import tkinter and define the Modern* widget classes (idempotent)"""
+    global ModernCard, ModernButton, ModernToggle
+    if ModernCard is not None:
+        return
+    
+    class ModernCard(tk.Frame):
+        def __init__(self, parent, colors, **kwargs):
+            super().__init__(parent, bg=colors["card_bg"], **kwargs)
+            self.colors = colors
+            self.configure(relief='flat', bd=0)
+            self.inner = tk.Frame(self, bg=colors["card_bg"])
+            self.inner.pack(fill='both', expand=True, padx=12, pady=12)
+
+    class ModernButton(tk.Button):
+        def __init__(self, parent, text="", command=None, variant="primary", **kwargs):
+            # Try to get colors from parent, fallback to light scheme
+            if hasattr(parent, 'colors'):
+                colors = parent.colors
+            else:
+                # Walk up the widget hierarchy to find colors
+                colors = COLOR_SCHEMES["light"]
+                p = parent
+                while p:
+                    if hasattr(p, 'colors'):
+                        colors = p.colors
+                        break
+                    p = p.master
+            
+            variants = {
+                "primary": {"bg": colors["accent"], "fg": "white", "hover": colors["accent_light"]},
+                "secondary": {"bg": colors["card_bg"], "fg": colors["fg"], "hover": colors["card_shadow"]},
+                "success": {"bg": colors["success"], "fg": "white", "hover": "#34d399"},
+                "danger": {"bg": colors["error"], "fg": "white", "hover": "#f87171"},
+                "info": {"bg": colors["info"], "fg": "white", "hover": colors["accent_light"]}
+            }
+            
+            style = variants.get(variant, variants["primary"])
+            
+            super().__init__(parent, text=text, command=command,
+                            bg=style["bg"], fg=style["fg"],
+                            font=('Segoe UI', 10),
+                            relief='flat', bd=0,
+                            padx=16, pady=8,
+                            cursor='hand2',
+                            activebackground=style["hover"],
+                            activeforeground="white",
+                            **kwargs)
+            
+            self.bind('<Enter>', lambda e: self.config(bg=style["hover"]))
+            self.bind('<Leave>', lambda e: self.config(bg=style["bg"]))
+
+    class ModernToggle(tk.Frame):
+        def __init__(self, parent, text="", variable=None, **kwargs):
+            # Find colors from parent hierarchy
+            self.colors = COLOR_SCHEMES["light"]  # default
             p = parent
             while p:
                 if hasattr(p, 'colors'):
-                    colors = p.colors
+                    self.colors = p.colors
                     break
                 p = p.master
+            
+            super().__init__(parent, bg=self.colors["bg"])
+            self.variable = variable or tk.BooleanVar()
+            
+            if text:
+                self.label = tk.Label(self, text=text, bg=self.colors["bg"], fg=self.colors["fg"])
+                self.label.pack(side='left', padx=(0, 10))
+            
+            self.canvas = tk.Canvas(self, width=50, height=26, bg=self.colors["bg"], highlightthickness=0)
+            self.canvas.pack(side='left')
+            
+            self.draw_toggle()
+            self.canvas.bind('<Button-1>', self.toggle)
+            self.variable.trace('w', lambda *args: self.draw_toggle())
+        
+        def draw_toggle(self):
+            self.canvas.delete("all")
+            if self.variable.get():
+                self.canvas.create_rectangle(0, 0, 50, 26, fill=self.colors["accent"], outline="")
+                self.canvas.create_oval(26, 2, 48, 24, fill="white", outline="")
+            else:
+                self.canvas.create_rectangle(0, 0, 50, 26, fill=self.colors["trough_color"], outline="")
+                self.canvas.create_oval(2, 2, 24, 24, fill="white", outline="")
         
-        variants = {
-            "primary": {"bg": colors["accent"], "fg": "white", "hover": colors["accent_light"]},
-            "secondary": {"bg": colors["card_bg"], "fg": colors["fg"], "hover": colors["card_shadow"]},
-            "success": {"bg": colors["success"], "fg": "white", "hover": "#34d399"},
-            "danger": {"bg": colors["error"], "fg": "white", "hover": "#f87171"},
-            "info": {"bg": colors["info"], "fg": "white", "hover": colors["accent_light"]}
-        }
-        
-        style = variants.get(variant, variants["primary"])
-        
-        super().__init__(parent, text=text, command=command,
-                        bg=style["bg"], fg=style["fg"],
-                        font=('Segoe UI', 10),
-                        relief='flat', bd=0,
-                        padx=16, pady=8,
-                        cursor='hand2',
-                        activebackground=style["hover"],
-                        activeforeground="white",
-                        **kwargs)
-        
-        self.bind('<Enter>', lambda e: self.config(bg=style["hover"]))
-        self.bind('<Leave>', lambda e: self.config(bg=style["bg"]))
-
-class ModernToggle(tk.Frame):
-    def __init__(self, parent, text="", variable=None, **kwargs):
-        # Find colors from parent hierarchy
-        self.colors = COLOR_SCHEMES["light"]  # default
-        p = parent
-        while p:
-            if hasattr(p, 'colors'):
-                self.colors = p.colors
-                break
-            p = p.master
-        
-        super().__init__(parent, bg=self.colors["bg"])
-        self.variable = variable or tk.BooleanVar()
-        
-        if text:
-            self.label = tk.Label(self, text=text, bg=self.colors["bg"], fg=self.colors["fg"])
-            self.label.pack(side='left', padx=(0, 10))
-        
-        self.canvas = tk.Canvas(self, width=50, height=26, bg=self.colors["bg"], highlightthickness=0)
-        self.canvas.pack(side='left')
-        
-        self.draw_toggle()
-        self.canvas.bind('<Button-1>', self.toggle)
-        self.variable.trace('w', lambda *args: self.draw_toggle())
-    
-    def draw_toggle(self):
-        self.canvas.delete("all")
-        if self.variable.get():
-            self.canvas.create_rectangle(0, 0, 50, 26, fill=self.colors["accent"], outline="")
-            self.canvas.create_oval(26, 2, 48, 24, fill="white", outline="")
-        else:
-            self.canvas.create_rectangle(0, 0, 50, 26, fill=self.colors["trough_color"], outline="")
-            self.canvas.create_oval(2, 2, 24, 24, fill="white", outline="")
-    
-    def toggle(self, event=None):
-        self.variable.set(not self.variable.get())
+        def toggle(self, event=None):
+            self.variable.set(not self.variable.get())
 
 # ============================================================================
 # SYSTEM TRAY
@@ -1429,6 +4987,7 @@ class SystemTray:
         self.create_icon()
     
     def create_icon(self):
+        from PIL import ImageDraw
         icon_size = 64
         colors = COLOR_SCHEMES[self.app.current_scheme]
         
@@ -1552,7 +5111,7 @@ class DuplicateDetectorTab:
         self.scan_stop_event = threading.Event()
         
         self.setup_ui()
-        self.update_stats()
+        self.poll_stats()
     
     def setup_ui(self):
         header = tk.Frame(self.parent, bg=self.colors["bg"])
@@ -1592,6 +5151,15 @@ class DuplicateDetectorTab:
         tk.Spinbox(hash_frame, from_=4, to=16, textvariable=self.hash_size_var,
                   bg=self.colors["entry_bg"], fg=self.colors["fg"], width=5).pack(side='left', padx=5)
         
+        # Similarity threshold
+        similarity_frame = tk.Frame(settings_card.inner, bg=self.colors["card_bg"])
+        similarity_frame.pack(fill='x', pady=5)
+        
+        tk.Label(similarity_frame, text="Similarity:", bg=self.colors["card_bg"], fg=self.colors["fg"]).pack(side='left')
+        self.similarity_var = tk.DoubleVar(value=self.config.get("duplicate_similarity_threshold", 0.9))
+        tk.Spinbox(similarity_frame, from_=0.5, to=1.0, increment=0.01, textvariable=self.similarity_var,
+                  bg=self.colors["entry_bg"], fg=self.colors["fg"], width=5).pack(side='left', padx=5)
+        
         # Keep Newest
         keep_frame = tk.Frame(settings_card.inner, bg=self.colors["card_bg"])
         keep_frame.pack(fill='x', pady=5)
@@ -1633,7 +5201,11 @@ class DuplicateDetectorTab:
     def update_stats(self):
         stats = self.duplicate_detector.get_stats()
         self.stats_var.set(f"Indexed: {stats['total_indexed']} | Unique: {stats['unique_hashes']} | Duplicates: {stats['duplicate_count']}")
-        self.parent.after(5000, self.update_stats)
+    
+    def poll_stats(self):
+        """The single periodic refresh; other callers use update_stats() for a one-off update"""
+        self.update_stats()
+        self.parent.after(5000, self.poll_stats)
     
     def scan_folder(self):
         folder = self.app.changer.config["download_folder"]
@@ -1649,7 +5221,8 @@ class DuplicateDetectorTab:
                 indexed, existing = self.duplicate_detector.scan_folder(
                     folder, 
                     update_progress,
-                    self.scan_stop_event
+                    self.scan_stop_event,
+                    workers=self.config.get("duplicate_scan_workers", 0) or None
                 )
                 self.app.root.after(0, lambda: self.scan_done(indexed, existing))
             
@@ -1670,12 +5243,15 @@ class DuplicateDetectorTab:
         
         def do_find():
             duplicates = self.duplicate_detector.find_duplicates()
-            self.app.root.after(0, lambda: self.show_duplicates(duplicates))
+            groups = self.duplicate_detector.group_duplicates(duplicates)
+            self.app.root.after(0, lambda: self.show_duplicates(duplicates, groups))
         
         threading.Thread(target=do_find, daemon=True).start()
     
-    def show_duplicates(self, duplicates):
+    def show_duplicates(self, duplicates, groups):
         self.progress_bar.stop()
+        self.progress_var.set(f"Near-duplicate groups: {len(groups)} "
+                              f"({sum(len(group) - 1 for group in groups)} redundant files)")
         
         if not duplicates:
             messagebox.showinfo("No Duplicates", "No duplicates found!")
@@ -1702,6 +5278,7 @@ class DuplicateDetectorTab:
             
             def do_cleanup():
                 deleted = self.duplicate_detector.cleanup_duplicates(self.keep_newest_var.get())
+                self.app.changer.quota.reconcile()
                 self.app.root.after(0, lambda: self.cleanup_done(deleted))
             
             threading.Thread(target=do_cleanup, daemon=True).start()
@@ -1716,7 +5293,9 @@ class DuplicateDetectorTab:
     def save_settings(self):
         self.config["duplicate_hash_size"] = self.hash_size_var.get()
         self.config["duplicate_keep_newest"] = self.keep_newest_var.get()
+        self.config["duplicate_similarity_threshold"] = self.similarity_var.get()
         self.duplicate_detector.hash_size = self.hash_size_var.get()
+        self.duplicate_detector.similarity_threshold = self.similarity_var.get()
         self.app.changer.save_config()
         messagebox.showinfo("Success", "Settings saved!")
 
@@ -1733,6 +5312,10 @@ class KeywordsTab:
         self.batch_downloader = None
         
         self.setup_ui()
+        
+        # Pick up a batch that was still running when the app last exited
+        if self.app.job_queue.unfinished_run(include_stopped=False):
+            self.app.root.after(3000, self.download_now)
     
     def setup_ui(self):
         # Keywords List
@@ -1823,16 +5406,13 @@ class KeywordsTab:
         self.keyword_manager.save_keywords()
     
     def download_now(self):
+        if self.batch_downloader and self.batch_downloader.is_downloading:
+            return
         if not self.keyword_manager.keywords:
             messagebox.showinfo("No Keywords", "Add some keywords first!")
             return
         
-        self.batch_downloader = BatchDownloader(
-            self.app.source_manager,
-            self.app.changer.config["download_folder"],
-            self.app.changer.quota,
-            self.app.duplicate_detector
-        )
+        self.batch_downloader = self.app.engine.batch_downloader()
         self.batch_downloader.progress_callback = self.update_progress
         self.batch_downloader.complete_callback = self.download_complete
         
@@ -1845,7 +5425,8 @@ class KeywordsTab:
                 self.keyword_manager.keywords,
                 self.keyword_manager.downloads_per_keyword
             )
-            for kw in self.keyword_manager.keywords:
+            # Only keywords whose every image finished count as downloaded
+            for kw in self.batch_downloader.completed_keywords:
                 self.keyword_manager.record_download(kw)
         
         threading.Thread(target=download_thread, daemon=True).start()
@@ -1882,7 +5463,7 @@ class SettingsTab:
     
     def check_keyring_status(self):
         """Check and display keyring status"""
-        if HAS_KEYRING:
+        if load_keyring():
             try:
                 # Test keyring by setting and getting a test value
                 test_key = "test_connection"
@@ -2322,6 +5903,24 @@ class QuotaTab:
         self.quota_size = tk.IntVar(value=self.config.get("quota_size", 1000))
         tk.Spinbox(size_frame, from_=50, to=100000, textvariable=self.quota_size, width=8).pack(side='left', padx=5)
         
+        # Eviction
+        evict_frame = tk.Frame(card.inner, bg=self.colors["card_bg"])
+        evict_frame.pack(fill='x', pady=5)
+        
+        self.auto_evict = tk.BooleanVar(value=self.config.get("quota_auto_evict", False))
+        tk.Checkbutton(evict_frame, text="Free space automatically (favorites are never deleted)",
+                      variable=self.auto_evict, bg=self.colors["card_bg"], fg=self.colors["fg"]).pack(anchor='w')
+        
+        policy_frame = tk.Frame(card.inner, bg=self.colors["card_bg"])
+        policy_frame.pack(fill='x', pady=5)
+        
+        tk.Label(policy_frame, text="Delete first:", bg=self.colors["card_bg"], fg=self.colors["fg"]).pack(side='left')
+        self.policy_names = {label: key for key, label in QuotaManager.EVICTION_POLICIES.items()}
+        current_policy = self.config.get("quota_eviction_policy", "lru")
+        self.eviction_policy = tk.StringVar(value=QuotaManager.EVICTION_POLICIES.get(current_policy, "Least recently shown"))
+        ttk.Combobox(policy_frame, textvariable=self.eviction_policy, values=list(self.policy_names),
+                     state='readonly', width=25).pack(side='left', padx=5)
+        
         # Usage
         self.usage_label = tk.Label(card.inner, text="Calculating...", bg=self.colors["card_bg"], fg=self.colors["fg"])
         self.usage_label.pack(anchor='w', pady=5)
@@ -2334,11 +5933,11 @@ class QuotaTab:
         btn_frame.pack(fill='x', pady=5)
         
         ModernButton(btn_frame, text="Save", command=self.save_settings, variant="success").pack(side='left', padx=2)
-        ModernButton(btn_frame, text="Refresh", command=self.update_display, variant="info").pack(side='left', padx=2)
+        ModernButton(btn_frame, text="Refresh", command=self.refresh_usage, variant="info").pack(side='left', padx=2)
         
         self.update_display()
     
-    def update_display(self):
+    def update_display(self, schedule=True):
         used = self.quota.get_folder_size_mb()
         max_mb = self.quota.max_size_mb
         self.usage_label.config(text=f"Used: {used:.1f} MB / {max_mb} MB")
@@ -2347,14 +5946,23 @@ class QuotaTab:
             percent = min(100, (used / max_mb) * 100)
             self.progress['value'] = percent
         
-        self.parent.after(5000, self.update_display)
+        if schedule:
+            self.parent.after(5000, self.update_display)
+    
+    def refresh_usage(self):
+        self.quota.reconcile()
+        self.update_display(schedule=False)
     
     def save_settings(self):
         self.config["quota_enabled"] = self.quota_enabled.get()
         self.config["quota_size"] = self.quota_size.get()
         
+        self.config["quota_auto_evict"] = self.auto_evict.get()
+        self.config["quota_eviction_policy"] = self.policy_names.get(self.eviction_policy.get(), "lru")
+        
         self.quota.enabled = self.quota_enabled.get()
         self.quota.max_size_mb = self.quota_size.get()
+        self.quota.eviction_policy = self.config["quota_eviction_policy"] if self.auto_evict.get() else None
         
         self.app.changer.save_config()
 
@@ -2364,25 +5972,18 @@ class QuotaTab:
 
 class ModernWallpaperChangerApp:
     def __init__(self):
-        self.changer = WallpaperChanger(app=self)
-        self.source_manager = SourceManager(
-            SecureConfig.get_api_key(self.changer.config),
-            self.changer.config
-        )
-        self.keyword_manager = KeywordManager()
-        self.duplicate_detector = DuplicateDetector(
-            DUPLICATE_DB_FILE,
-            self.changer.config.get("duplicate_detection_enabled", True),
-            self.changer.config.get("duplicate_hash_size", 8)
-        )
+        self.engine = WallpaperEngine(app=self)
+        self.changer = self.engine.changer
+        self.source_manager = self.engine.source_manager
+        self.keyword_manager = self.engine.keyword_manager
+        self.job_queue = self.engine.job_queue
+        self.duplicate_detector = self.engine.duplicate_detector
         self.shortcut_manager = ShortcutManager(self)
         self.current_scheme = self.changer.config.get("theme", "light")
         
-        # Link to changer
-        self.changer.duplicate_detector = self.duplicate_detector
-        
         self.colors = COLOR_SCHEMES[self.current_scheme]
         
+        load_ui_widgets()
         self.root = tk.Tk()
         self.root.title("Wallpaper Changer")
         self.root.geometry("900x800+100+100")
@@ -2390,6 +5991,14 @@ class ModernWallpaperChangerApp:
         
         self.status_var = tk.StringVar(value="Ready")
         
+        # The tray runs on its own thread, so show it before building the window
+        if HAS_TRAY:
+            try:
+                self.tray = SystemTray(self.changer, self)
+                self.tray.run()
+            except Exception as e:
+                print(f"ℹ️ System tray unavailable: {e}")
+        
         self.setup_ui()
         
         if self.changer.config.get("change_on_startup", True):
@@ -2400,9 +6009,6 @@ class ModernWallpaperChangerApp:
         if self.changer.config.get("auto_start_enabled", True):
             self.root.after(500, self.start_auto_change)
         
-        self.tray = SystemTray(self.changer, self)
-        self.tray.run()
-        
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
     
     def start_auto_change(self):
@@ -2417,20 +6023,22 @@ class ModernWallpaperChangerApp:
             if images:
                 img = images[0]
                 try:
-                    response = requests.get(img['download_url'], timeout=30)
                     file_ext = os.path.splitext(img['download_url'])[1] or '.jpg'
                     filename = f"{img['source']}_{img['id']}{file_ext}"
                     save_path = os.path.join(self.changer.config["download_folder"], filename)
                     
-                    with open(save_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    self.changer.set_wallpaper(save_path, img['id'], "static")
+                    engine = self.changer.download_engine
+                    if engine:
+                        future = engine.submit(engine.download_file(img['download_url'], save_path, self.changer.quota))
+                        engine.deliver(future, self.root, lambda f: self.startup_downloaded(f, save_path, img['id']))
+                        return
                     
-                    if self.duplicate_detector and self.duplicate_detector.enabled:
-                        self.duplicate_detector.index_image(save_path)
+                    digest = self.changer.api.download_image(img['download_url'], save_path, self.changer.quota)
                     
-                    self.root.after(0, self.change_done)
+                    if self.changer.apply_downloaded(save_path, img['id'], digest):
+                        self.root.after(0, self.change_done)
+                    else:
+                        self.root.after(0, self.load_initial_preview)
                 except Exception as e:
                     print(f"Startup error: {e}")
                     self.root.after(0, self.load_initial_preview)
@@ -2439,6 +6047,17 @@ class ModernWallpaperChangerApp:
         
         threading.Thread(target=do_change, daemon=True).start()
     
+    def startup_downloaded(self, future, save_path, wallpaper_id):
+        """Tk-thread completion of an async startup download"""
+        try:
+            size, digest = future.result()
+            if self.changer.apply_downloaded(save_path, wallpaper_id, digest):
+                self.change_done()
+                return
+        except Exception as e:
+            print(f"Startup error: {e}")
+        self.load_initial_preview()
+    
     def change_done(self):
         self.status_var.set("Wallpaper changed")
         self.changer.scan_downloaded_wallpapers()
@@ -2603,6 +6222,9 @@ class ModernWallpaperChangerApp:
         self.root.after(5000, self.update_quota_display)
     
     def update_navigation_display(self):
+        # The background library load can finish before setup_ui has built the label
+        if not hasattr(self, 'nav_label'):
+            return
         current, total = self.changer.get_navigation_info()
         self.nav_label.config(text=f"{current}/{total}")
     
@@ -2628,23 +6250,33 @@ class ModernWallpaperChangerApp:
         self.status_var.set(msg)
     
     def update_preview(self):
-        if self.changer.current_wallpaper and os.path.exists(self.changer.current_wallpaper):
-            try:
-                # Temporarily increase limit for preview
-                original_limit = Image.MAX_IMAGE_PIXELS
-                Image.MAX_IMAGE_PIXELS = None
-                
-                img = Image.open(self.changer.current_wallpaper)
-                img.thumbnail((300, 200))
+        path = self.changer.current_wallpaper
+        if path and os.path.exists(path):
+            cached = self.changer.thumbnails.get(path)
+            if cached:
+                self.show_preview(path, cached)
+                return
+            
+            # Never decode the full wallpaper here; show it once the background thumbnail is ready
+            self.preview_label.config(image="", text="Loading preview...")
+            future = self.changer.thumbnails.request(path)
+            future.add_done_callback(lambda f: self.root.after(0, self.show_preview, path, f.result()))
+    
+    def show_preview(self, path, cached):
+        if path != self.changer.current_wallpaper:
+            return  # the wallpaper changed while this thumbnail was being made
+        if not cached:
+            self.preview_label.config(image="", text="Preview unavailable")
+            return
+        try:
+            from PIL import ImageTk
+            with Image.open(cached) as img:
                 photo = ImageTk.PhotoImage(img)
-                self.preview_label.config(image=photo, text="")
-                self.preview_label.image = photo
-                
-                # Restore limit
-                Image.MAX_IMAGE_PIXELS = original_limit
-            except Exception as e:
-                self.preview_label.config(image="", text="Preview unavailable")
-                print(f"Preview error: {e}")
+            self.preview_label.config(image=photo, text="")
+            self.preview_label.image = photo
+        except Exception as e:
+            self.preview_label.config(image="", text="Preview unavailable")
+            print(f"Preview error: {e}")
     
     def load_initial_preview(self):
         if self.changer.current_wallpaper:
@@ -2679,9 +6311,7 @@ class ModernWallpaperChangerApp:
         self.root.withdraw()
     
     def quit(self):
-        self.changer.stop_auto_change()
-        self.changer.db.close()
-        self.duplicate_detector.close()
+        self.engine.close()
         self.root.quit()
     
     def run(self):
@@ -2697,6 +6327,10 @@ class ShortcutManager:
         self.register_shortcuts()
     
     def register_shortcuts(self):
+        if keyboard is None:
+            print("ℹ️ keyboard not installed - global shortcuts disabled")
+            return
+        
         try:
             keyboard.unhook_all()
         except:
@@ -2733,13 +6367,193 @@ class ShortcutManager:
         self.app.changer.save_config()
         self.register_shortcuts()
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
 # ============================================================================
 # MAIN
 # ============================================================================
 
-def main():
+def run_daemon(engine, fetch_hours=0, stop_event=None):
+    """Rotate wallpapers on the configured interval and, optionally, fetch keywords every fetch_hours"""
+    stop_event = stop_event or threading.Event()
+    changer = engine.changer
+    
+    if engine.job_queue.unfinished_run(include_stopped=False):
+        print("Resuming interrupted batch download...")
+        threading.Thread(target=engine.download_keywords, kwargs={'progress_callback': print}, daemon=True).start()
+    
+    changer.start_auto_change()
+    print(f"Changing wallpaper every {changer.get_interval_seconds()}s - Ctrl+C to stop")
+    
+    next_fetch = time.monotonic() + fetch_hours * 3600 if fetch_hours > 0 else None
+    while not stop_event.wait(1.0):
+        if next_fetch and time.monotonic() >= next_fetch:
+            keywords = engine.keyword_manager.get_keywords_for_download()
+            if keywords:
+                engine.download_keywords(keywords, progress_callback=print)
+            next_fetch = time.monotonic() + fetch_hours * 3600
+    changer.stop_auto_change()
+    print("Stopped")
+
+def build_arg_parser():
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="wallpaper_changer",
+        description="Wallhaven wallpaper changer. Run without a command to open the window."
+    )
+    parser.add_argument("--setter", choices=["auto"] + list(WALLPAPER_SETTERS),
+                        help="wallpaper backend (default: wallpaper_setter from the config)")
+    commands = parser.add_subparsers(dest="command")
+    
+    daemon = commands.add_parser("daemon", help="change wallpapers on a schedule without any UI")
+    daemon.add_argument("--fetch-every", type=float, default=0, metavar="HOURS",
+                        help="also download new wallpapers for the saved keywords every HOURS")
+    
+    scan = commands.add_parser("scan", help="index the download folder for duplicate detection")
+    scan.add_argument("folder", nargs="?", help="folder to scan (default: the download folder)")
+    
+    dedup = commands.add_parser("dedup", help="list near-duplicate wallpapers")
+    dedup.add_argument("--delete", action="store_true", help="delete duplicates, keeping one per group")
+    dedup.add_argument("--keep-oldest", action="store_true", help="keep the oldest file instead of the newest")
+    
+    fetch = commands.add_parser("fetch", help="batch download wallpapers for keywords")
+    fetch.add_argument("keywords", nargs="*", help="keywords (default: the saved keyword list)")
+    fetch.add_argument("-n", "--count", type=int, help="wallpapers per keyword")
+    
+    next_cmd = commands.add_parser("next", help="change the wallpaper once")
+    next_cmd.add_argument("--local", action="store_true", help="pick from downloaded wallpapers only")
+    
+    stats = commands.add_parser("stats", help="show library, quota and duplicate statistics")
+    stats.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    
+    startup = commands.add_parser("startup", help="measure start-up time")
+    startup.add_argument("--imports", type=int, default=15, metavar="N",
+                         help="list the N slowest imports from python -X importtime (0 to skip)")
+    
+    bench = commands.add_parser("bench", help="measure download, hashing or rotation speed")
+    benches = bench.add_subparsers(dest="bench", required=True)
+    downloads = benches.add_parser("downloads", help="threaded vs async downloads of the same URLs")
+    downloads.add_argument("urls", nargs="+", help="URLs to download (files are deleted afterwards)")
+    downloads.add_argument("--workers", type=int, default=4, help="threads for the threaded backend")
+    downloads.add_argument("--concurrency", type=int, default=50, help="in-flight transfers for the async backend")
+    hashes = benches.add_parser("hashes", help="fast (draft) vs full-decode perceptual hashes")
+    hashes.add_argument("folder", nargs="?", help="images to hash (default: the download folder)")
+    hashes.add_argument("--sample", type=int, default=100, help="images to compare")
+    rotation = benches.add_parser("rotation", help="headless wallpaper changes with the null setter")
+    rotation.add_argument("folder", nargs="?", help="wallpapers to rotate (default: the download folder)")
+    rotation.add_argument("--changes", type=int, default=200, help="number of changes")
+    rotation.add_argument("--sequential", action="store_true", help="step in order instead of randomly")
+    return parser
+
+def run_benchmark(args):
+    """The bench subcommand; runs on temporary data and prints {key: value} results"""
+    config = WallpaperChanger.load_config()
+    if args.bench == "downloads":
+        with tempfile.TemporaryDirectory() as folder:
+            results = benchmark_download_backends(args.urls, folder, args.workers, args.concurrency)
+    elif args.bench == "hashes":
+        folder = args.folder or config["download_folder"]
+        paths = [entry.path for entry in os.scandir(folder)
+                 if entry.is_file() and entry.name.lower().endswith(LibraryIndex.IMAGE_EXTENSIONS)]
+        with tempfile.TemporaryDirectory() as db_folder:
+            detector = DuplicateDetector(os.path.join(db_folder, "hashes.db"),
+                                         hash_size=config.get("duplicate_hash_size", 8),
+                                         similarity_threshold=config.get("duplicate_similarity_threshold", 0.9))
+            try:
+                results = {"hashes": detector.compare_hash_modes(paths, args.sample)}
+            finally:
+                detector.close()
+    else:
+        results = {"rotation": benchmark_rotation(args.folder or config["download_folder"], args.changes,
+                                                  random_order=not args.sequential)}
+    
+    for name, values in results.items():
+        print(f"{name}: " + ", ".join(
+            f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in values.items()
+        ))
+    return 0
+
+def run_command(args):
+    if args.command == "bench":
+        return run_benchmark(args)
+    if args.command == "startup":
+        results = benchmark_startup(args.imports)
+        for key in ("import_seconds", "engine_seconds", "first_wallpaper_seconds", "library_ready_seconds"):
+            print(f"{key}: {results[key]:.3f}")
+        print(f"wallpapers: {results['wallpapers']}")
+        if "slowest_imports" in results:
+            print(f"\nimport time (-X importtime): {results['import_total_ms']:.1f} ms")
+            for name, ms in results["slowest_imports"]:
+                print(f"  {ms:8.1f} ms  {name}")
+        return 0
+    
+    config = WallpaperChanger.load_config()
+    config["notifications"] = False
+    if args.command != "daemon":
+        config["prefetch_enabled"] = False
+        config["fast_start"] = False
+    setter = create_wallpaper_setter(args.setter) if args.setter else None
+    engine = WallpaperEngine(config, setter=setter)
+    changer = engine.changer
+    
+    try:
+        if args.command == "daemon":
+            import signal
+            stop_event = threading.Event()
+            signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+            signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+            run_daemon(engine, args.fetch_every, stop_event)
+        
+        elif args.command == "scan":
+            folder = args.folder or config["download_folder"]
+            indexed, existing = engine.duplicate_detector.scan_folder(
+                folder, progress_callback=lambda message, count: print(f"\r{message}", end="", flush=True)
+            )
+            print(f"\nIndexed {indexed} new images ({existing} already known)")
+        
+        elif args.command == "dedup":
+            if args.delete:
+                deleted = engine.duplicate_detector.cleanup_duplicates(keep_newest=not args.keep_oldest)
+                changer.quota.reconcile()
+                print(f"Deleted {deleted} duplicates")
+            else:
+                duplicates = engine.duplicate_detector.find_duplicates()
+                for first, second in duplicates:
+                    print(f"{first}\t{second}")
+                groups = engine.duplicate_detector.group_duplicates(duplicates)
+                print(f"{len(duplicates)} duplicate pairs in {len(groups)} groups")
+        
+        elif args.command == "fetch":
+            downloader = engine.download_keywords(args.keywords or None, args.count, progress_callback=print)
+            stats = downloader.last_run_stats
+            if stats:
+                print(", ".join(f"{key}: {value}" for key, value in stats.items()))
+        
+        elif args.command == "next":
+            ok = changer.next_wallpaper() if args.local else changer.change_wallpaper()
+            print(changer.current_wallpaper if ok else "Could not change wallpaper")
+            return 0 if ok else 1
+        
+        elif args.command == "stats":
+            stats = engine.stats()
+            if args.json:
+                print(json.dumps(stats, indent=2))
+            else:
+                for key, value in stats.items():
+                    print(f"{key}: {value}")
+        return 0
+    finally:
+        engine.close()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_command(build_arg_parser().parse_args(argv))
     app = ModernWallpaperChangerApp()
     app.run()
 
 if __name__ == "__main__":
-    main()
+    # Needed for the DuplicateDetector process pool in frozen Windows builds
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())